@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+from copy import deepcopy
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+from uuid import UUID
+
+from cloud import fb_memory
+from cloud.utils import escape_email, escape_version
+
+# Benchmarks
+'''
+Times the hot paths (reads, queries, writes, casting and session checks) against the
+in-memory backend, so that the numbers are about our code and not the network. The
+mock project is extended with a `bench_w{width}` type per document width (the batch
+schema plus `width` extra string fields) and a `bench-{size}@example.org` user per
+eligible-set size, with slots for `size` docs of each of those types.
+
+    python benchmark.py --sizes 100,1000 --widths 0,50 --output before.json
+    python benchmark.py --compare before.json after.json
+
+Results are written as json, keyed by benchmark and parameters, with the git revision
+they were measured on.
+'''
+
+BASE_TYPE = 'batch'
+BENCH_USER = 'bench-{size}@example.org'
+BENCH_TYPE = 'bench_w{width}'
+# docs read one by one per run of the read benchmark
+READS_PER_RUN = 50
+# sessions checked per run of the session benchmarks
+SESSIONS_PER_RUN = 100
+WRITE_SIZES = [1, 100, 1000]
+# docs cast per run of the cast benchmark
+CAST_DOCS = 1000
+
+
+def git_revision() -> Dict:
+    def _git(*args) -> str:
+        try:
+            return subprocess.run(
+                ['git', *args], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+    return {'rev': _git('rev-parse', 'HEAD') or None, 'dirty': bool(_git('status', '--porcelain'))}
+
+
+# # Data
+
+def _bench_schema(schema: Dict, name: str, width: int) -> Dict:
+    res = deepcopy(schema)
+    res['name'] = name
+    res['fields'] = res['fields'] + [
+        {'name': f'extra_{x}', 'description': f'extra_{x}', 'type': ['null', 'string']}
+        for x in range(width)
+    ]
+    return res
+
+
+def seed(cfs, rtdb, folder: str, sizes: List[int], widths: List[int]) -> str:
+    # loads the mock project, then the bench types and users, returns the app id
+    app_id = fb_memory.load_mock_project(cfs, rtdb, folder)
+    info = rtdb.reference(f'{app_id}/settings').get()
+    version = info['defaultVersion']
+    schema_path = f'objects/{app_id}/{escape_version(version)}'
+    schema = json.loads(rtdb.reference(f'{schema_path}/{BASE_TYPE}').get())
+    templates = [
+        doc.to_dict() for doc in cfs.ref(path=f'{app_id}/data/{BASE_TYPE}').stream()
+    ]
+    total = max(sizes)
+    _ids = [str(UUID(int=x + 1)) for x in range(total)]
+    for width in widths:
+        _type = BENCH_TYPE.format(width=width)
+        rtdb.reference(f'{schema_path}/{_type}').set(
+            json.dumps(_bench_schema(schema, _type, width)))
+        for x, _id in enumerate(_ids):
+            doc = {
+                **templates[x % len(templates)],
+                'uuid': _id,
+                'version_modified': version,
+                **{f'extra_{i}': f'{x}-{i}' for i in range(width)}
+            }
+            cfs.ref(full_path=f'{app_id}/data/{_type}/{_id}').set(doc)
+    for size in sizes:
+        user = escape_email(BENCH_USER.format(size=size))
+        for width in widths:
+            _type = BENCH_TYPE.format(width=width)
+            for _id in _ids[:size]:
+                cfs.ref(full_path=f'{app_id}/slots/{user}/data/{_type}/{_id}').set(
+                    {'modified': '0'})
+    return app_id
+
+
+# # Timing
+
+class Bench(object):
+
+    def __init__(
+        self,
+        name: str,
+        params: Dict,
+        fn: Callable[[], int],
+        setup: Callable[[], None] = None,
+        warmup: bool = True
+    ):
+        # fn returns the number of operations it did (docs, reads, ...)
+        self.name = name
+        self.params = params
+        self.fn = fn
+        self.setup = setup
+        self.warmup = warmup
+
+    def key(self) -> str:
+        params = ','.join(f'{k}={v}' for k, v in sorted(self.params.items()))
+        return f'{self.name}[{params}]' if params else self.name
+
+    def run(self, repeat: int) -> Dict:
+        if self.warmup:
+            self.setup and self.setup()
+            self.fn()
+        timings = []
+        ops = 0
+        for _ in range(repeat):
+            self.setup and self.setup()
+            start = time.perf_counter()
+            ops = self.fn()
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        median = statistics.median(timings)
+        return {
+            'name': self.name,
+            'params': self.params,
+            'runs': repeat,
+            'ops': ops,
+            'min': timings[0],
+            'median': median,
+            'mean': statistics.mean(timings),
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'ops_per_sec': ops / median if median else None
+        }
+
+
+def _program_filter(value: str) -> Dict:
+    return {'filter': {'fieldFilter': {
+        'field': {'fieldPath': 'program'}, 'op': 'EQUAL', 'value': {'stringValue': value}}}}
+
+
+def _cursor(value: int, before: bool = False) -> Dict:
+    return {'values': [{'integerValue': str(value)}], 'before': before}
+
+
+def benchmarks(cfs, rtdb, sizes: List[int], widths: List[int]) -> List[Bench]:
+    from cloud import auth, data, schema
+    from cloud.query import parse_query
+    from cloud.schema import SchemaType
+
+    res = []
+
+    def _consume(gen) -> int:
+        return len(json.loads(''.join(gen)))
+
+    for width in widths:
+        _type = BENCH_TYPE.format(width=width)
+        uri = f'{data.APP_ID}/data/{_type}'
+        raw = [doc.to_dict() for doc in cfs.ref(path=uri).limit(CAST_DOCS).stream()]
+        expiry = sorted(int(d['expiry_date']) for d in raw if d.get('expiry_date'))
+        ordered = parse_query({
+            'orderBy': [{'field': {'fieldPath': 'expiry_date'}, 'direction': 'ASCENDING'}],
+            'startAt': _cursor(expiry[len(expiry) // 4]),
+            'endAt': _cursor(expiry[len(expiry) * 3 // 4])
+        })
+        filtered = parse_query({'where': _program_filter('Routine Immunization')})
+
+        for size in sizes:
+            user = BENCH_USER.format(size=size)
+            params = {'size': size, 'width': width}
+            _ids = data._eligible_docs(cfs, user, _type)
+            step = max(1, len(_ids) // READS_PER_RUN)
+            reads = list(_ids[::step][:READS_PER_RUN])
+
+            def _cold(user=user, _type=_type):
+                data._invalidate_eligible_docs(user, _type)
+
+            def _read(user=user, _type=_type, reads=reads):
+                for _id in reads:
+                    data._get(rtdb, cfs, user, _type, _id)
+                return len(reads)
+
+            def _query(user=user, _type=_type, query_=None):
+                return _consume(data._query(rtdb, cfs, user, _type, query_))
+
+            res.extend([
+                Bench('read', params, _read),
+                Bench('query_unordered', params, _query),
+                Bench('query_unordered_cold', params, _query, setup=_cold),
+                Bench('query_unordered_filtered', params,
+                      lambda _q=_query, f=filtered: _q(query_=f)),
+                Bench('query_ordered_cursors', params,
+                      lambda _q=_query, o=ordered: _q(query_=o)),
+            ])
+
+        def _cast(_type=_type, raw=raw):
+            for doc in raw:
+                schema.strip_banned_from_msg(rtdb, doc, _type, SchemaType.READ)
+            return len(raw)
+
+        res.append(Bench('clean_msg', {'width': width}, _cast))
+
+        user = BENCH_USER.format(size=max(sizes))
+        template = json.loads(data._get(rtdb, cfs, user, _type, raw[0]['uuid']))
+        template = schema.strip_banned_from_msg(rtdb, template, _type, SchemaType.WRITE)
+        template.pop('uuid', None)
+        for count in WRITE_SIZES:
+            def _write(_type=_type, count=count, user=user, template=template):
+                docs = [deepcopy(template) for _ in range(count)]
+                result = data.write_docs(rtdb, cfs, docs, _type, user)
+                if result.status_code != 201:
+                    raise RuntimeError(result.get_data(as_text=True))
+                return count
+
+            res.append(Bench('write_docs', {'docs': count, 'width': width}, _write))
+
+    handler = auth.AuthHandler(rtdb)
+    user = BENCH_USER.format(size=min(sizes))
+    token = handler.create_session(user)[user]['session_key']
+    fresh: List[str] = []
+
+    def _new_sessions():
+        fresh[:] = [
+            handler.create_session(user)[user]['session_key']
+            for _ in range(SESSIONS_PER_RUN)
+        ]
+
+    def _hit():
+        for _ in range(SESSIONS_PER_RUN):
+            assert(handler.verify_session(user, token))
+        return SESSIONS_PER_RUN
+
+    def _miss():
+        # each session is checked once, so none of them is cached yet
+        for _token in fresh:
+            assert(handler.verify_session(user, _token))
+        return len(fresh)
+
+    res.extend([
+        Bench('verify_session_hit', {}, _hit),
+        Bench('verify_session_miss', {}, _miss, setup=_new_sessions, warmup=False),
+    ])
+    return res
+
+
+# # Results
+
+def run(args) -> Dict:
+    sizes = [int(i) for i in args.sizes.split(',')]
+    widths = [int(i) for i in args.widths.split(',')]
+    folder = args.data or fb_memory.MOCK_DATA_PATH
+    with open(f'{folder}/meta/app-info.json') as f:
+        os.environ['LOGIAK_APP_ID'] = json.load(f)['uuid']
+    cfs, rtdb = fb_memory.MemoryFirestore(), fb_memory.MemoryRTDB()
+    seed(cfs, rtdb, folder, sizes, widths)
+    results = {}
+    # writes add docs to the bench types, so they run last
+    benches = benchmarks(cfs, rtdb, sizes, widths)
+    for bench in sorted(benches, key=lambda b: b.name == 'write_docs'):
+        if args.only and not any(o in bench.name for o in args.only.split(',')):
+            continue
+        results[bench.key()] = result = bench.run(args.repeat)
+        print(f'{bench.key():<60} {result["median"] * 1000:>10.2f} ms'
+              f' {result["ops_per_sec"] or 0:>12.0f} ops/s', file=sys.stderr)
+    return {
+        **git_revision(),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'args': vars(args),
+        'results': results
+    }
+
+
+def compare(old: Dict, new: Dict, threshold: float) -> List[str]:
+    # the change in median time of every benchmark in both, slower is positive
+    lines = [
+        f'{(old.get("rev") or "?")[:12]} -> {(new.get("rev") or "?")[:12]}',
+        f'{"benchmark":<60} {"old ms":>10} {"new ms":>10} {"change":>8}'
+    ]
+    for key in sorted(set(old['results']) & set(new['results'])):
+        before, after = old['results'][key]['median'], new['results'][key]['median']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > threshold:
+            flag = ' slower'
+        elif change < -threshold:
+            flag = ' faster'
+        lines.append(
+            f'{key:<60} {before * 1000:>10.2f} {after * 1000:>10.2f} {change:>+8.1%}{flag}')
+    return lines
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the API hot paths')
+    parser.add_argument('--sizes', default='100,1000', help='eligible-set sizes')
+    parser.add_argument('--widths', default='0,50', help='extra fields per document')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--only', help='comma separated benchmark names (substrings)')
+    parser.add_argument('--data', help='mock project folder [mock/lomis]')
+    parser.add_argument('--output', help='results file [benchmark-{rev}.json]')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1, help='change reported as slower / faster')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            print('\n'.join(compare(json.load(a), json.load(b), args.threshold)))
+        return
+    res = run(args)
+    output = args.output or f'benchmark-{(res["rev"] or "unknown")[:12]}.json'
+    with open(output, 'w') as f:
+        json.dump(res, f, indent=2, sort_keys=True)
+    print(f'results written to {output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel, root_validator, validator
+
+from .query import FieldReference, Filter, sort_columns, sort_rank, StructuredQuery
+
+# Aggregation Queries
+'''
+Shaped like the aggregations of a CFS StructuredAggregationQuery (count, sum, avg),
+plus min, max and groupBy. The `where` filter is the same as in a StructuredQuery,
+and runs over the same RBAC pre-filtered documents. Reductions happen here over the
+cast documents; only the columns that are aggregated are kept, never the documents.
+'''
+
+LOG = logging.getLogger('AGG')
+LOG.setLevel(logging.DEBUG)
+
+OPERATORS = ['count', 'sum', 'avg', 'min', 'max']
+
+
+class Aggregation(BaseModel):
+    alias: Optional[str] = None
+    count: Optional[Dict] = None
+    sum: Optional[FieldReference] = None
+    avg: Optional[FieldReference] = None
+    min: Optional[FieldReference] = None
+    max: Optional[FieldReference] = None
+
+    @root_validator(skip_on_failure=True)
+    def single_operator(cls, values):
+        ops = [op for op in OPERATORS if values.get(op) is not None]
+        assert(len(ops) == 1), f'an aggregation needs exactly one of {OPERATORS}'
+        return values
+
+    def operator(self) -> str:
+        return next(op for op in OPERATORS if getattr(self, op) is not None)
+
+    def field(self) -> Optional[str]:
+        if (op := self.operator()) != 'count':
+            return getattr(self, op).fieldPath
+
+    def name(self) -> str:
+        if self.alias:
+            return self.alias
+        if (field := self.field()):
+            return f'{self.operator()}_{field}'
+        return self.operator()
+
+
+class AggregationQuery(BaseModel):
+    where: Optional[Filter] = None
+    groupBy: Optional[List[FieldReference]] = None
+    aggregations: List[Aggregation]
+
+    @validator('aggregations')
+    def unique_names(cls, v, values):
+        assert(v), 'at least one aggregation is required'
+        names = [a.name() for a in v]
+        groups = [f.fieldPath for f in values.get('groupBy') or []]
+        assert(len(set(names)) == len(names)), 'aggregation names must be unique'
+        assert(not set(names) & set(groups)), 'aggregation names clash with groupBy'
+        return v
+
+    def as_query(self) -> StructuredQuery:
+        return StructuredQuery(where=self.where)
+
+    def group_fields(self) -> List[str]:
+        return [f.fieldPath for f in self.groupBy or []]
+
+    def value_fields(self) -> List[str]:
+        return sorted({a.field() for a in self.aggregations if a.field()})
+
+    def is_count(self) -> bool:
+        # answerable without reading any documents
+        return not self.groupBy and all(a.operator() == 'count' for a in self.aggregations)
+
+
+def _group_key(value: Any) -> Tuple:
+    # hashable, and keeps True / 1 / 1.0 / "1" apart
+    if isinstance(value, (list, dict)):
+        return ('json', json.dumps(value, sort_keys=True))
+    return (type(value).__name__, value)
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+
+
+class Reducer(object):
+    # Documents are added a chunk at a time. Each doc contributes a group code and its
+    # value for each aggregated field, the reductions are then a handful of numpy passes
+    # over those columns. sum / avg only count numbers, min / max compare any values in
+    # the order orderBy uses (so strings and dates too), nulls are left out of both.
+
+    def __init__(self, query: AggregationQuery):
+        self.query = query
+        self.group_fields = query.group_fields()
+        self._groups: Dict[Tuple, int] = {}
+        self._keys: List[List[Any]] = []
+        self._codes: List[int] = []
+        self._values: Dict[str, List[Any]] = {f: [] for f in query.value_fields()}
+        if not self.group_fields:
+            # a single group, that exists even if there are no docs
+            self._code([])
+
+    def _code(self, key: List[Any]) -> int:
+        hashed = tuple(_group_key(v) for v in key)
+        if (code := self._groups.get(hashed)) is None:
+            code = self._groups[hashed] = len(self._keys)
+            self._keys.append(key)
+        return code
+
+    def add(self, docs: List[Dict]):
+        for doc in docs:
+            self._codes.append(self._code([doc.get(f) for f in self.group_fields]))
+            for field, values in self._values.items():
+                values.append(doc.get(field))
+
+    def _numbers(self, field: str) -> Tuple[np.ndarray, bool]:
+        # the values as floats (nan if they aren't a number), and if the numbers are ints
+        numbers = [_number(v) for v in self._values[field]]
+        integral = all(isinstance(v, int) for v in numbers if v is not None)
+        column = np.array([np.nan if v is None else v for v in numbers], dtype=np.float64)
+        return column, integral
+
+    def _total(self, op: str, field: str, codes: np.ndarray) -> List:
+        n = len(self._keys)
+        values, integral = self._numbers(field)
+        present = ~np.isnan(values)
+        codes, values = codes[present], values[present]
+        found = np.bincount(codes, minlength=n)
+        res = np.bincount(codes, weights=values, minlength=n)
+        if op == 'avg':
+            return [
+                float(v) if f else None
+                for v, f in zip((res / np.maximum(found, 1)).tolist(), found.tolist())
+            ]
+        return [int(v) if integral else float(v) for v in res.tolist()]
+
+    def _extreme(self, op: str, field: str, codes: np.ndarray) -> List:
+        # sorted by group then value (see query.sort_columns), the first doc of each group
+        # holds its min, or its max with the order reversed
+        values = self._values[field]
+        types, numbers = sort_columns(values)
+        if op == 'max':
+            types, numbers = -types, -numbers
+        present = np.flatnonzero(types != 0)
+        order = present[np.lexsort((numbers[present], types[present], codes[present]))]
+        _, first = np.unique(codes[order], return_index=True)
+        res = [None] * len(self._keys)
+        for x in order[first].tolist():
+            res[codes[x]] = values[x]
+        return res
+
+    def result(self) -> List[Dict]:
+        codes = np.array(self._codes, dtype=np.int64)
+        counts = np.bincount(codes, minlength=len(self._keys))
+        columns = {}
+        for agg in self.query.aggregations:
+            if (op := agg.operator()) == 'count':
+                columns[agg.name()] = counts.tolist()
+            elif op in ('sum', 'avg'):
+                columns[agg.name()] = self._total(op, agg.field(), codes)
+            else:
+                columns[agg.name()] = self._extreme(op, agg.field(), codes)
+        rows = [
+            {
+                **dict(zip(self.group_fields, key)),
+                **{name: column[x] for name, column in columns.items()}
+            }
+            for x, key in enumerate(self._keys)
+        ]
+        return sorted(rows, key=lambda r: [sort_rank(r.get(f)) for f in self.group_fields])
@@ -24,11 +24,12 @@ from time import time as epoch_now
 from typing import Dict
 from uuid import uuid4
 
-from cachetools import cached, TTLCache
+from cachetools import cached
 from cachetools.keys import hashkey
 from flask import Response
 import requests
 
+from . import metrics, timing
 from .fb_utils import RTDB
 from .utils import escape_email, missing_required
 
@@ -36,6 +37,10 @@ from .utils import escape_email, missing_required
 LOG = logging.getLogger('AUTH')
 LOG.setLevel(logging.DEBUG)
 
+# verified (user, session key) pairs, so that most requests don't read the RTDB
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 4096))
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', 60))
+
 
 def require_auth(auth: 'AuthHandler'):
     def handler(fn):
@@ -126,7 +131,12 @@ class AuthHandler(object):
             'session_length': self.session_length
         }
 
-    @cached(cache=TTLCache(maxsize=32, ttl=60), key=ignore_self)
+    @timing.timed('session')
+    @cached(
+        cache=metrics.TTLCache(
+            'verify_session', maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL),
+        key=ignore_self
+    )
     def verify_session(self, user_id: str, token: str) -> bool:
         key = escape_email(user_id)
         user_token_path = f'{self.session_path}/{key}/{token}'
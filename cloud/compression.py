@@ -0,0 +1,166 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+from typing import Iterable, Iterator, Optional
+import zlib
+
+from flask import Response
+from werkzeug.http import parse_etags
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+# Content-Encoding
+'''
+Responses are compressed according to the request's Accept-Encoding. Streamed
+responses are compressed incrementally: every part the generator yields is
+flushed through the compressor (a sync flush), so the client can start reading
+before the query is finished and nothing is buffered in full.
+'''
+
+LOG = logging.getLogger('ENC')
+LOG.setLevel(logging.DEBUG)
+
+IDENTITY = 'identity'
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# bodies smaller than this are not worth the cpu (or the header)
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+# levels used while streaming, the static (cached) variants use the maximum
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+
+# in order of preference when the client has none
+ENCODINGS = [BROTLI, GZIP] if brotli else [GZIP]
+
+
+def negotiate_encoding(accept_encoding: str = None) -> str:
+    # picks an available content encoding from an Accept-Encoding header
+    if not accept_encoding:
+        return IDENTITY
+    options = []
+    for part in accept_encoding.split(','):
+        coding, *params = [i.strip() for i in part.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        coding = coding.lower()
+        if coding == '*':
+            options.extend([(q, e) for e in ENCODINGS])
+        elif coding in ENCODINGS:
+            options.append((q, coding))
+    options = [(q, e) for q, e in options if q > 0]
+    if not options:
+        return IDENTITY
+    # highest q, then our own preference
+    options.sort(key=lambda o: (-o[0], ENCODINGS.index(o[1])))
+    return options[0][1]
+
+
+class _Gzip(object):
+
+    def __init__(self, level: int):
+        # wbits=31 -> gzip header and trailer
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+def compressor(encoding: str, static: bool = False):
+    if encoding == GZIP:
+        return _Gzip(9 if static else GZIP_LEVEL)
+    elif encoding == BROTLI and brotli:
+        return brotli.Compressor(quality=11 if static else BROTLI_QUALITY)
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+
+def compress(body: bytes, encoding: str, static: bool = False) -> bytes:
+    if encoding == IDENTITY:
+        return body
+    _c = compressor(encoding, static)
+    return _c.process(body) + _c.finish()
+
+
+def compress_stream(parts: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    _c = compressor(encoding)
+    for part in parts:
+        if not part:
+            continue
+        if (res := _c.process(part) + _c.flush()):
+            yield res
+    yield _c.finish()
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    # an encoded body is a different representation, so it gets its own (strong) tag
+    return etag if encoding == IDENTITY else f'{etag}-{encoding}'
+
+
+def not_modified(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, any encoding of the entity will do
+    if not if_none_match or not etag:
+        return False
+    etags = parse_etags(if_none_match)
+    return any(
+        etags.contains_weak(encoded_etag(etag, e))
+        for e in [IDENTITY, *ENCODINGS]
+    )
+
+
+def not_modified_response(etag: str) -> Response:
+    res = Response(status=304)
+    res.set_etag(etag)
+    return res
+
+
+def compress_response(res: Response, accept_encoding: str = None) -> Response:
+    # compresses a response in place, if the client accepts it and it's worth it
+    if res.status_code != 200 or 'Content-Encoding' in res.headers:
+        return res
+    encoding: Optional[str] = negotiate_encoding(accept_encoding)
+    res.vary.add('Accept-Encoding')
+    if encoding == IDENTITY:
+        return res
+    if res.is_streamed:
+        res.response = compress_stream(res.iter_encoded(), encoding)
+        res.headers.pop('Content-Length', None)
+    else:
+        body = res.get_data()
+        if len(body) < MIN_SIZE:
+            return res
+        res.set_data(compress(body, encoding))
+    res.headers['Content-Encoding'] = encoding
+    if (etag := res.get_etag()[0]):
+        res.set_etag(encoded_etag(etag, encoding))
+    return res
@@ -22,10 +22,30 @@
 
 # from flask import jsonify, make_response, Response
 
+from bisect import bisect_left, bisect_right
+from contextlib import closing
+from hashlib import sha1
+from itertools import chain, islice
 import json
 import logging
 import os
-from typing import (Any, Dict, Generator, Iterator, List, Union)
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union
+)
 from uuid import uuid4
 
 from flask import Response
@@ -34,9 +54,12 @@ import spavro.io
 
 from aether.python.avro import tools as avro_tools
 
-from . import fb_utils
-from .query import StructuredQuery
-from .meta import meta_schema_object, _meta_info, _meta_schema
+from . import compression, fb_utils, metrics, planner, timing
+from .aggregation import AggregationQuery, Reducer
+from .formats import Format, JSONFormat, negotiate, SchemaMismatch
+from .planner import Plan
+from .query import parse_query, StructuredQuery
+from .meta import meta_read_fields, meta_schema_object, _meta_info, _meta_schema
 from .schema import strip_banned_from_msg as clean_msg
 from .schema import (
     cast_values_to_string,
@@ -45,7 +68,15 @@ from .schema import (
     schema_flag_extras,
     SchemaType
 )
-from .utils import chunk, escape_email, path_stripper
+from .utils import (
+    batched,
+    escape_email,
+    fan_out,
+    path_stripper,
+    prefetch,
+    read_token,
+    sign_token
+)
 
 from google.cloud import firestore_v1
 from google.api_core.exceptions import AlreadyExists, FailedPrecondition
@@ -61,6 +92,60 @@ APP_ALIAS = None
 # root path for testing (usually APP_ID)
 ROOT_PATH = os.environ.get('ROOT_PATH')
 
+# max number of concurrent chunk queries per request
+QUERY_WORKERS = int(os.environ.get('QUERY_WORKERS', 8))
+# slot listing is paged, and pages are fetched ahead of the data queries
+SLOT_PAGE_SIZE = int(os.environ.get('SLOT_PAGE_SIZE', 300))
+SLOT_PREFETCH_PAGES = int(os.environ.get('SLOT_PREFETCH_PAGES', 4))
+# documents per multi-get RPC for queries without a `where` clause
+GET_ALL_BATCH_SIZE = int(os.environ.get('GET_ALL_BATCH_SIZE', 300))
+# max number of ids in a single bulk read
+BULK_READ_MAX = int(os.environ.get('BULK_READ_MAX', 500))
+# fields every masked fetch includes: identity, and what the cast and ETags depend on
+MASK_ALWAYS = ['uuid', 'modified', 'version_modified']
+# CFS limit on the number of values in an "in" filter
+IN_QUERY_SIZE = 10
+# docs per write when streaming an ordered result
+STREAM_BATCH_SIZE = 100
+# paged queries
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+# tokens are signed so they can't be tampered with, without a shared secret they are
+# only valid on the instance that issued them
+PAGE_TOKEN_SECRET = os.environ.get('PAGE_TOKEN_SECRET', '').encode('utf-8') or os.urandom(32)
+
+PAGE_TOKEN_HEADER = 'Logiak-Page-Token'
+
+# The slot listing is the most repeated read we do, so each user's eligible ids of a
+# type are kept in memory for a short while. The cache is sized in number of ids.
+ELIGIBILITY_CACHE = metrics.TTLCache(
+    'eligibility',
+    maxsize=int(os.environ.get('ELIGIBILITY_CACHE_SIZE', 1_000_000)),
+    ttl=int(os.environ.get('ELIGIBILITY_CACHE_TTL', 60)),
+    getsizeof=len
+)
+_ELIGIBILITY_LOCK = Lock()
+
+# outcome of the index probe per filter shape, '' if valid or the error message if not
+QUERY_SHAPE_CACHE = metrics.TTLCache(
+    'query_shape',
+    maxsize=int(os.environ.get('QUERY_SHAPE_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('QUERY_SHAPE_CACHE_TTL', 600))
+)
+_SHAPE_LOCK = Lock()
+
+# number of docs per type, only used to plan queries so it can be a bit stale
+COLLECTION_COUNT_CACHE = metrics.TTLCache(
+    'collection_count',
+    maxsize=int(os.environ.get('COLLECTION_COUNT_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('COLLECTION_COUNT_CACHE_TTL', 3600))
+)
+_COLLECTION_LOCK = Lock()
+
+# eligible ids listed before planning a query, the rest of the listing is only waited
+# for if the plan needs all of them
+PLAN_PEEK_IDS = int(os.environ.get('PLAN_PEEK_IDS', 1000))
+
 _STRIP = path_stripper([ROOT_PATH, 'data']) \
     if ROOT_PATH \
     else path_stripper(['data', ''])
@@ -71,26 +156,92 @@ def resolve(
     path: List,
     cfs: fb_utils.Firestore,
     rtdb: fb_utils.RTDB,
-    data: Any = None
+    data: Any = None,
+    headers: Mapping = None,
+    args: Mapping = None
 ) -> Response:
     path = _STRIP(path)
+    headers = headers or {}
+    args = args or {}
     try:
         _type = path[0]
-        if path[1] == 'read':
+        if path[1] in ('read', 'query', 'aggregate'):
+            fmt = negotiate(headers.get('Accept'))
+            if not fmt or not (fmt := _format(rtdb, _type, fmt)):
+                return Response(
+                    f'Not Acceptable: {headers.get("Accept")}', 406, mimetype='text/plain')
+        if path[1] == 'read' and len(path) == 2:
+            try:
+                _ids = _bulk_read_ids(data)
+            except ValueError as err:
+                return Response(f'Invalid Request: {err}', 400, mimetype='text/plain')
+            if fmt.needs_schema:
+                # missing documents can't be written to a schema'd container
+                return Response(
+                    f'Not Acceptable: {fmt.mimetype}', 406, mimetype='text/plain')
+            fields = _fields_arg(args)
+            return _response(_bulk_read(rtdb, cfs, user_id, _type, _ids, fmt, fields), fmt)
+        elif path[1] == 'read':
             _id = path[2]
-            if doc := _get(rtdb, cfs, user_id, _type, _id):
-                return Response(doc, 200, mimetype='application/json')
+            fields = _fields_arg(args)
+            if (raw := _fetch_doc(rtdb, cfs, user_id, _type, _id, fields)) is not None:
+                etag = _doc_etag(_type, raw, fmt, fields)
+                if compression.not_modified(headers.get('If-None-Match'), etag):
+                    # no need to cast or serialize it
+                    res = compression.not_modified_response(etag)
+                    res.vary.add('Accept')
+                    return res
+                doc = _caster(rtdb, _type, fields)(raw)
+                res = _response(fmt.one(doc), fmt)
+                if etag:
+                    res.set_etag(etag)
+                return res
         elif path[1] == 'query':
             try:
+                if data and not isinstance(data, dict):
+                    raise ValueError('expected a StructuredQuery object')
+                data = dict(data or {})
+                page_size = data.pop('pageSize', None)
+                page_token = data.pop('pageToken', None)
+                explain = data.pop('explain', False)
                 if data:
                     # validate outside of the generator
-                    data = StructuredQuery(**data)
-                    _validate_query(cfs, _type, data)
-                    _response_generator = _query(rtdb, cfs, user_id, _type, data)
+                    data = parse_query(data)
                 else:
-                    _response_generator = _query(rtdb, cfs, user_id, _type, None)
-                return Response(_response_generator, 200, mimetype='application/json')
-            except (PydanticValidationError, FailedPrecondition) as pvr:
+                    data = None
+                if explain:
+                    # unordered pages are read in id order, see _query_page
+                    paged = bool(page_size or page_token)
+                    intersect = not paged or bool(data and data.is_ordered())
+                    plan, _, _ = _plan(cfs, user_id, _type, data, intersect=intersect)
+                    return _explain(plan)
+                if page_size or page_token:
+                    docs, next_token = _query_page(
+                        rtdb, cfs, user_id, _type, data, page_size, page_token)
+                    res = _response(fmt.many(docs), fmt)
+                    if next_token:
+                        res.headers[PAGE_TOKEN_HEADER] = next_token
+                    return res
+                _response_generator = _query(rtdb, cfs, user_id, _type, data, fmt)
+                return _response(_response_generator, fmt)
+            except (PydanticValidationError, FailedPrecondition, ValueError) as pvr:
+                return Response(f'Invalid Query: {pvr}', 400, mimetype='text/plain')
+        elif path[1] == 'aggregate':
+            try:
+                if not isinstance(data, dict):
+                    raise ValueError('expected an AggregationQuery object')
+                data = dict(data)
+                explain = data.pop('explain', False)
+                data = AggregationQuery(**data)
+                if explain:
+                    count = data.is_count()
+                    plan, _, _ = _plan(cfs, user_id, _type, data.as_query(), count=count)
+                    return _explain(plan)
+                if fmt.needs_schema:
+                    return Response(
+                        f'Not Acceptable: {fmt.mimetype}', 406, mimetype='text/plain')
+                return _response(fmt.many(_aggregate(rtdb, cfs, user_id, _type, data)), fmt)
+            except (PydanticValidationError, FailedPrecondition, ValueError) as pvr:
                 return Response(f'Invalid Query: {pvr}', 400, mimetype='text/plain')
         elif path[1] == 'create':
             try:
@@ -107,25 +258,131 @@ def resolve(
                 return Response(str(err), 400)
     except IndexError:
         pass
+    except SchemaMismatch as err:
+        # only for responses that aren't streamed, those are cut short instead
+        return Response(f'Not Acceptable: {err}', 406, mimetype='text/plain')
     return Response(f'Not Found @ {path}', 404)
 
+
+def _response(body, fmt: Format) -> Response:
+    res = Response(body, 200, mimetype=fmt.mimetype)
+    res.headers['Vary'] = 'Accept'
+    return res
+
+
+def _explain(plan: Plan) -> Response:
+    return Response(json.dumps(plan.dict(), sort_keys=True), 200, mimetype='application/json')
+
 # read
 
 
 def _is_eligible(cfs: fb_utils.Firestore, user_id: str, _type: str, _id) -> bool:
+    if (_ids := _cached_eligible_docs(user_id, _type)) is not None:
+        return _contains(_ids, _id)
     escaped_id = escape_email(user_id)
     uri = f'{APP_ID}/slots/{escaped_id}/data/{_type}/{_id}'
-    return cfs.ref(full_path=uri).get().exists
+    return cfs.read(doc_path=uri).exists
+
+
+def _eligible_among(
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    _ids: List[str]
+) -> Set[str]:
+    # the subset of _ids the user may read, checked in one pass
+    if (eligible := _cached_eligible_docs(user_id, _type)) is not None:
+        return {_id for _id in _ids if _contains(eligible, _id)}
+    escaped_id = escape_email(user_id)
+    uri = f'{APP_ID}/slots/{escaped_id}/data/{_type}'
+    # an empty mask, we only need to know the slots exist
+    res = cfs.get_all([f'{uri}/{_id}' for _id in _ids], field_paths=[])
+    return {doc.id for doc in res if doc.exists}
+
+
+def _contains(sorted_ids: Sequence[str], _id: str) -> bool:
+    x = bisect_left(sorted_ids, _id)
+    return x < len(sorted_ids) and sorted_ids[x] == _id
 
 
-def _eligible_docs(cfs: fb_utils.Firestore, user_id: str, _type: str):
+@timing.timed('eligible')
+def _eligible_docs(cfs: fb_utils.Firestore, user_id: str, _type: str) -> Tuple[str]:
+    # sorted ids of all docs of _type the user has a slot for
+    if (res := _cached_eligible_docs(user_id, _type)) is not None:
+        return res
     escaped_id = escape_email(user_id)
     uri = f'{APP_ID}/slots/{escaped_id}/data/{_type}'
-    res = cfs.list(path=uri)
-    LOG.debug(f'{user_id} is _is_eligible for {len(res)} of type {_type}')
+    res = tuple(sorted(cfs.list(path=uri)))
+    _cache_eligible_docs(user_id, _type, res)
     return res
 
 
+def _eligible_stream(cfs: fb_utils.Firestore, user_id: str, _type: str) -> Iterator[str]:
+    # Same ids as _eligible_docs, in no particular order. If they are not cached yet, they
+    # are yielded as the slot listing pages in on a background thread, so that the first
+    # data queries run while the rest of the slots are still being listed.
+    if (res := _cached_eligible_docs(user_id, _type)) is not None:
+        yield from res
+        return
+    escaped_id = escape_email(user_id)
+    uri = f'{APP_ID}/slots/{escaped_id}/data/{_type}'
+    listed = []
+    pages = cfs.list_pages(path=uri, page_size=SLOT_PAGE_SIZE)
+    with closing(prefetch(pages, SLOT_PREFETCH_PAGES)) as pages:
+        for page in timing.timed_iter('eligible', pages):
+            listed.extend(page)
+            yield from page
+    _cache_eligible_docs(user_id, _type, tuple(sorted(listed)))
+
+
+def _cache_eligible_docs(user_id: str, _type: str, _ids: Tuple[str]):
+    LOG.debug(f'{user_id} is _is_eligible for {len(_ids)} of type {_type}')
+    with _ELIGIBILITY_LOCK:
+        try:
+            ELIGIBILITY_CACHE[(user_id, _type)] = _ids
+        except ValueError:
+            pass  # larger than the whole cache, don't keep it
+
+
+def _cached_eligible_docs(user_id: str, _type: str) -> Optional[Tuple[str]]:
+    with _ELIGIBILITY_LOCK:
+        return ELIGIBILITY_CACHE.get((user_id, _type))
+
+
+def _invalidate_eligible_docs(user_id: str, _type: str):
+    with _ELIGIBILITY_LOCK:
+        ELIGIBILITY_CACHE.pop((user_id, _type), None)
+
+
+def _fields_arg(args: Mapping) -> Optional[List[str]]:
+    # ?fields=a,b,c
+    if (fields := [f.strip() for f in args.get('fields', '').split(',') if f.strip()]):
+        return fields
+
+
+def _caster(
+    rtdb: fb_utils.RTDB,
+    _type: str,
+    fields: Optional[Iterable[str]] = None
+) -> Callable[[Dict], Dict]:
+    # clean_msg, limited to the given fields (None is all of them). Casting is the most
+    # expensive step of a read, so the other fields are dropped before it. The cast also
+    # needs version_modified, to pick the schema.
+    if fields is None:
+        return timing.timed('cast')(lambda doc: clean_msg(rtdb, doc, _type, SchemaType.READ))
+    fields = list(fields)
+    keep = set(fields) | {'version_modified'}
+    drop_version = 'version_modified' not in fields
+
+    def _cast(doc: Dict) -> Dict:
+        res = clean_msg(rtdb, {k: doc[k] for k in keep if k in doc}, _type, SchemaType.READ)
+        if drop_version:
+            res.pop('version_modified', None)
+        return res
+
+    return timing.timed('cast')(_cast)
+
+
 def _get(
     rtdb: fb_utils.RTDB,
     cfs: fb_utils.Firestore,
@@ -133,43 +390,351 @@ def _get(
     _type: str,
     _id: str
 ):
+    if (doc := _read(rtdb, cfs, user_id, _type, _id)) is not None:
+        return json.dumps(doc, sort_keys=True)
+
+
+def _read(
+    rtdb: fb_utils.RTDB,
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    _id: str,
+    fields: List[str] = None
+) -> Optional[Dict]:
+    if (raw := _fetch_doc(rtdb, cfs, user_id, _type, _id, fields)) is not None:
+        return _caster(rtdb, _type, fields)(raw)
+
+
+def _fetch_doc(
+    rtdb: fb_utils.RTDB,
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    _id: str,
+    fields: List[str] = None
+) -> Optional[Dict]:
+    # the stored (uncast) document
     if not _is_eligible(cfs, user_id, _type, _id):
         return
     uri = f'{APP_ID}/data/{_type}/{_id}'
-    _doc = cfs.ref(full_path=uri).get()
-    if _doc:
-        return json.dumps(
-            clean_msg(rtdb, _doc.to_dict(), _type, SchemaType.READ),
-            sort_keys=True
+    mask = _field_mask(rtdb, _type, fields)
+    with timing.span('fetch'):
+        _doc = cfs.read(doc_path=uri, field_paths=mask)
+    if _doc.exists:
+        return _doc.to_dict()
+
+
+def _field_mask(
+    rtdb: fb_utils.RTDB,
+    _type: str,
+    fields: Optional[Iterable[str]] = None
+) -> Optional[List[str]]:
+    # The field paths to ask Firestore for: the given fields, or if None all that the
+    # READ schema exposes, so that banned fields never leave Firestore. Reading always
+    # needs the fields in MASK_ALWAYS. None (no schema) means the whole document.
+    if fields is None and (fields := meta_read_fields(rtdb, _type)) is None:
+        return None
+    return fb_utils.field_paths(sorted({*fields, *MASK_ALWAYS}))
+
+
+def _bulk_read_ids(data: Any) -> List[str]:
+    if not isinstance(data, dict) or not isinstance(data.get('ids'), list):
+        raise ValueError('expected {"ids": [...]}')
+    _ids = data['ids']
+    if not all(isinstance(_id, str) and _id for _id in _ids):
+        raise ValueError('ids must be non empty strings')
+    if len(_ids) > BULK_READ_MAX:
+        raise ValueError(f'at most {BULK_READ_MAX} ids can be read at once')
+    return _ids
+
+
+def _bulk_read(
+    rtdb: fb_utils.RTDB,
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    _ids: List[str],
+    fmt: Format,
+    fields: List[str] = None
+) -> Generator:
+    # Documents in the order they were asked for, None (null) for any id that does not
+    # exist or that the user may not read. Each batch costs one multi-get for the slots
+    # (unless they're cached) and one for the documents that survive.
+    uri = f'{APP_ID}/data/{_type}'
+    _cast = _caster(rtdb, _type, fields)
+    mask = _field_mask(rtdb, _type, fields)
+
+    @timing.timed('fetch')
+    def _fetch(_from: List[str]) -> List[Optional[Dict]]:
+        unique = list(dict.fromkeys(_from))
+        found = {}
+        if (eligible := _eligible_among(cfs, user_id, _type, unique)):
+            res = cfs.get_all([f'{uri}/{_id}' for _id in unique if _id in eligible], mask)
+            found = {doc.id: doc.to_dict() for doc in res if doc.exists}
+        return [found.get(_id) for _id in _from]
+
+    _chunks = batched(_ids, GET_ALL_BATCH_SIZE)
+    with closing(fan_out(_fetch, _chunks, QUERY_WORKERS, ordered=True)) as results:
+        yield from fmt.stream(
+            [_cast(doc) if doc is not None else None for doc in res]
+            for res in results
         )
 
 
+def _doc_etag(
+    _type: str,
+    raw: Dict,
+    fmt: Format,
+    fields: List[str] = None
+) -> Optional[str]:
+    # every write sets modified, and the cast depends on the version it was written with
+    if (modified := raw.get('modified')) is None:
+        return
+    key = '/'.join([
+        _type,
+        str(raw.get('uuid')),
+        str(modified),
+        str(raw.get('version_modified')),
+        fmt.mimetype,
+        ','.join(fields or [])
+    ])
+    return sha1(key.encode('utf-8')).hexdigest()
+
+
+def _format(rtdb: fb_utils.RTDB, _type: str, fmt: Type[Format]) -> Optional[Format]:
+    # None if the format needs a schema, but there isn't one for the type
+    if not fmt.needs_schema:
+        return fmt()
+    version = _meta_info(rtdb).get('defaultVersion')
+    if not _meta_schema(rtdb, version, _type, SchemaType.READ):
+        return None
+    return fmt(meta_schema_object(rtdb, version, _type, SchemaType.READ))
+
+
+@timing.timed('validate')
 def _validate_query(
     cfs: fb_utils.Firestore,
     _type: str,
-    structured_query: StructuredQuery = None
+    structured_query: StructuredQuery = None,
+    scoped: bool = True
 ) -> bool:  # or raises FailedPrecondition from Firebase on query with missing index
-    uri = f'{APP_ID}/data/{_type}'
-    query_ = cfs.ref(path=uri).where(u'uuid', u'in', ['__fake_ids'])
-    list(structured_query.filter(query_).limit(1).stream())
+    # Whether there is an index only depends on the shape of the filter, so each shape
+    # is probed once and the outcome remembered (for a while, indexes come and go).
+    # Scoped is the filter next to `uuid in`, otherwise the filter on its own.
+    if not structured_query or not structured_query.is_filtered():
+        return True  # `uuid in` on its own never needs an index
+    key = (_type, scoped, structured_query.filter_shape())
+    with _SHAPE_LOCK:
+        known = QUERY_SHAPE_CACHE.get(key)
+    if known is None:
+        try:
+            _probe_query(cfs, _type, structured_query, scoped)
+            known = ''
+        except FailedPrecondition as err:
+            known = err.message
+        with _SHAPE_LOCK:
+            QUERY_SHAPE_CACHE[key] = known
+    if known:
+        raise FailedPrecondition(known)
     return True
 
 
+def _has_index(
+    cfs: fb_utils.Firestore,
+    _type: str,
+    structured_query: StructuredQuery = None,
+    scoped: bool = True
+) -> bool:
+    try:
+        return _validate_query(cfs, _type, structured_query, scoped)
+    except FailedPrecondition:
+        return False
+
+
+def _probe_query(
+    cfs: fb_utils.Firestore,
+    _type: str,
+    structured_query: StructuredQuery,
+    scoped: bool = True
+):
+    uri = f'{APP_ID}/data/{_type}'
+    query_ = cfs.ref(path=uri)
+    if scoped:
+        query_ = query_.where(u'uuid', u'in', ['__fake_ids'])
+    list(cfs.stream(structured_query.filter(query_).limit(1)))
+
+
+def _collection_count(cfs: fb_utils.Firestore, _type: str) -> int:
+    with _COLLECTION_LOCK:
+        if (res := COLLECTION_COUNT_CACHE.get(_type)) is not None:
+            return res
+    # billed one read per 1000 docs, hence the long TTL
+    res = cfs.count(cfs.ref(path=f'{APP_ID}/data/{_type}'))
+    with _COLLECTION_LOCK:
+        COLLECTION_COUNT_CACHE[_type] = res
+    return res
+
+
+def _plan(
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    structured_query: StructuredQuery = None,
+    count: bool = False,
+    _ids: Sequence[str] = None,
+    intersect: bool = True
+) -> Tuple[Plan, Optional[StructuredQuery], Iterable[str]]:
+    # Picks how to read the docs (see planner), returns the plan, the query to run (as
+    # the plan filters it) and the eligible ids. Those are still being listed if there
+    # were more than PLAN_PEEK_IDS, unless the plan needs all of them in memory.
+    exact = True
+    if _ids is None and (_ids := _cached_eligible_docs(user_id, _type)) is None:
+        stream = _eligible_stream(cfs, user_id, _type)
+        _ids = list(islice(stream, PLAN_PEEK_IDS))
+        if len(_ids) < PLAN_PEEK_IDS:
+            _ids = tuple(sorted(_ids))
+        else:
+            _ids, exact = chain(_ids, stream), False
+    eligible = len(_ids) if exact else PLAN_PEEK_IDS
+    has_index = _has_index(cfs, _type, structured_query)
+    collection = _collection_count(cfs, _type) if intersect and eligible else None
+    options = planner.candidates(structured_query, has_index, count, collection, intersect)
+
+    def _choose() -> Plan:
+        return planner.plan(
+            structured_query, eligible, exact, collection, options,
+            IN_QUERY_SIZE, GET_ALL_BATCH_SIZE, QUERY_WORKERS)
+
+    plan = _choose()
+    if plan.strategy == planner.INTERSECT and not plan.filtered_locally \
+            and not _has_index(cfs, _type, structured_query, scoped=False):
+        options.remove((planner.INTERSECT, False))
+        plan = _choose()
+    if plan.strategy == planner.INTERSECT and not exact:
+        # the other plans only get more expensive with more ids, so it stays the best
+        _ids = tuple(sorted(_ids))
+        eligible, exact = len(_ids), True
+        plan = _choose()
+    if plan.filtered_locally:
+        structured_query = structured_query.filtered_locally()
+    LOG.debug(f'{plan.strategy} plan for {_type}, ~{plan.reads} reads')
+    return plan, structured_query, _ids
+
+
 def _query(
     rtdb: fb_utils.RTDB,
     cfs: fb_utils.Firestore,
     user_id: str,
     _type: str,
-    structured_query: StructuredQuery = None
+    structured_query: StructuredQuery = None,
+    fmt: Format = None
 ) -> Generator:
-    # raises validation errors
-    _ids = chunk(_eligible_docs(cfs, user_id, _type), 10)
+    # raises validation errors. Planned right away, only the reads are streamed.
+    # An offset without an order only skips the same docs every time if they are always
+    # read in the same order, which is by (sorted) id, see unordered_query.
+    _ids = None
+    if structured_query and structured_query.offset and not structured_query.is_ordered():
+        _ids = _eligible_docs(cfs, user_id, _type)
+    plan, structured_query, _ids = _plan(cfs, user_id, _type, structured_query, _ids=_ids)
     uri = f'{APP_ID}/data/{_type}'
     # if the query is not ordered then we can stream it directly
     if not structured_query or not structured_query.is_ordered():
-        yield from unordered_query(_type, rtdb, cfs, uri, structured_query, _ids)
+        return unordered_query(_type, rtdb, cfs, uri, structured_query, _ids, fmt, plan)
+    return ordered_query(_type, rtdb, cfs, uri, structured_query, _ids, fmt, plan)
+
+
+def _fetch_plan(
+    cfs: fb_utils.Firestore,
+    uri: str,
+    structured_query: StructuredQuery,
+    _ids: Iterable[str],
+    mask: List[str] = None,
+    plan: Plan = None
+) -> Tuple[Callable[[List], List[Dict]], Iterator[List]]:
+    # The fetch function and the chunks to run it on, for the planned strategy.
+    # Without a plan: without a filter we don't need a query at all, the eligible ids
+    # are the result, so we fetch them directly in large batches instead of 10 at a time.
+    filtered = bool(structured_query) and structured_query.is_filtered()
+    keep = None
+    if filtered and structured_query.is_filtered_locally():
+        # the filter can't (or shouldn't) run in CFS, it's applied to the fetched docs
+        if mask is not None:
+            mask = sorted({*mask, *fb_utils.field_paths(structured_query.filter_fields())})
+        keep = structured_query.matches
+    if plan:
+        strategy = plan.strategy
     else:
-        yield from ordered_query(_type, rtdb, cfs, uri, structured_query, _ids)
+        strategy = planner.IN_CHUNKS if filtered and not keep else planner.MULTI_GET
+    if strategy == planner.INTERSECT:
+        # the chunks are already the docs, CFS is read while they are iterated
+        chunks = _intersect(cfs, uri, structured_query, _ids, mask, keep)
+        return (lambda docs: docs), chunks
+    if strategy == planner.MULTI_GET:
+        return _batch_fetcher(cfs, uri, mask, keep), batched(_ids, GET_ALL_BATCH_SIZE)
+    return _chunk_fetcher(cfs, uri, structured_query, mask), batched(_ids, IN_QUERY_SIZE)
+
+
+def _intersect(
+    cfs: fb_utils.Firestore,
+    uri: str,
+    structured_query: StructuredQuery,
+    eligible: Sequence[str],
+    mask: List[str] = None,
+    keep: Callable[[Dict], bool] = None
+) -> Iterator[List[Dict]]:
+    # a single query with only the filter, of which the eligible docs are kept
+    query_ = cfs.ref(path=uri)
+    if structured_query:
+        query_ = structured_query.filter(query_)
+    if mask is not None:
+        query_ = query_.select(mask)
+    docs = (doc.to_dict() for doc in cfs.stream(query_) if _contains(eligible, doc.id))
+    chunks = batched(filter(keep, docs) if keep else docs, GET_ALL_BATCH_SIZE)
+    return timing.timed_iter('fetch', chunks)
+
+
+def _batch_fetcher(
+    cfs: fb_utils.Firestore,
+    uri: str,
+    mask: List[str] = None,
+    keep: Callable[[Dict], bool] = None
+) -> Callable[[List[str]], List[Dict]]:
+
+    @timing.timed('fetch')
+    def _fetch(_from: List[str]) -> List[Dict]:
+        res = cfs.get_all([f'{uri}/{_id}' for _id in _from], mask)
+        docs = [doc.to_dict() for doc in res if doc.exists]
+        return [doc for doc in docs if keep(doc)] if keep else docs
+
+    return _fetch
+
+
+def _chunk_fetcher(
+    cfs: fb_utils.Firestore,
+    uri: str,
+    structured_query: StructuredQuery,
+    mask: List[str] = None
+) -> Callable[[List[str]], List[Dict]]:
+    # builds the function that runs a single `uuid in [...]` chunk query.
+    # It only does Firestore IO so it is safe to run from the fan_out pool,
+    # casting stays on the calling thread where the schema caches live.
+
+    @timing.timed('fetch')
+    def _fetch(_from: List[str]) -> List[Dict]:
+        ref = cfs.ref(path=uri)
+        query_ = ref.where(u'uuid', u'in', _from)
+        if structured_query:
+            query_ = structured_query.filter(query_)
+        if mask is not None:
+            query_ = query_.select(mask)
+        return [doc.to_dict() for doc in cfs.stream(query_)]
+
+    return _fetch
+
+
+def _by_id(doc: Dict) -> str:
+    return doc.get('uuid') or ''
 
 
 def unordered_query(
@@ -178,84 +743,196 @@ def unordered_query(
     cfs: fb_utils.Firestore,
     uri: str,
     structured_query: StructuredQuery,
-    _ids: Iterator[str]
+    _ids: Iterable[str],
+    fmt: Format = None,
+    plan: Plan = None
 ):
     # in case of a whole lot of records, we can build a generator to stream them directly.
     # This should be the fastest way to do so, but only worked for unordered queries
     # because of the way that we implement Logiak's  RBAC, by pulling all the valid IDs,
     # and the CFS limitation that an "in" query can only have 10 values.
-    # Yielding chunks of json is however quite tricky to implement as the number is unknown
-    # 0 >= n_docs <= Infinity?
-
-    yield '['
-    # we have to hold off on adding the last element to make the json format properly
-    last = None
-    # we also have to keep track of whether we only have on record total so we don't break
-    # formatting when we add the last one at the end.
-    only = True
-    for _from in _ids:
-        ref = cfs.ref(path=uri)
-        query_ = ref.where(u'uuid', u'in', _from)
+    # The chunk queries are independent, so we run up to QUERY_WORKERS of them at once
+    # and write out each chunk as soon as it comes back.
+    # With a limit, we stop issuing chunk queries once we have enough docs.
+    # With an offset, the chunks are taken in order and each is sorted by id, so that
+    # the docs it skips don't depend on which query came back first.
+    selected = structured_query.selected_fields() if structured_query else None
+    mask = _field_mask(rtdb, type_, selected)
+    _fetch, _chunks = _fetch_plan(cfs, uri, structured_query, _ids, mask, plan)
+    _cast = _caster(rtdb, type_, selected)
+    fmt = fmt or JSONFormat()
+    stable = bool(structured_query and structured_query.offset)
+    with closing(fan_out(_fetch, _chunks, QUERY_WORKERS, ordered=stable)) as results:
+        if stable:
+            results = (sorted(res, key=_by_id) for res in results)
         if structured_query:
-            query_ = structured_query.filter(query_)
-        res = list(query_.stream())
-        if not res:
-            continue
-        elif res and last is not None:
-            res.insert(0, last)
-        last = res[-1]
-        res = res[:-1]
-        if res:
-            if not only:
-                yield ','
-            only = False
-            yield ','.join(
-                [json.dumps(
-                    clean_msg(rtdb, doc.to_dict(), type_, SchemaType.READ),
-                    sort_keys=True
-                ) for doc in res[:len(res)]]
-            )
-
-    if last:
-        if not only:
-            yield ','
-        yield json.dumps(
-            clean_msg(rtdb, last.to_dict(), type_, SchemaType.READ),
-            sort_keys=True
-        )
-    yield ']'
+            results = structured_query.window(results)
+        yield from fmt.stream([_cast(doc) for doc in res] for res in results)
 
 
-def all_matching_docs(
+def ordered_query(
     type_: str,
     rtdb: fb_utils.RTDB,
     cfs: fb_utils.Firestore,
     uri: str,
     structured_query: StructuredQuery,
-    _ids: Iterator[str]
+    _ids: Iterable[str],
+    fmt: Format = None,
+    plan: Plan = None
 ):
-    for _from in _ids:
-        ref = cfs.ref(path=uri)
-        query_ = ref.where(u'uuid', u'in', _from)
-        if structured_query:
-            query_ = structured_query.filter(query_).stream()
+    # Logiak stores everything as a string, so CFS can't order the chunks for us.
+    # Every chunk is cast as it arrives, then all of them are sorted in a single pass
+    # and written out in batches instead of as one big list at the end.
+    # A limited query only keeps the top offset + limit docs while the chunks arrive.
+    # With a select, the sort fields are cast as well and only dropped on the way out.
+    needed = structured_query.needed_fields()
+    mask = _field_mask(rtdb, type_, needed)
+    _fetch, _chunks = _fetch_plan(cfs, uri, structured_query, _ids, mask, plan)
+    _cast = _caster(rtdb, type_, needed)
+    fmt = fmt or JSONFormat()
+    with closing(fan_out(_fetch, _chunks, QUERY_WORKERS)) as results:
+        streams = ([_cast(doc) for doc in res] for res in results)
+        if structured_query.limit is not None:
+            docs = structured_query.top(streams)
         else:
-            query_ = query_.stream()
-        for doc in query_:
-            yield clean_msg(rtdb, doc.to_dict(), type_, SchemaType.READ)
+            docs = structured_query.order(list(chain.from_iterable(streams)))
+    yield from fmt.stream(batched(map(structured_query.project, docs), STREAM_BATCH_SIZE))
 
 
-def ordered_query(
-    type_: str,
+# aggregation
+
+
+def _aggregate(
     rtdb: fb_utils.RTDB,
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    aggregation_query: AggregationQuery
+) -> List[Dict]:
+    uri = f'{APP_ID}/data/{_type}'
+    is_count = aggregation_query.is_count()
+    plan, structured_query, _ids = _plan(
+        cfs, user_id, _type, aggregation_query.as_query(), count=is_count)
+    if plan.strategy == planner.COUNT:
+        total = _count(cfs, uri, structured_query, _ids)
+        return [{a.name(): total for a in aggregation_query.aggregations}]
+    # only the grouped and aggregated fields are read and cast
+    fields = aggregation_query.group_fields() + aggregation_query.value_fields()
+    mask = _field_mask(rtdb, _type, fields)
+    _fetch, _chunks = _fetch_plan(cfs, uri, structured_query, _ids, mask, plan)
+    if is_count:
+        # nothing to cast, only the number of docs matters
+        with closing(fan_out(_fetch, _chunks, QUERY_WORKERS)) as results:
+            total = sum(len(res) for res in results)
+        return [{a.name(): total for a in aggregation_query.aggregations}]
+    reducer = Reducer(aggregation_query)
+    _cast = _caster(rtdb, _type, fields)
+    with closing(fan_out(_fetch, _chunks, QUERY_WORKERS)) as results:
+        for res in results:
+            reducer.add([_cast(doc) for doc in res])
+    return reducer.result()
+
+
+def _count(
     cfs: fb_utils.Firestore,
     uri: str,
     structured_query: StructuredQuery,
-    _ids: Iterator[str]
-):
-    docs = list(all_matching_docs(type_, rtdb, cfs, uri, structured_query, _ids))
-    docs = structured_query.order(docs)
-    yield json.dumps(docs, sort_keys=True)
+    _ids: Iterable[str]
+) -> int:
+    # A count aggregation per chunk of ids: only the number leaves Firestore and no
+    # documents are read. This is not len(eligible ids), as slots can outlive their docs.
+    @timing.timed('fetch')
+    def _fetch(_from: List[str]) -> int:
+        query_ = structured_query.filter(cfs.ref(path=uri).where(u'uuid', u'in', _from))
+        return cfs.count(query_)
+
+    _chunks = batched(_ids, IN_QUERY_SIZE)
+    with closing(fan_out(_fetch, _chunks, QUERY_WORKERS)) as results:
+        return sum(results)
+
+
+# paged query
+
+
+def _query_page(
+    rtdb: fb_utils.RTDB,
+    cfs: fb_utils.Firestore,
+    user_id: str,
+    _type: str,
+    structured_query: StructuredQuery = None,
+    page_size: int = None,
+    page_token: str = None
+) -> Tuple[List[Dict], Optional[str]]:
+    # returns a page of docs and a token to resume after it, or None if it's the last.
+    # Unordered pages are ordered by uuid so that they can resume by position in the
+    # (sorted) list of eligible ids without re-reading earlier chunks.
+    structured_query = structured_query or StructuredQuery()
+    if structured_query.limit is not None or structured_query.offset is not None:
+        raise ValueError('pageSize can not be combined with limit or offset')
+    page_size = page_size or DEFAULT_PAGE_SIZE
+    if not isinstance(page_size, int) or not (0 < page_size <= MAX_PAGE_SIZE):
+        raise ValueError(f'pageSize must be between 1 and {MAX_PAGE_SIZE}')
+    fingerprint = _page_fingerprint(user_id, _type, structured_query)
+    state = {}
+    if page_token:
+        state = read_token(page_token, PAGE_TOKEN_SECRET)
+        if state.get('q') != fingerprint:
+            raise ValueError('pageToken does not belong to this query')
+
+    _ids = _eligible_docs(cfs, user_id, _type)
+    uri = f'{APP_ID}/data/{_type}'
+    # ask for one more than we need, to know if there is a next page
+    paged_query = structured_query.copy(update={'limit': page_size + 1})
+    after = paged_query.key_from_values(state['k']) if state else None
+    # unordered pages resume by position in the ids, so they are read in id order
+    plan, paged_query, _ = _plan(
+        cfs, user_id, _type, paged_query, _ids=_ids, intersect=structured_query.is_ordered())
+    needed = structured_query.needed_fields()
+    mask = _field_mask(rtdb, _type, needed)
+    _cast = _caster(rtdb, _type, needed)
+    if structured_query.is_ordered():
+        # the order spans all chunks, so every chunk is read but only the top is kept
+        _fetch, _chunks = _fetch_plan(cfs, uri, paged_query, _ids, mask, plan)
+        with closing(fan_out(_fetch, _chunks, QUERY_WORKERS)) as results:
+            streams = ([_cast(doc) for doc in res] for res in results)
+            docs = paged_query.top(streams, after)
+        position = None
+    else:
+        position = _resume_position(_ids, state)
+        docs = []
+        _fetch, _chunks = _fetch_plan(cfs, uri, paged_query, _ids[position:], mask, plan)
+        with closing(fan_out(_fetch, _chunks, QUERY_WORKERS, ordered=True)) as results:
+            for res in results:
+                docs.extend(sorted(res, key=_by_id))
+                if len(docs) > page_size:
+                    break
+        docs = [_cast(doc) for doc in docs[:page_size + 1]]
+    if len(docs) <= page_size:
+        return [structured_query.project(doc) for doc in docs], None
+    docs = docs[:page_size]
+    last = docs[-1]
+    next_state = {'q': fingerprint, 'k': paged_query.key_values(last)}
+    if position is not None:
+        next_state['p'] = bisect_right(_ids, last.get('uuid'), lo=position)
+    docs = [structured_query.project(doc) for doc in docs]
+    return docs, sign_token(next_state, PAGE_TOKEN_SECRET)
+
+
+def _page_fingerprint(user_id: str, _type: str, structured_query: StructuredQuery) -> str:
+    body = json.dumps([user_id, _type, structured_query.dict()], sort_keys=True, default=str)
+    return sha1(body.encode('utf-8')).hexdigest()
+
+
+def _resume_position(_ids: Sequence[str], state: Dict) -> int:
+    # the position in the token is only trusted while the id before it is still the last
+    # one we returned, otherwise the eligible ids changed and we look it up again.
+    if not state:
+        return 0
+    last_id = state['k'][-1]
+    position = state.get('p', 0)
+    if 0 < position <= len(_ids) and _ids[position - 1] == last_id:
+        return position
+    return bisect_right(_ids, last_id)
 
 
 # write
@@ -331,6 +1008,8 @@ def write_docs(
                 write_doc(rtdb, cfs, create_doc, update_doc, schema_name)
             except Exception as err:
                 write_errors.append(err)
+    # new docs may change what the user is eligible for
+    _invalidate_eligible_docs(user_id, schema_name)
     errors = [*schema_errors, *write_errors]
     if errors:
         err_msg = f'{len(errors)} errors in {count + 1} submitted docs: {errors}'
@@ -355,13 +1034,12 @@ def write_doc(
     _id = create_doc['uuid']
     # in Logiak everything is a string internally, not sure why, but there it is
     uri = f'{APP_ID}/data/{schema_name}/{_id}'
-    ref = cfs.ref(full_path=uri)
     try:
         # try to create first, if it fails, update
         create_doc = cast_values_to_string(create_doc)
-        res = ref.create(create_doc)
+        res = cfs.create(uri, create_doc)
         return res
     except AlreadyExists:
         update_doc = cast_values_to_string(update_doc)
-        res = ref.update(update_doc)
+        res = cfs.update(uri, update_doc)
         return res
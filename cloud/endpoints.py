@@ -33,7 +33,7 @@ try:
 except ImportError:
     from test.app.cloud.auth import AuthHandler, auth_request, require_auth
 
-from . import data, fb_utils, meta, utils
+from . import compression, data, fb_utils, meta, metrics, timing, utils
 
 LOG = logging.getLogger('EP')
 LOG.setLevel(logging.DEBUG)
@@ -44,7 +44,20 @@ _STRIP = utils.path_stripper([ROOT_PATH, ''])
 
 SCHEMAS = {}
 
-if (fb_uri := os.environ.get('FIREBASE_HOST', False)):
+# non-standard response headers that browser clients need to be able to read
+EXPOSE_HEADERS = [data.PAGE_TOKEN_HEADER, 'ETag']
+
+if os.environ.get('FIREBASE_BACKEND') == 'memory':
+    # no Firebase at all, see fb_memory
+    from . import fb_memory
+    LOG.debug('Using the in-memory backend')
+    APP = None
+    CFS = fb_memory.MemoryFirestore()
+    RTDB = fb_memory.MemoryRTDB()
+    _app_id = fb_memory.load_mock_project(CFS, RTDB, os.environ.get('MOCK_DATA_PATH'))
+    if _app_id != data.APP_ID:
+        LOG.warning(f'LOGIAK_APP_ID is not the mock project app: {_app_id}')
+elif (fb_uri := os.environ.get('FIREBASE_HOST', False)):
     LOG.debug('Connecting to Live Firebase from local functions')
     project_id = os.environ.get('FIREBASE_PROJECT_ID')
     cert = os.environ.get('FIREBASE_CREDENTIALS')
@@ -58,6 +71,7 @@ if (fb_uri := os.environ.get('FIREBASE_HOST', False)):
             'projectId': project_id
         })
     CFS = fb_utils.Firestore(app=APP)
+    RTDB = fb_utils.RTDB(APP)
 elif (local_fb_uri := os.environ.get('FIREBASE_DATABASE_EMULATOR_HOST', False)):
     LOG.debug('Connecting to Local Emulator')
     _local = 'local'
@@ -74,15 +88,14 @@ elif (local_fb_uri := os.environ.get('FIREBASE_DATABASE_EMULATOR_HOST', False)):
             _local,
             credentials=AnonymousCredentials()
         ))
+    RTDB = fb_utils.RTDB(APP)
 else:
     LOG.debug('Connecting to Firebase')
     APP = firebase_admin.initialize_app(options={
         'databaseURL': os.environ.get('FIREBASE_URL')
     })
     CFS = fb_utils.Firestore(APP)
-
-
-RTDB = fb_utils.RTDB(APP)
+    RTDB = fb_utils.RTDB(APP)
 AUTH_HANDLER = AuthHandler(RTDB)
 
 
@@ -90,17 +103,33 @@ def allow_cors(fn):
     cors_domain = os.environ.get('CORS_DOMAIN', '*')
 
     def wrapper(request, *args, **kwargs):
-        if request.method != 'OPTIONS':
-            res: Response = fn(request, *args, **kwargs)
-        else:
-            res = Response('', 204)
-        res.headers['Access-Control-Allow-Origin'] = cors_domain
-        res.headers['Access-Control-Allow-Headers'] = '*'
-        res.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
-        return res
+        # the outermost handler times the request, see timing
+        with timing.request() as timings:
+            if request.method != 'OPTIONS':
+                res: Response = fn(request, *args, **kwargs)
+            else:
+                res = Response('', 204)
+            res.headers['Access-Control-Allow-Origin'] = cors_domain
+            res.headers['Access-Control-Allow-Headers'] = '*'
+            res.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS, DELETE'
+            res.headers['Access-Control-Expose-Headers'] = ', '.join(EXPOSE_HEADERS)
+            # no-op if an inner handler already encoded it
+            res = compression.compress_response(res, request.headers.get('Accept-Encoding'))
+            if timings:
+                res.headers['Timing-Allow-Origin'] = cors_domain
+                _add_timing(res, timings, f'{request.method} {request.path}')
+            return res
     return wrapper
 
 
+def _add_timing(res: Response, timings: timing.Timings, label: str):
+    # A streamed body is mostly produced after the headers are sent, so the header
+    # only has what happened up to then. The totals are logged once it's done.
+    res.headers[timing.SERVER_TIMING_HEADER] = timings.header()
+    if res.is_streamed:
+        res.response = timing.trailing(res.response, timings, label)
+
+
 # actual request handlers
 
 
@@ -116,6 +145,8 @@ def handle_all(request):
             return handle_meta(request)
         elif root == 'data':
             return handle_data(request)
+        elif root == 'metrics':
+            return handle_metrics(request)
         return Response(f'Not Found @ {path}', 404)
     except Exception as err:
         return Response(f'Unhandled Server Error: {err}', 500)
@@ -131,7 +162,7 @@ def handle_auth(request):
 @require_auth(AUTH_HANDLER)
 def handle_meta(request):
     path = request.path.split('/')
-    return meta.resolve(path, RTDB)
+    return meta.resolve(path, RTDB, request.headers)
 
 
 @allow_cors
@@ -140,4 +171,10 @@ def handle_data(request):
     user_id = request.headers.get('Logiak-User-Id')
     path = request.path.split('/')
     data_ = request.get_json()
-    return data.resolve(user_id, path, CFS, RTDB, data_)
+    return data.resolve(user_id, path, CFS, RTDB, data_, request.headers, request.args)
+
+
+@allow_cors
+@require_auth(AUTH_HANDLER)
+def handle_metrics(request):
+    return Response(metrics.render(), 200, content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,353 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from copy import deepcopy
+import json
+import os
+from threading import RLock
+from typing import Any, Dict, List
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+from . import fb_utils
+from .query import compile_filter
+from .utils import escape_version
+
+# In-memory backend
+'''
+A stand-in for the parts of Cloud Firestore and the Realtime Database that this API
+uses, seeded from the mock project (see download_mock_data.py) and selected with
+FIREBASE_BACKEND=memory. It is meant for local work and benchmarks, where the
+emulator is too slow and too noisy, never for production. Queries follow the CFS
+semantics we rely on (values are compared raw, as Logiak stores them), but indexes
+are never enforced and nothing is persisted.
+'''
+
+# the LoMIS demo project, in the layout download_mock_data.py writes
+MOCK_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'mock', 'lomis')
+
+OPERATORS = ['<', '<=', '==', '>', '>=', 'in', 'array-contains', 'array-contains-any']
+
+
+def _split(path: str) -> List[str]:
+    return [i for i in path.split('/') if i]
+
+
+def _field_name(field_path: str) -> str:
+    # top level paths only, as quoted by FieldPath.to_api_repr
+    if field_path.startswith('`'):
+        return field_path[1:-1].replace('\\`', '`').replace('\\\\', '\\')
+    return field_path
+
+
+def _project(doc: Dict, field_paths) -> Dict:
+    if field_paths is None:
+        return deepcopy(doc)
+    names = [_field_name(p) for p in field_paths]
+    return {k: deepcopy(doc[k]) for k in names if k in doc}
+
+
+# # Firestore
+
+class _Store(object):
+    # documents are keyed by their full path, and every collection keeps an
+    # index of its child ids so listing does not scan the whole store
+
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+        self.index: Dict[str, Dict[str, None]] = {}
+        self.lock = RLock()
+
+    def put(self, path: str, value: Dict):
+        with self.lock:
+            self.docs[path] = value
+            parts = _split(path)
+            for x in range(len(parts) - 1, 0, -2):
+                self.index.setdefault('/'.join(parts[:x]), {})[parts[x]] = None
+
+    def remove(self, path: str):
+        with self.lock:
+            self.docs.pop(path, None)
+            parts = _split(path)
+            self.index.get('/'.join(parts[:-1]), {}).pop(parts[-1], None)
+
+    def children(self, collection_path: str) -> List[str]:
+        with self.lock:
+            return sorted(self.index.get(collection_path, {}).keys())
+
+
+class MemorySnapshot(object):
+
+    def __init__(self, reference: 'MemoryDocument', data: Dict = None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return self._data
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class MemoryDocument(object):
+
+    def __init__(self, store: _Store, path: str):
+        self._store = store
+        self.path = '/'.join(_split(path))
+        self.id = _split(path)[-1]
+
+    def get(self, field_paths=None, **kwargs) -> MemorySnapshot:
+        with self._store.lock:
+            doc = self._store.docs.get(self.path)
+            return MemorySnapshot(self, _project(doc, field_paths) if doc is not None else None)
+
+    def create(self, value: Dict):
+        with self._store.lock:
+            if self.path in self._store.docs:
+                raise AlreadyExists(f'Document already exists: {self.path}')
+            self._store.put(self.path, deepcopy(value))
+
+    def set(self, value: Dict, merge=False):
+        with self._store.lock:
+            if merge and self.path in self._store.docs:
+                self._store.docs[self.path].update(deepcopy(value))
+            else:
+                self._store.put(self.path, deepcopy(value))
+
+    def update(self, value: Dict):
+        with self._store.lock:
+            if self.path not in self._store.docs:
+                raise NotFound(f'No document to update: {self.path}')
+            self._store.docs[self.path].update(deepcopy(value))
+
+    def delete(self):
+        with self._store.lock:
+            self._store.remove(self.path)
+
+    def collection(self, name: str) -> 'MemoryCollection':
+        return MemoryCollection(self._store, f'{self.path}/{name}')
+
+
+class _AggregationResult(object):
+
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class _CountQuery(object):
+
+    def __init__(self, query: 'MemoryQuery', alias: str = None):
+        self._query = query
+        self._alias = alias or 'count'
+
+    def get(self, **kwargs):
+        count = sum(1 for _ in self._query._matches())
+        return [[_AggregationResult(self._alias, count)]]
+
+
+class MemoryQuery(object):
+
+    def __init__(self, store: _Store, path: str, filters=(), fields=None, limit_=None):
+        self._store = store
+        self._path = path
+        self._filters = tuple(filters)
+        # values of different types never match, as in CFS, see query.compile_filter
+        self._match = compile_filter(self._filters)
+        self._fields = fields
+        self._limit = limit_
+
+    def _copy(self, **kwargs) -> 'MemoryQuery':
+        args = {
+            'filters': self._filters,
+            'fields': self._fields,
+            'limit_': self._limit,
+            **kwargs
+        }
+        return MemoryQuery(self._store, self._path, **args)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> 'MemoryQuery':
+        if op_string not in OPERATORS:
+            raise ValueError(f'Operator string {op_string} is invalid.')
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def select(self, field_paths) -> 'MemoryQuery':
+        return self._copy(fields=list(field_paths))
+
+    def limit(self, count: int) -> 'MemoryQuery':
+        return self._copy(limit_=count)
+
+    def count(self, alias: str = None) -> _CountQuery:
+        return _CountQuery(self, alias)
+
+    def _matches(self):
+        for _id in self._store.children(self._path):
+            path = f'{self._path}/{_id}'
+            with self._store.lock:
+                doc = self._store.docs.get(path)
+            if doc is None:
+                continue
+            if self._match(doc):
+                yield MemoryDocument(self._store, path), doc
+
+    def stream(self, **kwargs):
+        for x, (ref, doc) in enumerate(self._matches()):
+            if self._limit is not None and x >= self._limit:
+                return
+            yield MemorySnapshot(ref, _project(doc, self._fields))
+
+    def get(self, **kwargs):
+        return list(self.stream())
+
+
+class MemoryCollection(MemoryQuery):
+
+    def __init__(self, store: _Store, path: str):
+        super().__init__(store, '/'.join(_split(path)))
+        self.id = _split(path)[-1]
+
+    def document(self, _id: str) -> MemoryDocument:
+        return MemoryDocument(self._store, f'{self._path}/{_id}')
+
+    def list_documents(self, page_size: int = None):
+        # like the real client, includes "missing" parents of sub-collections
+        for _id in self._store.children(self._path):
+            yield self.document(_id)
+
+    def add(self, value: Dict, document_id: str = None):
+        ref = self.document(document_id or os.urandom(10).hex())
+        ref.set(value)
+        return None, ref
+
+
+class MemoryClient(object):
+
+    def __init__(self):
+        self._store = _Store()
+
+    def collection(self, path: str) -> MemoryCollection:
+        return MemoryCollection(self._store, path)
+
+    def document(self, path: str) -> MemoryDocument:
+        return MemoryDocument(self._store, path)
+
+    def get_all(self, references, field_paths=None, **kwargs):
+        for ref in references:
+            yield ref.get(field_paths=field_paths)
+
+
+class MemoryFirestore(fb_utils.Firestore):
+
+    def __init__(self):
+        super().__init__(instance=MemoryClient())
+
+
+# # RTDB
+
+class MemoryReference(object):
+
+    def __init__(self, root: 'MemoryRTDB', path: str):
+        self._root = root
+        self._parts = _split(path)
+
+    def _node(self):
+        node = self._root.tree
+        for p in self._parts:
+            if not isinstance(node, dict) or p not in node:
+                return None
+            node = node[p]
+        return node
+
+    def get(self, shallow=False, **kwargs):
+        with self._root.lock:
+            node = self._node()
+            if shallow and isinstance(node, dict):
+                return {k: True for k in node.keys()}
+            return deepcopy(node)
+
+    def set(self, value):
+        with self._root.lock:
+            if not self._parts:
+                self._root.tree = deepcopy(value) or {}
+                return
+            node = self._root.tree
+            for p in self._parts[:-1]:
+                if not isinstance(node.get(p), dict):
+                    node[p] = {}
+                node = node[p]
+            node[self._parts[-1]] = deepcopy(value)
+
+    def update(self, value: Dict):
+        for k, v in value.items():
+            self.child(k).set(v)
+
+    def child(self, path: str) -> 'MemoryReference':
+        return MemoryReference(self._root, '/'.join([*self._parts, *_split(path)]))
+
+    def delete(self):
+        with self._root.lock:
+            if not self._parts:
+                self._root.tree = {}
+                return
+            parent = MemoryReference(self._root, '/'.join(self._parts[:-1]))._node()
+            if isinstance(parent, dict):
+                parent.pop(self._parts[-1], None)
+
+
+class MemoryRTDB(fb_utils.RTDB):
+
+    def __init__(self):
+        super().__init__(app=None)
+        self.tree: Dict = {}
+        self.lock = RLock()
+
+    def _reference(self, path):
+        return MemoryReference(self, path)
+
+
+# # Seeding
+
+def _load(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_mock_project(cfs: MemoryFirestore, rtdb: MemoryRTDB, folder: str = None) -> str:
+    # same as the test setup against the emulator, returns the app id of the project
+    folder = folder or MOCK_DATA_PATH
+    info = _load(f'{folder}/meta/app-info.json')
+    app_id = info['uuid']
+    version = escape_version(info['defaultVersion'])
+    rtdb.reference(f'{app_id}/settings').set(info)
+    rtdb.reference(f'{app_id}/inits').set(_load(f'{folder}/meta/inits.json'))
+    rtdb.reference(
+        f'apps/{info["defaultAppUuid"]}/{version}/{info["variants"]}/json'
+    ).set(json.dumps(_load(f'{folder}/meta/app.json')))
+    schemas = _load(f'{folder}/meta/schemas.json')
+    for name, schema in schemas.items():
+        rtdb.reference(f'objects/{app_id}/{version}/{name}').set(schema)
+    for _type in ['data', 'slots', 'tx']:
+        _path = f'{folder}/data/{_type}.json'
+        if os.path.exists(_path):
+            fb_utils.cfs_write(cfs, _load(_path), app_id)
+    return app_id
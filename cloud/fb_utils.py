@@ -16,22 +16,80 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from time import perf_counter
 import types
+from typing import Iterable, Iterator, List
 
 from firebase_admin.db import reference as rtdb_reference
 from firebase_admin.firestore import client as cfs_client
 from google.cloud import firestore
 from google.cloud.firestore_v1.collection import CollectionReference
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from . import metrics, timing
+
+
+def field_paths(names: Iterable[str]) -> List[str]:
+    # top level field names as field paths for a mask, quoted where needed (e.g. dots)
+    return [FieldPath(name).to_api_repr() for name in names]
+
+
+def _timed_stream(backend: str, op: str, iterable: Iterable) -> Iterator:
+    # one observation per call, the time spent waiting on the backend for all of it
+    waited = 0.0
+    items = iter(iterable)
+    try:
+        while True:
+            start = perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                waited += perf_counter() - start
+            yield item
+    finally:
+        metrics.observe_call(backend, op, waited)
 
 
 # RTDB io
 
+class Reference(object):
+    # counts and times the calls of a reference, everything else is passed through
+
+    def __init__(self, ref):
+        self._ref = ref
+
+    def get(self, *args, **kwargs):
+        timing.count('rtdb_gets')
+        with timing.span('rtdb'), metrics.backend_call('rtdb', 'get'):
+            return self._ref.get(*args, **kwargs)
+
+    def set(self, value):
+        with metrics.backend_call('rtdb', 'set'):
+            return self._ref.set(value)
+
+    def update(self, value):
+        with metrics.backend_call('rtdb', 'update'):
+            return self._ref.update(value)
+
+    def delete(self):
+        with metrics.backend_call('rtdb', 'delete'):
+            return self._ref.delete()
+
+    def __getattr__(self, name):
+        return getattr(self._ref, name)
+
+
 class RTDB(object):
 
     def __init__(self, app):
         self.app = app
 
     def reference(self, path):
+        return Reference(self._reference(path))
+
+    def _reference(self, path):
         return rtdb_reference(path, app=self.app)
 
 
@@ -46,13 +104,30 @@ class Firestore(object):
         elif instance:
             self.cfs = instance
 
-    def read(self, path=None, _id=None, doc_path=None):
-        if doc_path:
-            return self.ref(full_path=doc_path).get()
-        if _id:
-            return self.ref(path, _id).get().to_dict()
+    def read(self, path=None, _id=None, doc_path=None, field_paths=None):
+        if doc_path or _id:
+            timing.count('cfs_reads')
+            with metrics.backend_call('firestore', 'get'):
+                if doc_path:
+                    return self.ref(full_path=doc_path).get(field_paths=field_paths)
+                return self.ref(path, _id).get().to_dict()
         else:
-            return [i.to_dict() for i in self.ref(path, _id).get()]
+            return [i.to_dict() for i in self.stream(self.ref(path, _id))]
+
+    def stream(self, query):
+        # the snapshots of a query, a query is billed at least one read
+        found = 0
+        for doc in _timed_stream('firestore', 'query', query.stream()):
+            found += 1
+            yield doc
+        timing.count('cfs_reads', max(found, 1))
+
+    def count(self, query) -> int:
+        # a count aggregation, billed one read per 1000 index entries
+        with metrics.backend_call('firestore', 'count'):
+            res = query.count().get()[0][0].value
+        timing.count('cfs_reads', max(1, -(-res // 1000)))
+        return res
 
     def ref(self, path=None, _id=None, full_path=None):
         if full_path:
@@ -63,18 +138,55 @@ class Firestore(object):
         else:
             return self.cfs.collection(path)
 
+    def get_all(self, full_paths, field_paths=None):
+        # multi-get, one RPC for the whole batch of document paths
+        refs = [self.ref(full_path=p) for p in full_paths]
+        timing.count('cfs_reads', len(refs))
+        res = self.cfs.get_all(refs, field_paths=field_paths)
+        return _timed_stream('firestore', 'get_all', res)
+
     def list(self, path=None, _id=None, full_path=None):
-        return [i.id for i in self.ref(path, _id, full_path).list_documents()]
+        with metrics.backend_call('firestore', 'list'):
+            res = [i.id for i in self.ref(path, _id, full_path).list_documents()]
+        timing.count('cfs_reads', max(len(res), 1))
+        return res
+
+    def list_pages(self, path=None, _id=None, full_path=None, page_size=300):
+        # like list, but yields the ids a page at a time as they are fetched
+        page, listed = [], 0
+        listing = self.ref(path, _id, full_path).list_documents(page_size=page_size)
+        for i in _timed_stream('firestore', 'list', listing):
+            page.append(i.id)
+            if len(page) >= page_size:
+                listed += len(page)
+                timing.count('cfs_reads', len(page))
+                yield page
+                page = []
+        timing.count('cfs_reads', len(page) if (page or listed) else 1)
+        if page:
+            yield page
 
     def write(self, path=None, value=None, _id=None, full_path=None):
         _set_ref = self.ref(path, _id, full_path)
-        if isinstance(_set_ref, CollectionReference):
-            return _set_ref.add(value, document_id=_id)
-        else:
-            return _set_ref.set(value)
+        with metrics.backend_call('firestore', 'set'):
+            if isinstance(_set_ref, CollectionReference):
+                return _set_ref.add(value, document_id=_id)
+            else:
+                return _set_ref.set(value)
+
+    def create(self, full_path, value):
+        # raises AlreadyExists
+        with metrics.backend_call('firestore', 'create'):
+            return self.ref(full_path=full_path).create(value)
+
+    def update(self, full_path, value):
+        # raises NotFound
+        with metrics.backend_call('firestore', 'update'):
+            return self.ref(full_path=full_path).update(value)
 
     def remove(self, path, _id=None):
-        return self.ref(path, _id).delete()
+        with metrics.backend_call('firestore', 'delete'):
+            return self.ref(path, _id).delete()
 
 
 # recursive generator to extract data from a nested CFS path
@@ -0,0 +1,195 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from io import BytesIO
+import json
+import logging
+from typing import Dict, Iterator, List, Optional, Type, Union
+
+import msgpack
+import spavro.datafile
+import spavro.io
+import spavro.schema
+
+from . import timing
+
+# Response serialization
+'''
+Documents are always produced as (cast) dicts, in chunks. A Format turns a stream
+of those chunks into the body of a response, and only ever holds one chunk at a
+time, so that query results can still be streamed to the client. The format is
+chosen from the request's Accept header, see `negotiate`.
+'''
+
+LOG = logging.getLogger('FMT')
+LOG.setLevel(logging.DEBUG)
+
+
+class SchemaMismatch(RuntimeError):
+    # a document that can't be written with the format's schema
+    pass
+
+
+class Format(object):
+    mimetype: str = None
+    # other mimetypes clients may ask for this format with
+    aliases: List[str] = []
+    # whether the format is built around the (READ) schema of the type
+    needs_schema: bool = False
+
+    def __init__(self, schema: spavro.schema.Schema = None):
+        self.schema = schema
+
+    def stream(self, chunks: Iterator[List[Dict]]) -> Iterator[Union[str, bytes]]:
+        raise NotImplementedError
+
+    def many(self, docs: List[Dict]) -> Union[str, bytes]:
+        parts = list(self.stream(iter([docs])))
+        return (b'' if parts and isinstance(parts[0], bytes) else '').join(parts)
+
+    def one(self, doc: Dict) -> Union[str, bytes]:
+        return self.many([doc])
+
+
+class JSONFormat(Format):
+    # a single json array
+    mimetype = 'application/json'
+
+    def stream(self, chunks):
+        # Yielding chunks of json is tricky as the number of docs is unknown
+        # 0 >= n_docs <= Infinity? so we only emit a separator once something has
+        # already been written, one yield per non-empty chunk.
+        yield '['
+        first = True
+        for docs in chunks:
+            if not docs:
+                continue
+            with timing.span('encode'):
+                body = ','.join([json.dumps(doc, sort_keys=True) for doc in docs])
+            yield body if first else f',{body}'
+            first = False
+        yield ']'
+
+    @timing.timed('encode')
+    def one(self, doc):
+        return json.dumps(doc, sort_keys=True)
+
+
+class NDJSONFormat(Format):
+    # one json document per line
+    mimetype = 'application/x-ndjson'
+    aliases = ['application/ndjson', 'application/jsonl']
+
+    def stream(self, chunks):
+        for docs in chunks:
+            if docs:
+                with timing.span('encode'):
+                    body = ''.join([f'{json.dumps(doc, sort_keys=True)}\n' for doc in docs])
+                yield body
+
+
+class MessagePackFormat(Format):
+    # a stream of msgpack maps, one per document (read with msgpack.Unpacker)
+    mimetype = 'application/msgpack'
+    aliases = ['application/x-msgpack']
+
+    def stream(self, chunks):
+        packer = msgpack.Packer()
+        for docs in chunks:
+            if docs:
+                with timing.span('encode'):
+                    body = b''.join([packer.pack(doc) for doc in docs])
+                yield body
+
+    @timing.timed('encode')
+    def one(self, doc):
+        return msgpack.packb(doc)
+
+
+class AvroFormat(Format):
+    # an avro object container file, one block per chunk
+    mimetype = 'application/avro'
+    aliases = ['avro/binary', 'application/x-avro-binary']
+    needs_schema = True
+
+    def stream(self, chunks):
+        buffer = BytesIO()
+        writer = spavro.datafile.DataFileWriter(
+            buffer, spavro.io.DatumWriter(), self.schema)
+
+        def _drain():
+            res = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            return res
+
+        for docs in chunks:
+            with timing.span('encode'):
+                for doc in docs:
+                    # Documents written on older app versions may not match the current
+                    # schema, and a container can only hold one schema. Leaving them out
+                    # would lose them without the client knowing, so the response fails
+                    # instead (cut short if it's already streaming).
+                    if not spavro.io.validate(self.schema, doc):
+                        msg = (f'{doc.get("uuid")} (version {doc.get("version_modified")})'
+                               f' does not match schema {self.schema.name}')
+                        LOG.error(msg)
+                        raise SchemaMismatch(msg)
+                    writer.append(doc)
+                writer.sync()
+                block = _drain()
+            if block:
+                yield block
+        writer.sync()  # writes the header if nothing was written yet
+        if (block := _drain()):
+            yield block
+
+
+FORMATS: List[Type[Format]] = [JSONFormat, NDJSONFormat, AvroFormat, MessagePackFormat]
+
+_BY_MIMETYPE = {
+    mimetype: fmt
+    for fmt in FORMATS
+    for mimetype in [fmt.mimetype, *fmt.aliases]
+}
+
+
+def negotiate(accept: str = None) -> Optional[Type[Format]]:
+    # picks the preferred format from an Accept header, defaulting to JSON.
+    # None means that nothing the client accepts is available (406).
+    if not accept:
+        return JSONFormat
+    options = []
+    for x, part in enumerate(accept.split(',')):
+        mimetype, *params = [i.strip() for i in part.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if q > 0:
+            # highest q first, then in the order given
+            options.append((-q, x, mimetype.lower()))
+    for _, _, mimetype in sorted(options):
+        if mimetype in _BY_MIMETYPE:
+            return _BY_MIMETYPE[mimetype]
+        if mimetype in ('*/*', 'application/*'):
+            return JSONFormat
+    return None
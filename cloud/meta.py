@@ -16,18 +16,20 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import json
 import logging
 import os
-from typing import List
+from threading import Lock
+from typing import Dict, FrozenSet, List, Mapping, Optional
 
-from cachetools import cached, LRUCache, TTLCache
+from cachetools import cached
 from cachetools.keys import hashkey
 from flask import Response
 import spavro.schema
 
 
-from . import fb_utils
+from . import compression, fb_utils, metrics
 from .schema import strip_banned_from_schema, SchemaType
 from .utils import escape_email, escape_version, path_stripper
 
@@ -52,25 +54,83 @@ def key_ignore_db(*args, **kwargs):
     return hashkey(*args[1:], **kwargs)
 
 
-def as_json_response(obj) -> Response:
+# Serialized bodies of the (cached) meta objects, with their compressed variants.
+# Keyed by identity, as the caches below hand out the same object until it expires;
+# the entry holds a reference to the object so its id can't be reused meanwhile.
+_BODIES = metrics.LRUCache('meta_bodies', maxsize=64)
+_BODIES_LOCK = Lock()
+
+
+class _Body(object):
+
+    def __init__(self, obj):
+        raw = json.dumps(obj).encode('utf-8')
+        self.etag = hashlib.sha1(raw).hexdigest()
+        self.encoded: Dict[str, bytes] = {compression.IDENTITY: raw}
+
+    def size(self) -> int:
+        return len(self.encoded[compression.IDENTITY])
+
+    def get(self, encoding: str) -> bytes:
+        if encoding not in self.encoded:
+            # compressed once, at the highest level since it's reused
+            body = compression.compress(
+                self.encoded[compression.IDENTITY], encoding, static=True)
+            with _BODIES_LOCK:
+                self.encoded[encoding] = body
+        return self.encoded[encoding]
+
+
+def _body(obj) -> _Body:
+    with _BODIES_LOCK:
+        entry = _BODIES.get(id(obj))
+        if entry and entry[0] is obj:
+            return entry[1]
+        body = _Body(obj)
+        _BODIES[id(obj)] = (obj, body)
+        return body
+
+
+def as_json_response(
+    obj,
+    encoding: str = compression.IDENTITY,
+    if_none_match: str = None
+) -> Response:
     if obj is not None:
-        return Response(json.dumps(obj), 200, mimetype='application/json')
+        body = _body(obj)
+        if body.size() < compression.MIN_SIZE:
+            encoding = compression.IDENTITY
+        etag = compression.encoded_etag(body.etag, encoding)
+        if compression.not_modified(if_none_match, body.etag):
+            res = compression.not_modified_response(etag)
+        else:
+            res = Response(body.get(encoding), 200, mimetype='application/json')
+            res.set_etag(etag)
+            if encoding != compression.IDENTITY:
+                res.headers['Content-Encoding'] = encoding
+        res.vary.add('Accept-Encoding')
+        return res
     return Response('Not Found', 404)
 
 
-def resolve(path, rtdb: fb_utils.RTDB) -> Response:
+def resolve(path, rtdb: fb_utils.RTDB, headers: Mapping = None) -> Response:
     path = _STRIP(path)
+    headers = headers or {}
+    args = (
+        compression.negotiate_encoding(headers.get('Accept-Encoding')),
+        headers.get('If-None-Match')
+    )
     try:
         if path[0] == 'schema':
             if len(path) == 2:
-                return as_json_response(_meta_list_schemas(rtdb, path[1]))
+                return as_json_response(_meta_list_schemas(rtdb, path[1]), *args)
             if len(path) == 3:
-                return as_json_response(_meta_schema(rtdb, path[1], path[2]))
+                return as_json_response(_meta_schema(rtdb, path[1], path[2]), *args)
         elif path[0] == 'app':
             if len(path) < 2:
-                return as_json_response(_meta_info(rtdb))
+                return as_json_response(_meta_info(rtdb), *args)
             else:
-                return as_json_response(_meta_app(rtdb, path[1], path[2]))
+                return as_json_response(_meta_app(rtdb, path[1], path[2]), *args)
     except IndexError:
         # could not parse args
         pass
@@ -79,7 +139,7 @@ def resolve(path, rtdb: fb_utils.RTDB) -> Response:
 
 # /meta/app [GET]
 # -> {app_id}/settings
-@cached(cache=TTLCache(maxsize=1, ttl=300), key=key_ignore_db)
+@cached(cache=metrics.TTLCache('_meta_info', maxsize=1, ttl=300), key=key_ignore_db)
 def _meta_info(rtdb: fb_utils.RTDB) -> dict:
     uri = f'{APP_ID}/settings'
     return rtdb.reference(uri).get()
@@ -87,7 +147,7 @@ def _meta_info(rtdb: fb_utils.RTDB) -> dict:
 
 # /meta/app/{app_version}/{app_language} [GET]
 # -> apps/{app_alias}/{app_version(escaped)}/{language}/json
-@cached(LRUCache(maxsize=32), key=key_ignore_db)
+@cached(metrics.LRUCache('_meta_app', maxsize=32), key=key_ignore_db)
 def _meta_app(rtdb: fb_utils.RTDB, app_version: str, app_language: str) -> dict:
     global APP_ALIAS
     if not APP_ALIAS:
@@ -101,7 +161,7 @@ def _meta_app(rtdb: fb_utils.RTDB, app_version: str, app_language: str) -> dict:
 
 # /meta/schema/{app_version} [GET]
 # -> objects/{app_id}/{app_version(escaped)}
-@cached(LRUCache(maxsize=32), key=key_ignore_db)
+@cached(metrics.LRUCache('_meta_list_schemas', maxsize=32), key=key_ignore_db)
 def _meta_list_schemas(rtdb: fb_utils.RTDB, app_version: str) -> List:
     _version = escape_version(app_version)
     uri = f'objects/{APP_ID}/{_version}'
@@ -112,7 +172,7 @@ def _meta_list_schemas(rtdb: fb_utils.RTDB, app_version: str) -> List:
 
 # /meta/schema/{app_version}/{schema_name}` [GET]
 # -> objects/{app_id}/{app_version(escaped)}/{schema_name}
-@cached(LRUCache(maxsize=32), key=key_ignore_db)
+@cached(metrics.LRUCache('_meta_schema', maxsize=32), key=key_ignore_db)
 def _meta_schema(
     rtdb: fb_utils.RTDB,
     app_version: str,
@@ -127,7 +187,42 @@ def _meta_schema(
         return strip_banned_from_schema(_schema, type)
 
 
-@cached(LRUCache(maxsize=32), key=key_ignore_db)
+# -> objects/{app_id}
+@cached(cache=metrics.TTLCache('_meta_versions', maxsize=1, ttl=300), key=key_ignore_db)
+def _meta_versions(rtdb: fb_utils.RTDB) -> List[str]:
+    uri = f'objects/{APP_ID}'
+    res = rtdb.reference(uri).get(shallow=True)
+    return sorted(res.keys()) if res else []
+
+
+@cached(cache=metrics.TTLCache('meta_read_fields', maxsize=128, ttl=300), key=key_ignore_db)
+def meta_read_fields(rtdb: fb_utils.RTDB, schema_name: str) -> Optional[FrozenSet[str]]:
+    # Every field the READ schema of any version exposes. A document is cast with the
+    # schema of the version that wrote it, so any of these can end up in a response.
+    # Only versions published since the last call are read from the RTDB.
+    fields = set()
+    for version in _meta_versions(rtdb):
+        fields.update(_meta_version_read_fields(rtdb, version, schema_name))
+    return frozenset(fields) or None
+
+
+# The fields of one version's READ schema. Not read through _meta_schema, so that going
+# over every version doesn't evict the schemas in use from its (small) cache.
+@cached(metrics.LRUCache('_meta_version_read_fields', maxsize=1024), key=key_ignore_db)
+def _meta_version_read_fields(
+    rtdb: fb_utils.RTDB,
+    app_version: str,
+    schema_name: str
+) -> FrozenSet[str]:
+    _version = escape_version(app_version)
+    uri = f'objects/{APP_ID}/{_version}/{schema_name}'
+    if not (res := rtdb.reference(uri).get()):
+        return frozenset()
+    _schema = strip_banned_from_schema(json.loads(res), SchemaType.READ)
+    return frozenset(f['name'] for f in _schema.get('fields', []))
+
+
+@cached(metrics.LRUCache('meta_schema_object', maxsize=32), key=key_ignore_db)
 def meta_schema_object(
     rtdb: fb_utils.RTDB,
     app_version: str,
@@ -142,7 +237,7 @@ def meta_schema_object(
         return spavro.schema.parse(meta_)
 
 
-@cached(LRUCache(maxsize=128), key=key_ignore_db)
+@cached(metrics.LRUCache('meta_user_init_info', maxsize=128), key=key_ignore_db)
 def meta_user_init_info(
     rtdb: fb_utils.RTDB,
     email: str
@@ -0,0 +1,274 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import islice
+import sys
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, List, Tuple
+
+import cachetools
+
+# Metrics
+'''
+Process wide counters, for sizing the caches and watching the backends:
+
+- caches made with LRUCache / TTLCache from here count their hits, misses, evictions
+  (full) and expirations, their size and roughly how much memory they hold
+- calls to Firestore and the RTDB (see fb_utils) are counted and timed per operation
+
+`render` writes all of it in the Prometheus text format, served at /metrics. Numbers
+are per instance and reset when it restarts.
+'''
+
+PREFIX = 'logiak'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# entries measured per cache (and items per container) to estimate memory, deep sizes
+# are slow and eligibility entries can hold a million ids
+MEMORY_SAMPLE = 20
+
+_LOCK = Lock()
+CACHES: Dict[str, '_Instrumented'] = {}
+CALLS: Dict[Tuple[str, str], 'Histogram'] = {}
+
+
+# # Caches
+
+class _Instrumented(object):
+    # Hits and misses are counted on lookup (`cache[key]`, as `cached` does, or `get`),
+    # not when the cache reads itself (pop, evictions). Counts are not locked, a few may
+    # be lost between threads.
+
+    def __init__(self, name: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._internal = 0
+        with _LOCK:
+            CACHES[name] = self
+
+    @contextmanager
+    def _uncounted(self):
+        self._internal += 1
+        try:
+            yield
+        finally:
+            self._internal -= 1
+
+    def __getitem__(self, key):
+        if self._internal:
+            return super().__getitem__(key)
+        try:
+            res = super().__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return res
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        self.misses += 1
+        return default
+
+    def pop(self, *args, **kwargs):
+        with self._uncounted():
+            return super().pop(*args, **kwargs)
+
+    def popitem(self):
+        if not self._internal:
+            self.evictions += 1
+        with self._uncounted():
+            return super().popitem()
+
+    def clear(self):
+        # some versions of cachetools clear with popitem
+        with self._uncounted():
+            super().clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self),
+            # in the cache's own unit, entries unless it has a getsizeof
+            'size': self.currsize,
+            'maxsize': self.maxsize,
+            'memory': approx_memory(self),
+        }
+
+
+class LRUCache(_Instrumented, cachetools.LRUCache):
+    pass
+
+
+class TTLCache(_Instrumented, cachetools.TTLCache):
+
+    def expire(self, *args, **kwargs):
+        # counted on the underlying storage, expire doesn't return them in every version
+        before = cachetools.Cache.__len__(self)
+        res = super().expire(*args, **kwargs)
+        self.expirations += before - cachetools.Cache.__len__(self)
+        return res
+
+
+def deep_size(obj, seen: set = None) -> int:
+    # bytes held by obj and what it references: containers, instance attributes and the
+    # variables closed over by functions (cached casters are closures)
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        return size + _sampled(obj.items(), len(obj), lambda kv: _pair_size(kv, seen))
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + _sampled(obj, len(obj), lambda i: deep_size(i, seen))
+    if callable(obj) and getattr(obj, '__closure__', None):
+        return size + sum(deep_size(c.cell_contents, seen) for c in obj.__closure__
+                          if _has_contents(c))
+    if hasattr(obj, '__dict__'):
+        return size + deep_size(vars(obj), seen)
+    return size
+
+
+def _pair_size(kv, seen: set) -> int:
+    # items() makes a new tuple per pair, those don't count (and their ids get reused)
+    return deep_size(kv[0], seen) + deep_size(kv[1], seen)
+
+
+def _sampled(items, count: int, size_of) -> int:
+    # the size of the first few items, scaled up to all of them
+    sample = list(islice(items, MEMORY_SAMPLE))
+    if not sample:
+        return 0
+    return int(sum(size_of(i) for i in sample) / len(sample) * count)
+
+
+def _has_contents(cell) -> bool:
+    try:
+        cell.cell_contents
+        return True
+    except ValueError:  # not bound yet
+        return False
+
+
+def approx_memory(cache: cachetools.Cache) -> int:
+    # the mean deep size of a sample of entries, times the number of entries
+    seen = set()
+    try:
+        return _sampled(cache.items(), len(cache), lambda kv: _pair_size(kv, seen))
+    except (KeyError, RuntimeError):  # changed while sampled
+        return 0
+
+
+# # Backend calls
+
+class Histogram(object):
+
+    def __init__(self, buckets: List[float] = None):
+        self.buckets = buckets or LATENCY_BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[Tuple[str, int]], float, int]:
+        # cumulative buckets, sum and count, as of the same moment
+        with self._lock:
+            counts, _sum, count = list(self.counts), self.sum, self.count
+        buckets, total = [], 0
+        for bound, n in zip([*[str(b) for b in self.buckets], '+Inf'], counts):
+            total += n
+            buckets.append((bound, total))
+        return buckets, _sum, count
+
+
+def observe_call(backend: str, op: str, seconds: float):
+    if (hist := CALLS.get((backend, op))) is None:
+        with _LOCK:
+            hist = CALLS.setdefault((backend, op), Histogram())
+    hist.observe(seconds)
+
+
+@contextmanager
+def backend_call(backend: str, op: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe_call(backend, op, perf_counter() - start)
+
+
+# # Output
+
+def _labels(**labels) -> str:
+    def _escape(v):
+        return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def render() -> str:
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    with _LOCK:
+        caches = sorted(CACHES.items())
+        calls = sorted(CALLS.items())
+    lines = []
+    stats = {name: cache.stats() for name, cache in caches}
+    for stat, kind, _help in [
+        ('hits', 'counter', 'cache lookups that found the entry'),
+        ('misses', 'counter', 'cache lookups that did not find the entry'),
+        ('evictions', 'counter', 'entries dropped to make room'),
+        ('expirations', 'counter', 'entries dropped when their TTL ran out'),
+        ('entries', 'gauge', 'entries in the cache'),
+        ('size', 'gauge', 'size of the cache, in entries unless sized otherwise'),
+        ('maxsize', 'gauge', 'maximum size of the cache'),
+        ('memory', 'gauge', 'approximate bytes held by the cache'),
+    ]:
+        metric = f'{PREFIX}_cache_{stat}' + ('_total' if kind == 'counter' else '')
+        if stat == 'memory':
+            metric = f'{PREFIX}_cache_memory_bytes'
+        lines += [f'# HELP {metric} {_help}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{_labels(cache=name)} {s[stat]}' for name, s in stats.items()]
+    metric = f'{PREFIX}_backend_call_seconds'
+    lines += [
+        f'# HELP {metric} latency of calls to Firestore and the RTDB',
+        f'# TYPE {metric} histogram'
+    ]
+    for (backend, op), hist in calls:
+        buckets, _sum, count = hist.snapshot()
+        for bound, n in buckets:
+            lines.append(f'{metric}_bucket{_labels(backend=backend, op=op, le=bound)} {n}')
+        lines.append(f'{metric}_sum{_labels(backend=backend, op=op)} {_sum}')
+        lines.append(f'{metric}_count{_labels(backend=backend, op=op)} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,183 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from math import ceil
+import os
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .query import StructuredQuery
+
+# Query planning
+'''
+RBAC means every query is over the ids the user has slots for, and there is more
+than one way to read the matching docs:
+
+- in_chunks: `uuid in [...]` queries of 10 ids with the filter, run concurrently
+- multi_get: multi-gets of the ids by path, the filter is applied here
+- intersect: a single query with only the filter (or none), streamed and intersected
+  with the eligible ids in memory
+- count: a count aggregation per `in` chunk, only for counting
+
+Each is estimated from the number of eligible ids, the size of the collection and a
+rough guess of the filter's selectivity. The cost is in document reads, a round trip
+is worth ROUND_TRIP_COST reads, and concurrent round trips only count once per wave.
+'''
+
+IN_CHUNKS = 'in_chunks'
+MULTI_GET = 'multi_get'
+INTERSECT = 'intersect'
+COUNT = 'count'
+
+# how many document reads a (sequential) round trip to CFS is worth
+ROUND_TRIP_COST = float(os.environ.get('PLAN_ROUND_TRIP_COST', 50))
+# docs a single term is assumed to match, per value for `in` / `array-contains-any`
+EQUALITY_SELECTIVITY = 0.1
+RANGE_SELECTIVITY = 1 / 3
+
+
+class Estimate(BaseModel):
+    strategy: str
+    filtered_locally: bool
+    reads: int
+    round_trips: int
+    cost: float
+
+
+class Plan(BaseModel):
+    strategy: str
+    filtered_locally: bool
+    # eligible is a lower bound if the slot listing wasn't finished when planning
+    eligible: int
+    eligible_exact: bool
+    collection: Optional[int]
+    selectivity: float
+    reads: int
+    round_trips: int
+    candidates: List[Estimate]
+
+
+def selectivity(structured_query: StructuredQuery = None) -> float:
+    # the share of docs the filter is expected to match, terms are taken as independent
+    if not structured_query or not structured_query.is_filtered():
+        return 1.0
+    res = 1.0
+    for _, op, value in structured_query.filter_terms():
+        if op in ('==', 'array-contains'):
+            res *= EQUALITY_SELECTIVITY
+        elif op in ('in', 'array-contains-any'):
+            values = len(value) if isinstance(value, list) else 1
+            res *= min(1.0, EQUALITY_SELECTIVITY * values)
+        else:
+            res *= RANGE_SELECTIVITY
+    return res
+
+
+def estimate(
+    strategy: str,
+    filtered_locally: bool,
+    eligible: int,
+    collection: Optional[int],
+    selectivity: float,
+    in_size: int,
+    batch_size: int,
+    workers: int
+) -> Estimate:
+    matched = selectivity if not filtered_locally else 1.0
+    if strategy == IN_CHUNKS:
+        round_trips = ceil(eligible / in_size)
+        # a query with no results is still billed one read
+        reads = max(ceil(eligible * matched), round_trips)
+    elif strategy == COUNT:
+        # one read per 1000 index entries counted, a chunk never has that many
+        round_trips = ceil(eligible / in_size)
+        reads = round_trips
+    elif strategy == MULTI_GET:
+        round_trips = ceil(eligible / batch_size)
+        reads = eligible
+    elif strategy == INTERSECT:
+        round_trips = 1
+        reads = max(ceil(collection * matched), 1)
+    else:
+        raise ValueError(f'Unknown strategy: {strategy}')
+    waves = round_trips if strategy == INTERSECT else ceil(round_trips / max(1, workers))
+    return Estimate(
+        strategy=strategy,
+        filtered_locally=filtered_locally,
+        reads=reads,
+        round_trips=round_trips,
+        cost=reads + ROUND_TRIP_COST * waves
+    )
+
+
+def candidates(
+    structured_query: StructuredQuery = None,
+    has_index: bool = True,
+    count: bool = False,
+    collection: Optional[int] = None,
+    intersect: bool = True
+) -> List[Tuple[str, bool]]:
+    # the (strategy, filtered_locally) pairs that can answer the query. A multi-get
+    # can't filter in CFS, and without an index nothing else can either.
+    filtered = bool(structured_query) and structured_query.is_filtered()
+    res = []
+    if has_index and (filtered or count):
+        res.append((COUNT if count else IN_CHUNKS, False))
+    res.append((MULTI_GET, filtered))
+    if intersect and collection is not None:
+        if filtered and has_index:
+            res.append((INTERSECT, False))
+        res.append((INTERSECT, filtered))
+    return res
+
+
+def plan(
+    structured_query: StructuredQuery = None,
+    eligible: int = 0,
+    eligible_exact: bool = True,
+    collection: Optional[int] = None,
+    options: List[Tuple[str, bool]] = None,
+    in_size: int = 10,
+    batch_size: int = 300,
+    workers: int = 1
+) -> Plan:
+    # the options, cheapest first, the chosen one is the first
+    options = options or [(MULTI_GET, False)]
+    _selectivity = selectivity(structured_query)
+    estimates = sorted(
+        [
+            estimate(
+                strategy, local, eligible, collection, _selectivity,
+                in_size, batch_size, workers)
+            for strategy, local in options
+        ],
+        key=lambda e: e.cost
+    )
+    best = estimates[0]
+    return Plan(
+        strategy=best.strategy,
+        filtered_locally=best.filtered_locally,
+        eligible=eligible,
+        eligible_exact=eligible_exact,
+        collection=collection,
+        selectivity=_selectivity,
+        reads=best.reads,
+        round_trips=best.round_trips,
+        candidates=estimates
+    )
@@ -17,14 +17,31 @@
 # under the License.
 
 from enum import Enum
+import heapq
 import json
-import operator
-from typing import Any, get_type_hints, List, Optional, Union
-from pydantic import BaseModel, validator
+import os
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    get_type_hints,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union
+)
+import numpy as np
+from pydantic import BaseModel, PrivateAttr, validator
 from pydantic.dataclasses import dataclass
 
 from google.cloud import firestore, firestore_v1
 
+from . import metrics
+
 # CFS Query API Implementation
 '''
 This set of classes allow the StructuredQuery Language used by the CFS REST
@@ -32,7 +49,7 @@ Interface to be accepted by the API for the purpose of filtering, ordering
 and limiting data. These queries build upon a base query which is already
 referenced to a particular datatype and filtered for the user based on the RBAC
 rules set in logiak. As such, there is no ability to set the initial path with
-CFS and the `select` directive is not accepted.
+CFS. `select` is accepted, and only narrows the fields of the documents returned.
 '''
 
 import logging
@@ -93,11 +110,21 @@ class ObjectValue:
     # # mapValue
 
     def get_value(self):
-        fields = get_type_hints(self).keys()
-        for f in fields:
+        for f in _OBJECT_VALUE_FIELDS:
             if (value := getattr(self, f)) is not None:
                 return value
 
+    def get_typed_value(self):
+        # integerValue is a string on the wire (int64) but is compared as a number
+        # against cast documents
+        if self.integerValue is not None:
+            return int(self.integerValue)
+        return self.get_value()
+
+
+# resolved once, not on every get_value
+_OBJECT_VALUE_FIELDS = tuple(get_type_hints(ObjectValue).keys())
+
 
 @dataclass
 class FieldReference:
@@ -148,6 +175,9 @@ class FieldFilter:
     def build(self, base: firestore_v1.query.Query):
         return base.where(*self.fieldFilter.format())
 
+    def terms(self) -> List[Tuple[str, str, Any]]:
+        return [tuple(self.fieldFilter.format())]
+
 
 class CompositeFilterBody(BaseModel):
     filters: List['Filter']
@@ -162,6 +192,10 @@ class CompositeFilter:
             base = filter_.build(base)
         return base
 
+    def terms(self) -> List[Tuple[str, str, Any]]:
+        # composite filters can only be AND, so they flatten to a list of terms
+        return [i for filter_ in self.compositeFilter.filters for i in filter_.terms()]
+
 
 @dataclass
 class Filter:
@@ -170,10 +204,96 @@ class Filter:
     def build(self, base: firestore_v1.query.Query):
         return self.filter.build(base)
 
+    def terms(self) -> List[Tuple[str, str, Any]]:
+        return self.filter.terms()
+
 
 CompositeFilterBody.update_forward_refs()
 
 
+# # Sorting
+
+# Logiak values are only typed once they are cast by the schema, so a field can hold
+# any of these types or be missing. Ranking on type first gives a total order over
+# mixed values, with null first as in Firestore.
+def sort_rank(value: Any) -> Tuple:
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, json.dumps(value, sort_keys=True, default=str))
+
+
+def sort_columns(values: List[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    # the same ordering as sort_rank, as a (type rank, value) pair of numeric columns.
+    # strings and other values are replaced by their dense rank within their type.
+    types = np.zeros(len(values), dtype=np.int8)
+    numbers = np.zeros(len(values), dtype=np.float64)
+    groups = {3: ([], []), 4: ([], [])}
+    for x, value in enumerate(values):
+        if value is None:
+            continue
+        elif isinstance(value, bool):
+            types[x], numbers[x] = 1, value
+        elif isinstance(value, (int, float)):
+            types[x], numbers[x] = 2, value
+        elif isinstance(value, str):
+            types[x] = 3
+            groups[3][0].append(x)
+            groups[3][1].append(value)
+        else:
+            types[x] = 4
+            groups[4][0].append(x)
+            groups[4][1].append(json.dumps(value, sort_keys=True, default=str))
+    for idx, group in groups.values():
+        if idx:
+            # object dtype, so that strings compare exactly like python strings
+            _, inverse = np.unique(np.array(group, dtype=object), return_inverse=True)
+            numbers[idx] = inverse.ravel()
+    return types, numbers
+
+
+def sort_permutation(items: List[Dict], fields: List[str], descending: List[bool]) -> np.ndarray:
+    # indices that put items in SortKey order, from a single (stable) lexsort
+    keys = []
+    for field, desc in zip(fields, descending):
+        types, numbers = sort_columns([i.get(field) for i in items])
+        if desc:
+            types, numbers = -types, -numbers
+        keys.extend([types, numbers])
+    # lexsort's primary key is the last one
+    return np.lexsort(keys[::-1]) if keys else np.arange(len(items))
+
+
+class SortKey(object):
+    # comparable key over all orderBy terms, respecting the direction of each
+
+    __slots__ = ('ranks', 'descending')
+
+    def __init__(self, values: List[Any], descending: List[bool]):
+        self.ranks = tuple([sort_rank(v) for v in values])
+        self.descending = descending
+
+    def compare(self, other: 'SortKey') -> int:
+        # only the terms both keys have are compared, so a cursor with fewer
+        # values than there are orderBy terms matches on that prefix
+        for a, b, desc in zip(self.ranks, other.ranks, self.descending):
+            if a != b:
+                res = -1 if a < b else 1
+                return -res if desc else res
+        return 0
+
+    def __lt__(self, other: 'SortKey') -> bool:
+        return self.compare(other) < 0
+
+    def __eq__(self, other: 'SortKey') -> bool:
+        return self.compare(other) == 0
+
+
 # # OrderBy
 
 @dataclass
@@ -181,10 +301,69 @@ class Order:
     field: FieldReference
     direction: SortDirection
 
-    def sort(self, items: List):
-        reverse = True if self.direction == 'DESCENDING' else False
-        items.sort(key=operator.itemgetter(self.field.fieldPath), reverse=reverse)
-        return items
+    def is_descending(self) -> bool:
+        return self.direction == 'DESCENDING'
+
+
+# # Local filtering
+
+# The same filters evaluated in python, for when CFS can't run them (no index). Values
+# only match values of the same type, which is how CFS compares them, so on documents
+# as they are stored (everything a string) the result is the same as the CFS query.
+
+def _kind(value: Any) -> int:
+    return sort_rank(value)[0]
+
+
+_COMPARE = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '==': lambda a, b: a == b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def _term_matcher(field: str, op: str, operand: Any) -> Callable[[Dict], bool]:
+    compare = _COMPARE.get(op, _COMPARE['=='])
+    operands = operand if isinstance(operand, list) else [operand]
+
+    def _matches(value: Any, other: Any) -> bool:
+        if _kind(value) != _kind(other):
+            return False
+        # arrays and maps only support equality
+        return compare(value, other) if _kind(value) < 4 or op == '==' else False
+
+    def _term(doc: Dict) -> bool:
+        if field not in doc:
+            return False
+        value = doc[field]
+        if op == 'in':
+            return any(_matches(value, x) for x in operands)
+        if op == 'array-contains':
+            return isinstance(value, list) and any(_matches(i, operand) for i in value)
+        if op == 'array-contains-any':
+            return isinstance(value, list) and any(
+                _matches(i, x) for i in value for x in operands)
+        return _matches(value, operand)
+
+    return _term
+
+
+def compile_filter(terms: Iterable[Tuple[str, str, Any]]) -> Callable[[Dict], bool]:
+    matchers = [_term_matcher(*term) for term in terms]
+
+    def _matches(doc: Dict) -> bool:
+        return all(m(doc) for m in matchers)
+
+    return _matches
+
+
+# # Projection
+
+@dataclass
+class Projection:
+    fields: List[FieldReference]
 
 
 # # StartAt / EndAt
@@ -196,48 +375,40 @@ class Cursor:
     # if true: (use start_after & end_before)
     before: bool = False
 
-    def __make_match_filter(self, orderBy: List[Order]):
-        values = [ov.get_value() for ov in self.values]
-        db = [(o.field.fieldPath, values[x])
-              for x, o in enumerate(orderBy) if (x < len(values))]
-        LOG.debug(f'cutoff: {db}')
-        getters = [operator.itemgetter(o.field.fieldPath)
-                   for x, o in enumerate(orderBy) if (x < len(values))]
-
-        def match_filter(i) -> bool:
-            res = all([fn(i) == values[x] for x, fn in enumerate(getters)])
-            return res
-
-        return match_filter
-
-    def cutoff(self, filter_, items, ascending=True) -> int:
-        for x, i in enumerate(items):
-            if filter_(i):
-                return x
-
-    def prune(self, orderBy: List[Order], items) -> List[Any]:
-        _filter = self.__make_match_filter(orderBy)
-        ascending = True if self.position == 'start' else False
-        offset = 0 if not self.before else 1
-        if not ascending:
-            offset = offset * -1
-        limit = self.cutoff(_filter, items, ascending)
-        if not isinstance(limit, int) and ascending:
-            # no matching startAt value, no start -> None
-            return []
-        if not limit and not ascending:
-            # no matching endAt value, no end -> All
-            return items
-        # valid idx can't be < 1 in this case
-        idx = max([
-            0,
-            limit + offset
-        ])
-        LOG.debug(f'{orderBy} -> {self} : @ {limit} + {offset} -> [{idx}], {ascending}')
-        if ascending:
+    def key(self, orderBy: List[Order]) -> SortKey:
+        values = [ov.get_typed_value() for ov in self.values]
+        return SortKey(values, [o.is_descending() for o in orderBy[:len(values)]])
+
+    def admits(self, doc_key: SortKey, cursor_key: SortKey) -> bool:
+        # is a document with doc_key on the included side of this cursor?
+        res = doc_key.compare(cursor_key)
+        if res == 0:
+            return not self.before
+        return res > 0 if self.position == 'start' else res < 0
+
+    def bound(self, orderBy: List[Order], items: List[Dict]) -> int:
+        # binary search of sorted items for the edge of this cursor: the first doc that
+        # is included by a start cursor, or the first doc excluded by an end cursor.
+        # The cursor values don't need to match a doc, they can fall between docs.
+        cursor = self.key(orderBy)
+        fields = [o.field.fieldPath for o in orderBy[:len(self.values)]]
+        start = self.position == 'start'
+        lo, hi = 0, len(items)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = SortKey([items[mid].get(f) for f in fields], cursor.descending)
+            if self.admits(key, cursor) == start:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def prune(self, orderBy: List[Order], items: List[Dict]) -> List[Dict]:
+        idx = self.bound(orderBy, items)
+        LOG.debug(f'{orderBy} -> {self} : @ {idx}')
+        if self.position == 'start':
             return items[idx:]
-        else:
-            return items[:idx + 1]  # +1 for slice convention
+        return items[:idx]
 
 
 @dataclass
@@ -250,13 +421,43 @@ class EndCursor(Cursor):
     position: str = 'end'
 
 
+class _Compiled(NamedTuple):
+    # the parts of a query that are read for every chunk and every doc, as plain tuples
+    filters: Tuple[Tuple[str, str, Any], ...]
+    matches: Callable[[Dict], bool]
+    shape: Tuple[Tuple[str, str], ...]
+    sort_fields: Tuple[str, ...]
+    descending: Tuple[bool, ...]
+    selected: Optional[Tuple[str, ...]]
+
+
 class StructuredQuery(BaseModel):
+    select: Optional[Projection] = None
     where: Optional[Filter] = None
     orderBy: Optional[List[Order]] = None
     startAt: Optional[StartCursor] = None
     endAt: Optional[EndCursor] = None
-    limit: int = None
-    offset: int = None
+    limit: Optional[int] = None
+    offset: Optional[int] = None
+
+    # derived from select, where and orderBy only, so copies that update
+    # limit / offset can share it
+    _compiled: _Compiled = PrivateAttr()
+    # evaluate `where` in python instead of in CFS, see filtered_locally
+    _local: bool = PrivateAttr(default=False)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        terms = tuple(self.where.terms()) if self.where else ()
+        orders = self.orderBy or []
+        self._compiled = _Compiled(
+            filters=terms,
+            matches=compile_filter(terms),
+            shape=tuple(sorted({(f, op) for f, op, _ in terms})),
+            sort_fields=tuple([o.field.fieldPath for o in orders] + ['uuid']),
+            descending=tuple([o.is_descending() for o in orders] + [False]),
+            selected=tuple(f.fieldPath for f in self.select.fields) if self.select else None
+        )
 
     @validator('startAt')
     def is_ordered_sa(cls, v, values):
@@ -270,30 +471,187 @@ class StructuredQuery(BaseModel):
             'endAt depends on orderBy'
         return v
 
+    @validator('select')
+    def has_fields(cls, v):
+        assert(v is None or v.fields), 'select needs at least one field'
+        return v
+
     @validator('limit')
-    def nonop_limit(cls, v):
-        assert False, 'limit is not Implemented'
+    def positive_limit(cls, v):
+        assert(v is None or v >= 0), 'limit must be >= 0'
+        return v
 
     @validator('offset')
-    def nonop_offset(cls, v):
-        assert False, 'offset is not Implemented, use startAt / endAt'
+    def positive_offset(cls, v):
+        assert(v is None or v >= 0), 'offset must be >= 0'
+        return v
 
     def filter(self, base: firestore_v1.query.Query):
-        if self.where:
-            return self.where.build(base)
+        if self._local:
+            return base
+        for term in self._compiled.filters:
+            base = base.where(*term)
         return base
 
+    def matches(self, doc: Dict) -> bool:
+        # `where` on a document as stored in CFS
+        return self._compiled.matches(doc)
+
+    def filtered_locally(self) -> 'StructuredQuery':
+        # a copy whose filter is left out of the CFS queries, for the caller to apply
+        # with `matches` instead
+        res = self.copy()
+        res._local = True
+        return res
+
+    def is_filtered_locally(self) -> bool:
+        return self._local and self.is_filtered()
+
+    def filter_fields(self) -> List[str]:
+        return list(dict.fromkeys(f for f, _, _ in self._compiled.filters))
+
+    def filter_terms(self) -> Tuple[Tuple[str, str, Any], ...]:
+        # the filter as (field, operator, value) terms, all of which must match
+        return self._compiled.filters
+
+    def key_values(self, doc: Dict) -> List[Any]:
+        # the values of the sort key terms for a doc, see sort_key
+        return [doc.get(f) for f in self._compiled.sort_fields]
+
+    def key_from_values(self, values: List[Any]) -> SortKey:
+        return SortKey(values, list(self._compiled.descending))
+
+    def stop(self) -> Optional[int]:
+        # index after the last doc we need, counted before the offset is dropped
+        if self.limit is None:
+            return None
+        return (self.offset or 0) + self.limit
+
+    def window(self, chunks: Iterable[List]) -> Iterator[List]:
+        # applies offset / limit to an unordered stream of chunks, and stops pulling
+        # chunks as soon as we have enough, so the remaining queries are never issued.
+        skip = self.offset or 0
+        remaining = self.limit
+        if remaining == 0:
+            return
+        for items in chunks:
+            if skip:
+                dropped = min(skip, len(items))
+                items = items[dropped:]
+                skip -= dropped
+            if remaining is not None:
+                items = items[:remaining]
+                remaining -= len(items)
+            if items:
+                yield items
+            if remaining == 0:
+                return
+
+    def is_filtered(self):
+        return self.where is not None
+
+    def filter_shape(self) -> Tuple[Tuple[str, str], ...]:
+        # the (field, operator) pairs of the filter without their values, which is all
+        # that decides whether CFS has the index it needs
+        return self._compiled.shape
+
+    def selected_fields(self) -> Optional[List[str]]:
+        # None is all of them
+        if (selected := self._compiled.selected) is not None:
+            return list(selected)
+
+    def needed_fields(self) -> Optional[List[str]]:
+        # the selection, plus the fields the order (and cursors) depend on
+        if (selected := self.selected_fields()) is None:
+            return None
+        return list(dict.fromkeys(selected + self.sort_terms()[0]))
+
+    def project(self, doc: Dict) -> Dict:
+        if (selected := self._compiled.selected) is None:
+            return doc
+        return {k: doc[k] for k in selected if k in doc}
+
     def is_ordered(self):
         return self.orderBy is not None
 
-    def order(self, items: List):
-        if self.orderBy:
-            for term in reversed(self.orderBy):
-                items = term.sort(items)
+    def sort_terms(self) -> Tuple[List[str], List[bool]]:
+        # the uuid is always the last term so that every doc has a distinct position
+        return list(self._compiled.sort_fields), list(self._compiled.descending)
+
+    def sort(self, items: List[Dict]) -> List[Dict]:
+        # sorts in the same order as sort_key, but in one numpy pass
+        if len(items) < 2:
+            return list(items)
+        return [items[x] for x in sort_permutation(items, *self.sort_terms())]
+
+    def sort_key(self) -> Callable[[Dict], SortKey]:
+        fields, descending = self.sort_terms()
+
+        def _key(doc: Dict) -> SortKey:
+            return SortKey([doc.get(f) for f in fields], descending)
+
+        return _key
+
+    def _trim(self, items: List[Dict]) -> List[Dict]:
+        # cuts sorted items down to the range between the cursors
         if self.startAt:
-            LOG.debug('-> startAt')
             items = self.startAt.prune(self.orderBy, items)
         if self.endAt:
-            LOG.debug('-> endAt')
             items = self.endAt.prune(self.orderBy, items)
         return items
+
+    def top(self, streams: Iterable[List[Dict]], after: SortKey = None) -> List[Dict]:
+        # for limited ordered queries we don't need to keep everything to sort it,
+        # only a bounded heap of the best offset + limit docs seen so far, and the
+        # streams can be consumed as they arrive. If `after` is set, only docs that
+        # sort strictly after it are considered (paging).
+        _key = self.sort_key()
+        start = self.startAt.key(self.orderBy) if self.startAt else None
+        end = self.endAt.key(self.orderBy) if self.endAt else None
+
+        def _candidates():
+            for x, stream in enumerate(streams):
+                for y, doc in enumerate(stream):
+                    key = _key(doc)
+                    if start and not self.startAt.admits(key, start):
+                        continue
+                    if end and not self.endAt.admits(key, end):
+                        continue
+                    if after and not after < key:
+                        continue
+                    yield (key, x, y, doc)
+
+        if not self.stop():
+            return []
+        best = heapq.nsmallest(self.stop(), _candidates())
+        return [i[-1] for i in best[self.offset or 0:]]
+
+    def order(self, items: List) -> List:
+        # sorts everything at once, then cuts it to the cursors and offset / limit
+        if self.orderBy:
+            items = self.sort(items)
+        return self._trim(items)[self.offset or 0:self.stop()]
+
+
+# # Parsing
+
+# Clients tend to send the same few queries over and over, so validated queries are
+# kept by their canonical json. They're shared, so never mutate one (use .copy).
+PARSE_CACHE = metrics.LRUCache(
+    'query_parse', maxsize=int(os.environ.get('QUERY_PARSE_CACHE_SIZE', 256)))
+_PARSE_LOCK = Lock()
+
+
+def parse_query(body: Dict) -> StructuredQuery:
+    # raises the same validation errors as StructuredQuery(**body)
+    try:
+        key = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    except TypeError:  # not plain json, can't be keyed
+        return StructuredQuery(**body)
+    with _PARSE_LOCK:
+        if (res := PARSE_CACHE.get(key)) is not None:
+            return res
+    res = StructuredQuery(**body)
+    with _PARSE_LOCK:
+        PARSE_CACHE[key] = res
+    return res
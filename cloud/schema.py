@@ -24,11 +24,11 @@ import logging
 import operator
 from typing import Callable, Dict, List
 
-from cachetools import cached, LRUCache
+from cachetools import cached
 from cachetools.keys import hashkey
 from spavro.schema import SchemaParseException
 
-from . import fb_utils
+from . import fb_utils, metrics
 
 
 LOG = logging.getLogger('SCHEMA')
@@ -119,7 +119,7 @@ def strip_banned_from_schema(schema: Dict, type: SchemaType):
 
 
 # not recursive so doesn't work on nested schemas, but neither does logiak
-@cached(LRUCache(maxsize=100), key=key_ignore_db)
+@cached(metrics.LRUCache('schema_caster', maxsize=100), key=key_ignore_db)
 def schema_caster(rtdb: fb_utils.RTDB, schema_name: str, version: str) -> Callable[[Dict], Dict]:
     # have to import here to avoid circular reference in meta
     from .meta import _meta_schema, _meta_info
@@ -154,7 +154,7 @@ def cast_values_to_string(msg: Dict):
     return {k: str(v) if v is not None else '' for k, v in msg.items()}
 
 
-@cached(LRUCache(maxsize=3), key=key_ignore_db)
+@cached(metrics.LRUCache('msg_stripper', maxsize=3), key=key_ignore_db)
 def msg_stripper(_type: SchemaType):
     list_ = _SCHEMA_REMOVE[_type]
 
@@ -176,7 +176,7 @@ def schema_filter(_type: SchemaType):
     return _is_allowed
 
 
-@cached(LRUCache(maxsize=3))
+@cached(metrics.LRUCache('schema_stripper', maxsize=3))
 def schema_stripper(_type: SchemaType):
     allow = schema_filter(_type)
 
@@ -186,7 +186,7 @@ def schema_stripper(_type: SchemaType):
     return _stripper
 
 
-@cached(LRUCache(maxsize=128), key=key_ignore_db)
+@cached(metrics.LRUCache('schema_flag_extras', maxsize=128), key=key_ignore_db)
 def schema_flag_extras(rtdb: fb_utils.RTDB, schema_name, schema_version) -> Callable:
     from .meta import _meta_schema
     schema = _meta_schema(rtdb, schema_version, schema_name, SchemaType.ALL)
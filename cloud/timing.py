@@ -0,0 +1,189 @@
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import json
+import logging
+import os
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+# Request timing
+'''
+Spans (named phases of a request: session, eligible, validate, fetch, cast, encode...)
+and counters (cfs_reads, rtdb_gets) are added up per request, in the Timings bound to
+the current context. Outside of a request nothing is bound and everything here is a
+no-op. Work handed to other threads (see utils.fan_out and utils.prefetch) is bound to
+the same Timings with `bind`, so concurrent spans add up to more than the wall time.
+
+The totals go out as a Server-Timing header, and for streamed responses, where most
+of the work happens after the headers are sent, as a log record once the body is done.
+'''
+
+LOG = logging.getLogger('TIMING')
+LOG.setLevel(logging.DEBUG)
+
+REQUEST_TIMING = os.environ.get('REQUEST_TIMING', 'true').lower() == 'true'
+SERVER_TIMING_HEADER = 'Server-Timing'
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.spans: Dict[str, list] = {}  # name -> [seconds, calls]
+        self.counts: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += seconds
+            span[1] += 1
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+    def header(self) -> str:
+        # https://www.w3.org/TR/server-timing/ durations in ms, counts as descriptions
+        with self._lock:
+            spans = [f'{k};dur={v[0] * 1000:.1f}' for k, v in self.spans.items()]
+            counts = [f'{k};desc={v}' for k, v in self.counts.items()]
+        return ', '.join([*spans, *counts, f'total;dur={self.elapsed() * 1000:.1f}'])
+
+    def record(self) -> Dict:
+        with self._lock:
+            return {
+                'total_ms': round(self.elapsed() * 1000, 1),
+                'spans': {
+                    k: {'ms': round(v[0] * 1000, 1), 'calls': v[1]}
+                    for k, v in self.spans.items()
+                },
+                'counts': dict(self.counts)
+            }
+
+
+_TIMINGS: ContextVar[Optional[Timings]] = ContextVar('timings', default=None)
+
+
+def current() -> Optional[Timings]:
+    return _TIMINGS.get()
+
+
+@contextmanager
+def request():
+    # binds new Timings for the duration, unless timing is off or already bound
+    if not REQUEST_TIMING or _TIMINGS.get() is not None:
+        yield None
+        return
+    timings = Timings()
+    token = _TIMINGS.set(timings)
+    try:
+        yield timings
+    finally:
+        _TIMINGS.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    if (timings := _TIMINGS.get()) is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, perf_counter() - start)
+
+
+def timed(name: str) -> Callable:
+    # decorator, a span around each call. Cheap enough to wrap per document work.
+    def _decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def _timed(*args, **kwargs):
+            if (timings := _TIMINGS.get()) is None:
+                return fn(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings.add(name, perf_counter() - start)
+        return _timed
+    return _decorator
+
+
+def count(name: str, n: int = 1):
+    if (timings := _TIMINGS.get()) is not None:
+        timings.count(name, n)
+
+
+def bind(fn: Callable) -> Callable:
+    # fn, to run on another thread against the Timings of the calling context
+    if (timings := _TIMINGS.get()) is None:
+        return fn
+
+    @wraps(fn)
+    def _bound(*args, **kwargs):
+        token = _TIMINGS.set(timings)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _TIMINGS.reset(token)
+    return _bound
+
+
+def timed_iter(name: str, iterable: Iterable) -> Iterator:
+    # a span around fetching each item, not around what the consumer does with it
+    if _TIMINGS.get() is None:
+        yield from iterable
+        return
+    items = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+
+def trailing(body: Iterable, timings: Timings, label: str) -> Iterator:
+    # Iterates a streamed response body with the request's Timings bound, the WSGI
+    # server does so long after the handler returned. The totals are logged at the end.
+    items = iter(body)
+    try:
+        while True:
+            token = _TIMINGS.set(timings)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                _TIMINGS.reset(token)
+            yield item
+    finally:
+        if hasattr(items, 'close'):
+            items.close()
+        LOG.info(f'{label} {json.dumps(timings.record(), sort_keys=True)}')
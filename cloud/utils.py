@@ -18,7 +18,17 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from typing import List
+import base64
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import hmac
+import json
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+from . import timing
 
 
 def escape_email(s):
@@ -51,8 +61,108 @@ def path_stripper(to_exclude: List):
     return _fn
 
 
-def chunk(obj, size):
-    n = max(1, size)
-    return (
-        obj[i:i + size] for i in range(0, len(obj), n)
-    )
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    # lists of up to size items, from iterators of unknown length too
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fan_out(fn: Callable, items: Iterable, workers: int, ordered: bool = False) -> Iterator[Any]:
+    # calls fn on each item from a pool of at most `workers` threads and yields the
+    # results as they complete, or in input order if `ordered`. Items are pulled lazily
+    # so that no more than `workers` calls are ever in flight, and closing the generator
+    # early cancels anything that has not started yet.
+    workers = max(1, workers)
+    # the calls count towards the request that made them
+    fn = timing.bind(fn)
+    items = iter(items)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    def _next_done():
+        if ordered:
+            return [pending.popleft()]
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+        return done
+
+    try:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) < workers:
+                continue
+            for future in _next_done():
+                yield future.result()
+        while pending:
+            for future in _next_done():
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def prefetch(iterable: Iterable, maxsize: int) -> Iterator[Any]:
+    # iterates `iterable` on a background thread, keeping up to `maxsize` items
+    # buffered ahead of the consumer, so a slow producer (paged IO) overlaps with the
+    # consumer's own work. Errors are re-raised in the consumer, and closing the
+    # generator early stops the producer at its next item.
+    queue = Queue(maxsize=max(1, maxsize))
+    stop = Event()
+    end = object()
+
+    def _put(msg) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(msg, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+            _put((end, None))
+        except Exception as err:
+            _put((end, err))
+
+    Thread(target=timing.bind(_produce), daemon=True).start()
+    try:
+        while True:
+            item, err = queue.get()
+            if err:
+                raise err
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def sign_token(payload: Dict, secret: bytes) -> str:
+    # opaque, tamper proof token: base64(json).signature
+    body = base64.urlsafe_b64encode(
+        json.dumps(payload, sort_keys=True, default=str).encode('utf-8'))
+    signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return f'{body.decode("ascii")}.{signature}'
+
+
+def read_token(token: str, secret: bytes) -> Dict:
+    try:
+        body, signature = token.encode('ascii').rsplit(b'.', 1)
+        expected = hmac.new(secret, body, hashlib.sha256).hexdigest().encode('ascii')
+        if hmac.compare_digest(signature, expected):
+            return json.loads(base64.urlsafe_b64decode(body))
+    except (AttributeError, ValueError, UnicodeError):
+        pass
+    raise ValueError('Invalid token')
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2020 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+import json
+import os
+import random
+import shutil
+import sys
+from types import GeneratorType
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from uuid import UUID
+
+from cloud.utils import escape_email
+
+# Synthetic mock data
+'''
+Writes a mock project in the layout of download_mock_data.py, scaled up from a source
+project (mock/lomis by default). The meta files are copied, documents are generated
+from the Avro schemas of the default version, with every value string-encoded the way
+Logiak stores it:
+
+- text: a value seen in the source for that field, or a unique value if the field is
+  marked unique (or the doc id for `uuid`)
+- number / date: uniform over the range seen in the source
+- boolean: 'true' / 'false' as often as in the source
+
+Fields the source docs carry outside of the schema (apk_version_*, slot) are sampled
+too. Users get slots with skewed eligibility: the user ranked `r` can see
+`max_share / r ** skew` of each type (at least one doc), picked at random.
+
+    python generate_mock_data.py /tmp/lomis-100k --docs 100000 --users 200
+    python benchmark.py --data /tmp/lomis-100k
+
+Output is deterministic for a given seed, and streamed, so 1M docs fit in memory.
+'''
+
+META_FILES = ['app-info.json', 'app.json', 'inits.json', 'schemas.json']
+USER_EMAIL = 'user-{x:05d}@example.org'
+# values in Logiak timestamps, when the source has none for a field
+DEFAULT_DATES = (1577836800000, 1640995200000)  # 2020 - 2021
+DEFAULT_NUMBERS = (0.0, 1000.0)
+
+
+def _load(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def _decimals(value: str) -> int:
+    return min(len(value.split('.')[1]), 6) if '.' in value else 0
+
+
+def _as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# # Values
+
+def _field_maker(field: Dict, pool: List) -> Callable[[int, str, random.Random], Any]:
+    # returns fn(index, doc_id, rng) -> string-encoded value, for one schema field
+    name = field['name']
+    _type = [t for t in field['type'] if t != 'null'][0] if isinstance(
+        field['type'], list) else field['type']
+    unique = field.get('@logiak', {}).get('unique') == 'true'
+    if name == 'uuid':
+        return lambda x, _id, rng: _id
+    if _type in ('long', 'double', 'int', 'float'):
+        numbers = [n for n in (_as_float(v) for v in pool) if n is not None]
+        if _type == 'long':
+            lo, hi = (int(min(numbers)), int(max(numbers))) if numbers else DEFAULT_DATES
+            return lambda x, _id, rng: str(rng.randint(lo, hi))
+        lo, hi = (min(numbers), max(numbers)) if numbers else DEFAULT_NUMBERS
+        decimals = max([_decimals(str(v)) for v in pool] or [1])
+        return lambda x, _id, rng: str(float(round(rng.uniform(lo, hi), decimals)))
+    if _type == 'boolean':
+        share = sum(1 for v in pool if v == 'true') / len(pool) if pool else 0.5
+        return lambda x, _id, rng: 'true' if rng.random() < share else 'false'
+    if unique:
+        if pool and all(isinstance(v, str) and v.isdigit() for v in pool):
+            width = max(len(v) for v in pool)
+            return lambda x, _id, rng: f'{x:0{width}d}'
+        return lambda x, _id, rng: _uuid(rng)
+    if pool:
+        return lambda x, _id, rng: rng.choice(pool)
+    return lambda x, _id, rng: f'{name}-{rng.randrange(100)}'
+
+
+def doc_maker(
+    schema: Dict,
+    source_docs: List[Dict],
+    version: str,
+    seed: int
+) -> Callable[[int, str], Dict]:
+    # returns fn(index, doc_id) -> doc for one type. Every doc draws from its own random
+    # generator, so the same doc comes out wherever (and however often) it's made.
+    pools = defaultdict(list)
+    for doc in source_docs:
+        for k, v in doc.items():
+            pools[k].append(v)
+    makers = {}
+    for field in schema['fields']:
+        if field['name'] in ('version_created', 'version_modified'):
+            makers[field['name']] = lambda x, _id, rng: version
+        else:
+            makers[field['name']] = _field_maker(field, pools[field['name']])
+    extras = {k: v for k, v in pools.items() if k not in makers}
+
+    def _make(x: int, _id: str) -> Dict:
+        rng = random.Random(f'{seed}/{_id}')
+        return {
+            **{k: rng.choice(v) for k, v in extras.items()},
+            **{k: fn(x, _id, rng) for k, fn in makers.items()}
+        }
+    return _make
+
+
+# # Output
+
+def _write(f, node):
+    # generators of (key, value) are streamed as objects, anything else is dumped
+    if not isinstance(node, GeneratorType):
+        f.write(json.dumps(node))
+        return
+    f.write('{')
+    for x, (k, v) in enumerate(node):
+        f.write(',\n' if x else '\n')
+        f.write(f'{json.dumps(k)}: ')
+        _write(f, v)
+    f.write('}')
+
+
+def write_json(path: str, node):
+    with open(path, 'w') as f:
+        _write(f, node)
+        f.write('\n')
+
+
+def _items(keys, fn: Callable) -> Iterator[Tuple[str, Any]]:
+    return ((k, fn(k)) for k in keys)
+
+
+# # Project
+
+def split_docs(total: int, weights: Dict[str, int]) -> Dict[str, int]:
+    # docs per type, in the proportions of the source (at least one each)
+    whole = sum(weights.values()) or 1
+    return {t: max(1, round(total * w / whole)) for t, w in weights.items()}
+
+
+def eligible_counts(users: int, docs: int, skew: float, max_share: float) -> List[int]:
+    return [max(1, min(docs, round(docs * max_share / (r + 1) ** skew))) for r in range(users)]
+
+
+def generate(args) -> Dict:
+    rng = random.Random(args.seed)
+    src, dst = args.source, args.output
+    os.makedirs(f'{dst}/meta', exist_ok=True)
+    os.makedirs(f'{dst}/data', exist_ok=True)
+    info = _load(f'{src}/meta/app-info.json')
+    version = info['defaultVersion']
+    for name in META_FILES:
+        if name != 'inits.json':
+            shutil.copyfile(f'{src}/meta/{name}', f'{dst}/meta/{name}')
+    schemas = {k: json.loads(v) for k, v in _load(f'{src}/meta/schemas.json').items()}
+    source = _load(f'{src}/data/data.json').get('data', {})
+    types = args.types.split(',') if args.types else sorted(source)
+    for _type in types:
+        if _type not in schemas:
+            raise ValueError(f'No schema for {_type} in {src}')
+    counts = split_docs(args.docs, {t: len(source.get(t) or {}) or 1 for t in types})
+    ids = {t: [_uuid(rng) for _ in range(n)] for t, n in counts.items()}
+    makers = {
+        t: doc_maker(schemas[t], list((source.get(t) or {}).values()), version, args.seed)
+        for t in types
+    }
+
+    def _docs(_type):
+        make = makers[_type]
+        return (
+            (_id, make(x, _id)) for x, _id in enumerate(ids[_type])
+        )
+
+    write_json(
+        f'{dst}/data/data.json',
+        _items(['data'], lambda _: _items(types, _docs))
+    )
+
+    # slots, with every user's eligible ids for each type
+    emails = [USER_EMAIL.format(x=x) for x in range(args.users)]
+    shares = {
+        t: eligible_counts(args.users, n, args.skew, args.max_share)
+        for t, n in counts.items()
+    }
+    now = str(args.timestamp)
+
+    def _slots(x):
+        user = escape_email(emails[x])
+        slot = {'modified': now, 'modifiedBy': user}
+        return (
+            user,
+            _items(['data'], lambda _: _items(types, lambda t: _items(
+                sorted(rng.sample(ids[t], shares[t][x])), lambda _: slot)))
+        )
+
+    write_json(
+        f'{dst}/data/slots.json',
+        _items(['slots'], lambda _: (_slots(x) for x in range(args.users)))
+    )
+
+    # a CREATE in the tx log for a share of the docs, the same doc as in data.json
+    tx = defaultdict(dict)
+    for _type in types:
+        make = makers[_type]
+        for x, _id in enumerate(ids[_type]):
+            if rng.random() >= args.tx:
+                continue
+            doc = make(x, _id)
+            ts = int(doc.get('created') or now)
+            day = datetime.fromtimestamp(ts / 1000, timezone.utc).strftime('%Y-%m-%d')
+            tx[day][f'{ts}-{_id}'] = {
+                **doc,
+                '_table': _type,
+                '_operation': 'CREATE',
+                '_syncTime': ts,
+                '_syncTimestamp': ts,
+            }
+    write_json(f'{dst}/data/tx.json', {'tx': tx})
+
+    template = next(iter(_load(f'{src}/meta/inits.json').values()))
+    write_json(f'{dst}/meta/inits.json', {
+        escape_email(email): {**template, 'email': email, 'managedUuid': _uuid(rng)}
+        for email in emails
+    })
+    return {
+        'app_id': info['uuid'],
+        'docs': counts,
+        'users': args.users,
+        'eligible': {t: [s[0], s[-1]] for t, s in shares.items()},
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Generates a scaled up mock project')
+    parser.add_argument('output', help='folder to write the project to')
+    parser.add_argument('--source', default='mock/lomis', help='project to scale [mock/lomis]')
+    parser.add_argument('--docs', type=int, default=10000, help='docs in total, over all types')
+    parser.add_argument('--types', help='comma separated types [those in the source data]')
+    parser.add_argument('--users', type=int, default=100, help='users with slots')
+    parser.add_argument(
+        '--skew', type=float, default=1.0, help='eligibility falls as 1 / rank ** skew')
+    parser.add_argument(
+        '--max-share', type=float, default=0.5, help='share of docs the top user sees')
+    parser.add_argument('--tx', type=float, default=0.1, help='share of docs in the tx log')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--timestamp', type=int, default=DEFAULT_DATES[1],
+        help='Logiak timestamp (ms) of the slots, and of docs without `created`')
+    args = parser.parse_args(argv)
+    res = generate(args)
+    print(json.dumps(res, indent=2), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,8 @@ def all(text):
         return main._meta(request)
     if text.startswith('data'):
         return main._data(request)
+    if text.startswith('metrics'):
+        return main._metrics(request)
 
 
 # Add function loggers to the main Flask Logger
@@ -41,3 +41,7 @@ def _meta(request):
 
 def _data(request):
     return endpoints.handle_data(request)
+
+
+def _metrics(request):
+    return endpoints.handle_metrics(request)
@@ -37,7 +37,7 @@ from google.auth.credentials import AnonymousCredentials
 from google.cloud.firestore_v1.client import Client as CFS_Client
 
 
-from test.app.cloud import fb_utils
+from test.app.cloud import fb_memory, fb_utils
 
 from test.app.cloud.auth import AuthHandler
 from test.app.cloud.utils import escape_email, escape_version
@@ -61,6 +61,9 @@ _rtdb_options = {
 
 FIREBASE_APP = None
 
+# FIREBASE_BACKEND=memory runs the integration tests without the emulator
+MEMORY_BACKEND = os.environ.get('FIREBASE_BACKEND') == 'memory'
+
 
 class MockPostRequest(object):
     def __init__(self, path='/', form=None, headers=None, json=None):
@@ -104,17 +107,23 @@ def fb_app(rtdb_options):
 # @pytest.mark.integration
 @pytest.fixture(scope='session')
 def rtdb(fb_app):
-    yield fb_utils.RTDB(fb_app)
+    if MEMORY_BACKEND:
+        yield fb_memory.MemoryRTDB()
+    else:
+        yield fb_utils.RTDB(fb_app)
 
 
 @pytest.mark.integration
 @pytest.fixture(scope='session')
 def cfs():
-    yield fb_utils.Firestore(
-        instance=CFS_Client(
-            project_name,
-            credentials=AnonymousCredentials()
-        ))
+    if MEMORY_BACKEND:
+        yield fb_memory.MemoryFirestore()
+    else:
+        yield fb_utils.Firestore(
+            instance=CFS_Client(
+                project_name,
+                credentials=AnonymousCredentials()
+            ))
 
 
 def get_local_session(self):
@@ -19,13 +19,21 @@
 # under the License.
 
 from flask import Response
+import gzip
+from io import BytesIO
 import json
+import operator
 import os
 import pytest
+from unittest.mock import patch
 
+import msgpack
+from google.api_core.exceptions import FailedPrecondition
 from pydantic.error_wrappers import ValidationError as PydanticValidationError
+import spavro.datafile
+import spavro.io
 
-from test.app.cloud import meta, data, auth, schema
+from test.app.cloud import meta, data, auth, formats, metrics, planner, schema, timing
 from test.app.cloud.query import StructuredQuery
 
 from test.app.cloud.auth import require_auth
@@ -192,6 +200,45 @@ def test__meta_resolution(rtdb, path, status_code):  # noqa
     assert(res.status_code == status_code)
 
 
+@pytest.mark.integration
+def test__meta_compressed(rtdb):  # noqa
+    path = f'meta/app/{TEST_APP_VERSION}/{TEST_APP_LANG}'.split('/')
+    plain = meta.resolve(path, rtdb)
+    assert('Content-Encoding' not in plain.headers)
+    res = meta.resolve(path, rtdb, {'Accept-Encoding': 'gzip'})
+    assert(res.status_code == 200)
+    assert(res.headers['Content-Encoding'] == 'gzip')
+    assert(gzip.decompress(res.get_data()) == plain.get_data())
+    assert(len(res.get_data()) < len(plain.get_data()))
+    # compressed once, then served from the cache
+    with patch.object(meta.compression, 'compress') as _compress:
+        again = meta.resolve(path, rtdb, {'Accept-Encoding': 'gzip'})
+        assert(not _compress.called)
+    assert(again.get_data() == res.get_data())
+
+
+@pytest.mark.integration
+def test__meta_etag(rtdb):  # noqa
+    path = f'meta/app/{TEST_APP_VERSION}/{TEST_APP_LANG}'.split('/')
+    res = meta.resolve(path, rtdb)
+    etag = res.get_etag()[0]
+    assert(etag)
+    res = meta.resolve(path, rtdb, {'Accept-Encoding': 'gzip'})
+    assert(res.get_etag()[0] == f'{etag}-gzip')
+    for headers in [
+        {'If-None-Match': f'"{etag}"'},
+        {'If-None-Match': f'"{etag}-gzip"', 'Accept-Encoding': 'gzip'},
+    ]:
+        with patch.object(meta.json, 'dumps') as _dumps:
+            res = meta.resolve(path, rtdb, headers)
+            assert(not _dumps.called)
+        assert(res.status_code == 304)
+        assert(not res.get_data())
+        assert('Content-Encoding' not in res.headers)
+    res = meta.resolve(path, rtdb, {'If-None-Match': '"other"'})
+    assert(res.status_code == 200)
+
+
 @pytest.mark.integration
 def test__meta_info(rtdb):  # noqa
     res = meta._meta_info(rtdb)
@@ -248,6 +295,43 @@ def test__data_eligible_doc(cfs):  # noqa
         _id))
 
 
+@pytest.mark.integration
+def test__data_eligibility_cache(rtdb, cfs):  # noqa
+    data.ELIGIBILITY_CACHE.clear()
+    _ids = data._eligible_docs(
+        cfs,
+        TEST_USER,
+        TEST_OBJECT_TYPE)
+    assert(list(_ids) == sorted(_ids))
+    assert((TEST_USER, TEST_OBJECT_TYPE) in data.ELIGIBILITY_CACHE)
+    # served from memory
+    with patch.object(cfs, 'ref', side_effect=RuntimeError), \
+            patch.object(cfs, 'list', side_effect=RuntimeError):
+        assert(data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE) == _ids)
+        assert(data._is_eligible(cfs, TEST_USER, TEST_OBJECT_TYPE, _ids[-1]))
+        assert(not data._is_eligible(cfs, TEST_USER, TEST_OBJECT_TYPE, 'missing'))
+    # writes invalidate the user's entry for the type
+    res = data.write_docs(rtdb, cfs, [{}], TEST_OBJECT_TYPE, TEST_USER)
+    assert(res.status_code == 400)
+    assert((TEST_USER, TEST_OBJECT_TYPE) in data.ELIGIBILITY_CACHE)
+    doc = json.loads(data._get(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _ids[0]))
+    doc = schema.strip_banned_from_msg(rtdb, doc, TEST_OBJECT_TYPE, schema.SchemaType.WRITE)
+    res = data.write_docs(rtdb, cfs, [doc], TEST_OBJECT_TYPE, TEST_USER)
+    assert(res.status_code == 201), res.data
+    assert((TEST_USER, TEST_OBJECT_TYPE) not in data.ELIGIBILITY_CACHE)
+
+
+@pytest.mark.integration
+def test__data_eligible_stream(cfs):  # noqa
+    data.ELIGIBILITY_CACHE.clear()
+    with patch.object(data, 'SLOT_PAGE_SIZE', 10):
+        streamed = list(data._eligible_stream(cfs, TEST_USER, TEST_OBJECT_TYPE))
+    assert(len(streamed) == TEST_ELIGIBLE_OF_TYPE)
+    # a full pass fills the eligibility cache
+    assert(data.ELIGIBILITY_CACHE[(TEST_USER, TEST_OBJECT_TYPE)] == tuple(sorted(streamed)))
+    assert(sorted(data._eligible_stream(cfs, TEST_USER, TEST_OBJECT_TYPE)) == sorted(streamed))
+
+
 @pytest.mark.integration
 def test__data_get_single_doc(rtdb, cfs):  # noqa
     _ids = data._eligible_docs(
@@ -265,6 +349,62 @@ def test__data_get_single_doc(rtdb, cfs):  # noqa
     assert(doc['uuid'] in _ids)
 
 
+@pytest.mark.integration
+def test__data_read_etag(rtdb, cfs):  # noqa
+    _id = data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE)[0]
+    path = f'data/{TEST_OBJECT_TYPE}/read/{_id}'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb)
+    assert(res.status_code == 200)
+    etag, weak = res.get_etag()
+    assert(etag and not weak)
+    # the representation changes with the format
+    other = data.resolve(TEST_USER, path, cfs, rtdb, None, {'Accept': 'application/msgpack'})
+    assert(other.get_etag()[0] != etag)
+
+    with patch.object(data, 'clean_msg') as _cast:
+        for match in [f'"{etag}"', f'W/"{etag}"', f'"other", "{etag}-gzip"']:
+            res = data.resolve(TEST_USER, path, cfs, rtdb, None, {'If-None-Match': match})
+            assert(res.status_code == 304), match
+            assert(res.get_etag()[0] == etag)
+            assert(not res.get_data())
+        assert(not _cast.called)
+
+    res = data.resolve(TEST_USER, path, cfs, rtdb, None, {'If-None-Match': '"other"'})
+    assert(res.status_code == 200)
+    # not eligible -> still not found
+    res = data.resolve(TEST_USER_2, path, cfs, rtdb, None, {'If-None-Match': f'"{etag}"'})
+    assert(res.status_code == 404)
+
+
+@pytest.mark.integration
+def test__data_bulk_read(rtdb, cfs):  # noqa
+    _ids = list(data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE))
+    other = [
+        i for i in data._eligible_docs(cfs, TEST_USER_2, TEST_OBJECT_TYPE)
+        if i not in _ids
+    ]
+    requested = _ids[::-1] + ['not-a-doc', _ids[0]] + other[:2]
+    path = f'data/{TEST_OBJECT_TYPE}/read'.split('/')
+    expected = [data._read(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, i) for i in requested]
+    assert(len([i for i in expected if i]) == TEST_AVAILABLE_OF_TYPE + 1)
+    for cached in [True, False]:
+        if not cached:
+            data.ELIGIBILITY_CACHE.clear()
+        res = data.resolve(TEST_USER, path, cfs, rtdb, {'ids': requested})
+        assert(res.status_code == 200)
+        assert(json.loads(res.get_data()) == expected)
+    res = data.resolve(
+        TEST_USER, path, cfs, rtdb, {'ids': requested}, {'Accept': 'application/x-ndjson'})
+    assert(_decode(res) == expected)
+
+    for body in [None, [], {'ids': 'abc'}, {'ids': [1]}, {'ids': ['a'] * 10_000}]:
+        res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+        assert(res.status_code == 400), body
+    res = data.resolve(
+        TEST_USER, path, cfs, rtdb, {'ids': requested}, {'Accept': 'application/avro'})
+    assert(res.status_code == 406)
+
+
 @pytest.mark.integration
 def test__data_dont_get_bad_doc(rtdb, cfs):  # noqa
     _ids = data._eligible_docs(
@@ -319,6 +459,20 @@ def test__data_query_no_matches(rtdb, cfs):  # noqa
     )
 
 
+@pytest.mark.integration
+def test__data_batch_fetch(cfs):  # noqa
+    _ids = data._eligible_docs(
+        cfs,
+        TEST_USER,
+        TEST_OBJECT_TYPE)
+    uri = f'{data.APP_ID}/data/{TEST_OBJECT_TYPE}'
+    _fetch = data._batch_fetcher(cfs, uri)
+    _docs = _fetch(_ids)
+    # slots without a matching data document are dropped
+    assert(len(_docs) == TEST_AVAILABLE_OF_TYPE)
+    assert(all([(i.get('uuid') in _ids) for i in _docs]))
+
+
 @pytest.mark.parametrize('query,result_size,error', [
     (
         {},
@@ -435,6 +589,19 @@ def test__data_query_no_matches(rtdb, cfs):  # noqa
         },
         0,
         False),
+    (
+        {
+            "limit": 5
+        },
+        5,
+        False),
+    (
+        {
+            "limit": 500,
+            "offset": 120
+        },
+        TEST_AVAILABLE_OF_TYPE - 120,
+        False),
     (
         {
             "where": {
@@ -654,6 +821,36 @@ def test__data_query_dynamic(rtdb, cfs, query, result_size, error):  # noqa
         ',1809p1111',
         False,
         TEST_AVAILABLE_OF_TYPE),
+    (
+        {
+            "orderBy": [
+                {
+                    "field": {"fieldPath": "batch_number"},
+                    "direction": "ASCENDING"
+                }
+            ],
+            "offset": 1,
+            "limit": 2
+        },
+        'batch_number',
+        '0045mo96',
+        True,
+        2),
+    (
+        {
+            "orderBy": [
+                {
+                    "field": {"fieldPath": "batch_number"},
+                    "direction": "ASCENDING"
+                }
+            ],
+            "offset": 1,
+            "limit": 2
+        },
+        'batch_number',
+        '0049F107',
+        False,
+        2),
 ])
 @pytest.mark.integration
 def test__data_query_order(rtdb, cfs, query, field, result, first, size):  # noqa
@@ -691,6 +888,546 @@ def test__data_query_order(rtdb, cfs, query, field, result, first, size):  # noq
         assert(_docs[-1][field] == result)
 
 
+@pytest.mark.parametrize('query', [
+    None,
+    {
+        "where": {
+            "filter": {
+                "fieldFilter": {
+                    "field": {"fieldPath": "program"},
+                    "op": "EQUAL",
+                    "value": {"stringValue": "Routine Immunization"}
+                }
+            }
+        }
+    },
+    {
+        "orderBy": [
+            {
+                "field": {"fieldPath": "quantity"},
+                "direction": "DESCENDING"
+            }
+        ]
+    },
+    {
+        "orderBy": [
+            {
+                "field": {"fieldPath": "batch_number"},
+                "direction": "ASCENDING"
+            }
+        ],
+        "startAt": {
+            "before": True,
+            "values": [{"stringValue": "0045mo96"}]
+        }
+    }
+])
+@pytest.mark.integration
+def test__data_query_pages(rtdb, cfs, query):  # noqa
+    query = StructuredQuery(**query) if query else None
+    expected = json.loads(''.join(data._query(
+        rtdb,
+        cfs,
+        TEST_USER,
+        TEST_OBJECT_TYPE,
+        query)))
+    docs = []
+    token = None
+    pages = 0
+    while True:
+        page, token = data._query_page(
+            rtdb,
+            cfs,
+            TEST_USER,
+            TEST_OBJECT_TYPE,
+            query,
+            page_size=25,
+            page_token=token)
+        pages += 1
+        assert(len(page) <= 25)
+        docs.extend(page)
+        if not token:
+            break
+    assert(pages == (len(expected) + 24) // 25)
+    assert(len(docs) == len(expected))
+    assert(sorted([i['uuid'] for i in docs]) == sorted([i['uuid'] for i in expected]))
+    if query and query.is_ordered():
+        field = query.orderBy[0].field.fieldPath
+        assert([i[field] for i in docs] == [i[field] for i in expected])
+
+
+@pytest.mark.integration
+def test__data_query_page_token(rtdb, cfs):  # noqa
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb, {'pageSize': 100})
+    assert(res.status_code == 200)
+    assert(len(json.loads(res.data)) == 100)
+    token = res.headers[data.PAGE_TOKEN_HEADER]
+
+    res = data.resolve(TEST_USER, path, cfs, rtdb, {'pageToken': token})
+    assert(res.status_code == 200)
+    assert(len(json.loads(res.data)) == TEST_AVAILABLE_OF_TYPE - 100)
+    assert(data.PAGE_TOKEN_HEADER not in res.headers)
+
+    # a token only works for the query (and user) it was issued for
+    for user, body in [
+        (TEST_USER, {'pageToken': token, 'limit': 10}),
+        (TEST_USER_2, {'pageToken': token}),
+        (TEST_USER, {'pageToken': token[:-1]}),
+        (TEST_USER, {'pageSize': 10, 'limit': 10}),
+    ]:
+        res = data.resolve(user, path, cfs, rtdb, body)
+        assert(res.status_code == 400), body
+
+
+def _decode(res: Response):
+    body = res.get_data()
+    if res.mimetype == 'application/json':
+        return json.loads(body)
+    elif res.mimetype == 'application/x-ndjson':
+        return [json.loads(line) for line in body.decode().splitlines()]
+    elif res.mimetype == 'application/msgpack':
+        return list(msgpack.Unpacker(BytesIO(body), raw=False))
+    elif res.mimetype == 'application/avro':
+        reader = spavro.datafile.DataFileReader(BytesIO(body), spavro.io.DatumReader())
+        return list(reader)
+
+
+@pytest.mark.parametrize('accept', [
+    'application/json',
+    'application/x-ndjson',
+    'application/msgpack',
+    'application/avro',
+])
+@pytest.mark.integration
+def test__data_formats(rtdb, cfs, accept):  # noqa
+    headers = {'Accept': accept}
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb, None, headers)
+    assert(res.status_code == 200)
+    assert(res.mimetype == accept)
+    docs = _decode(res)
+    assert(len(docs) == TEST_AVAILABLE_OF_TYPE)
+    expected = json.loads(''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE)))
+    by_id = {doc['uuid']: doc for doc in expected}
+    for doc in docs:
+        assert(doc == by_id[doc['uuid']])
+
+    # pages use the same format
+    res = data.resolve(TEST_USER, path, cfs, rtdb, {'pageSize': 10}, headers)
+    assert(res.status_code == 200)
+    assert(len(_decode(res)) == 10)
+
+    _id = docs[0]['uuid']
+    path = f'data/{TEST_OBJECT_TYPE}/read/{_id}'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb, None, headers)
+    assert(res.status_code == 200)
+    doc = _decode(res)
+    if accept == 'application/json':
+        assert(doc == by_id[_id])
+    else:
+        assert(doc == [by_id[_id]])
+
+
+@pytest.mark.integration
+def test__data_format_not_acceptable(rtdb, cfs):  # noqa
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb, None, {'Accept': 'text/html'})
+    assert(res.status_code == 406)
+    # there is no schema to write avro with
+    path = 'data/not-a-type/query'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb, None, {'Accept': 'application/avro'})
+    assert(res.status_code == 406)
+
+    # a doc that doesn't match the schema (as stored, not cast) fails the response
+    _id = data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE)[0]
+    path = f'data/{TEST_OBJECT_TYPE}/read/{_id}'.split('/')
+    with patch.object(data, '_caster', return_value=lambda doc: doc):
+        res = data.resolve(TEST_USER, path, cfs, rtdb, None, {'Accept': 'application/avro'})
+        assert(res.status_code == 406 and _id in res.get_data(as_text=True))
+        path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+        res = data.resolve(TEST_USER, path, cfs, rtdb, None, {'Accept': 'application/avro'})
+        with pytest.raises(formats.SchemaMismatch):
+            res.get_data()
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'limit': 10},
+    {'orderBy': [{'field': {'fieldPath': 'quantity'}, 'direction': 'DESCENDING'}]},
+    {
+        'orderBy': [{'field': {'fieldPath': 'quantity'}, 'direction': 'DESCENDING'}],
+        'limit': 10
+    },
+])
+@pytest.mark.integration
+def test__data_query_select(rtdb, cfs, query):  # noqa
+    selected = ['batch_number', 'item_name', 'version_modified']
+    full = json.loads(''.join(data._query(
+        rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, StructuredQuery(**query) if query else None)))
+    _q = StructuredQuery(**query, select={'fields': [{'fieldPath': f} for f in selected]})
+    docs = json.loads(''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _q)))
+    assert(len(docs) == len(full))
+    assert(all(set(doc) <= set(selected) for doc in docs))
+    expected = [{k: doc[k] for k in selected if k in doc} for doc in full]
+    if _q.is_ordered():
+        assert([d['batch_number'] for d in docs] == [d['batch_number'] for d in expected])
+    else:
+        key = operator.itemgetter('batch_number')
+        assert(sorted(docs, key=key) == sorted(expected, key=key))
+
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    body = {**_q.dict(exclude_none=True, exclude={'limit'}), 'pageSize': 5}
+    res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+    assert(res.status_code == 200)
+    page = json.loads(res.data)
+    assert(len(page) == 5)
+    assert(all(set(doc) <= set(selected) for doc in page))
+
+
+@pytest.mark.integration
+def test__data_read_fields(rtdb, cfs):  # noqa
+    _id = data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE)[0]
+    full = data._read(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _id)
+    args = {'fields': 'uuid, quantity,missing'}
+    path = f'data/{TEST_OBJECT_TYPE}/read/{_id}'.split('/')
+    # the other fields are dropped before the cast
+    with patch.object(data, 'clean_msg', wraps=data.clean_msg) as _cast:
+        res = data.resolve(TEST_USER, path, cfs, rtdb, None, None, args)
+        assert(set(_cast.call_args[0][1]) == {'uuid', 'quantity', 'version_modified'})
+    assert(json.loads(res.data) == {'uuid': _id, 'quantity': full['quantity']})
+    # a different projection is a different representation
+    assert(res.get_etag()[0] != data.resolve(TEST_USER, path, cfs, rtdb).get_etag()[0])
+
+    path = f'data/{TEST_OBJECT_TYPE}/read'.split('/')
+    res = data.resolve(TEST_USER, path, cfs, rtdb, {'ids': [_id, 'missing']}, None, args)
+    assert(json.loads(res.data) == [{'uuid': _id, 'quantity': full['quantity']}, None])
+
+
+@pytest.mark.integration
+def test__data_field_mask(rtdb, cfs):  # noqa
+    mask = data._field_mask(rtdb, TEST_OBJECT_TYPE)
+    assert('quantity' in mask and 'uuid' in mask)
+    assert(not set(mask) & set(schema.BANNED_READ))
+    assert(data._field_mask(rtdb, TEST_OBJECT_TYPE, ['quantity']) == [
+        'modified', 'quantity', 'uuid', 'version_modified'])
+    assert(data._field_mask(rtdb, 'not-a-type') is None)
+
+    # banned fields never leave Firestore, and the results don't change
+    queries = [
+        None,
+        StructuredQuery(**{'where': _program_filter('EQUAL', 'Routine Immunization')}),
+        StructuredQuery(**{
+            'orderBy': [{'field': {'fieldPath': 'quantity'}, 'direction': 'ASCENDING'}],
+            'limit': 20
+        }),
+    ]
+    for _q in queries:
+        with patch.object(data, 'clean_msg', wraps=data.clean_msg) as _cast:
+            docs = ''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _q))
+            assert(_cast.called)
+            for call in _cast.call_args_list:
+                assert(not set(call[0][1]) & set(schema.BANNED_READ))
+        with patch.object(data, 'meta_read_fields', return_value=None):
+            unmasked = ''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _q))
+        key = operator.itemgetter('uuid')
+        assert(sorted(json.loads(docs), key=key) == sorted(json.loads(unmasked), key=key))
+
+    _id = data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE)[0]
+    raw = data._fetch_doc(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _id)
+    assert(raw and not set(raw) & set(schema.BANNED_READ))
+
+
+@pytest.mark.integration
+def test__meta_read_fields(rtdb):  # noqa
+    metrics.CACHES['meta_read_fields'].clear()
+    schemas = metrics.CACHES['_meta_schema']
+    lookups = schemas.hits + schemas.misses
+    fields = meta.meta_read_fields(rtdb, TEST_OBJECT_TYPE)
+    assert('quantity' in fields and not fields & set(schema.BANNED_READ))
+    # the schemas cache used to cast documents is left alone
+    assert(schemas.hits + schemas.misses == lookups)
+    # once a version has been read, it isn't read again when the union expires
+    metrics.CACHES['meta_read_fields'].clear()
+    with patch.object(rtdb, 'reference', wraps=rtdb.reference) as _ref:
+        assert(meta.meta_read_fields(rtdb, TEST_OBJECT_TYPE) == fields)
+        assert(not _ref.called)
+
+
+@pytest.mark.integration
+def test__data_validate_query_cache(rtdb, cfs):  # noqa
+    data.QUERY_SHAPE_CACHE.clear()
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    with patch.object(data, '_probe_query', wraps=data._probe_query) as _probe:
+        for value in ['Routine Immunization', 'Missing', 'Other']:
+            body = {'where': _program_filter('EQUAL', value)}
+            assert(data.resolve(TEST_USER, path, cfs, rtdb, body).status_code == 200)
+            # with and / or without `uuid in`, depending on the plan
+            probed = _probe.call_count
+            assert(probed in (1, 2) and probed == len(data.QUERY_SHAPE_CACHE))
+        # a new shape is probed, no filter at all never is
+        body = {'where': _program_filter('GREATER_THAN', 'A')}
+        assert(data.resolve(TEST_USER, path, cfs, rtdb, body).status_code == 200)
+        assert(_probe.call_count > probed)
+        probed = _probe.call_count
+        assert(data.resolve(TEST_USER, path, cfs, rtdb, {'limit': 1}).status_code == 200)
+        assert(_probe.call_count == probed)
+
+    # missing indexes are remembered too
+    data.QUERY_SHAPE_CACHE.clear()
+    missing = FailedPrecondition('The query requires an index')
+    with patch.object(data, '_probe_query', side_effect=missing) as _probe:
+        for value in ['Routine Immunization', 'Missing']:
+            with pytest.raises(FailedPrecondition):
+                data._validate_query(
+                    cfs, TEST_OBJECT_TYPE, StructuredQuery(where=_program_filter('EQUAL', value)))
+        assert(_probe.call_count == 1)
+    data.QUERY_SHAPE_CACHE.clear()
+
+
+def _program_filter(op, value):
+    return {
+        "filter": {
+            "fieldFilter": {
+                "field": {"fieldPath": "program"},
+                "op": op,
+                "value": {"stringValue": value}
+            }
+        }
+    }
+
+
+@pytest.mark.parametrize('where', [
+    _program_filter('EQUAL', 'Routine Immunization'),
+    _program_filter('EQUAL', 'Missing'),
+    _program_filter('GREATER_THAN', 'Poutine Immunization'),
+    _program_filter('LESS_THAN', 'Poutine Immunization'),
+    {'filter': {'compositeFilter': {'filters': [
+        _program_filter('EQUAL', 'Routine Immunization'),
+        {'filter': {'fieldFilter': {
+            'field': {'fieldPath': 'item_name'},
+            'op': 'GREATER_THAN_OR_EQUAL',
+            'value': {'stringValue': 'P'}
+        }}},
+    ]}}},
+])
+@pytest.mark.integration
+def test__data_query_local_filter(rtdb, cfs, where):  # noqa
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    key = operator.itemgetter('uuid')
+    expected = sorted(json.loads(data.resolve(
+        TEST_USER, path, cfs, rtdb, {'where': where}).get_data()), key=key)
+    # without an index, the docs are fetched by id and filtered here, same result
+    data.QUERY_SHAPE_CACHE.clear()
+    missing = FailedPrecondition('The query requires an index')
+    with patch.object(data, '_probe_query', side_effect=missing):
+        for body in [
+            {'where': where},
+            {'where': where, 'select': {'fields': [{'fieldPath': 'uuid'}]}},
+            {'where': where, 'orderBy': [
+                {'field': {'fieldPath': 'batch_number'}, 'direction': 'ASCENDING'}]},
+        ]:
+            res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+            assert(res.status_code == 200)
+            docs = sorted(json.loads(res.get_data()), key=key)
+            assert([d['uuid'] for d in docs] == [d['uuid'] for d in expected])
+            if 'select' not in body:
+                assert(docs == expected)
+        body = {'where': where, 'aggregations': [{'count': {}}]}
+        res = data.resolve(TEST_USER, f'data/{TEST_OBJECT_TYPE}/aggregate'.split('/'), cfs,
+                           rtdb, body)
+        assert(json.loads(res.get_data()) == [{'count': len(expected)}])
+    data.QUERY_SHAPE_CACHE.clear()
+
+
+@pytest.mark.parametrize('where', [
+    None,
+    _program_filter('EQUAL', 'Routine Immunization'),
+    _program_filter('EQUAL', 'Missing'),
+])
+@pytest.mark.integration
+def test__data_aggregate(rtdb, cfs, where):  # noqa
+    path = f'data/{TEST_OBJECT_TYPE}/aggregate'.split('/')
+    query_ = {'where': where} if where else None
+    docs = json.loads(''.join(data._query(
+        rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE,
+        StructuredQuery(**query_) if query_ else None)))
+
+    # plain counts never cast a document, or fetch them by id
+    body = {'where': where, 'aggregations': [{'count': {}}, {'count': {}, 'alias': 'n'}]}
+    with patch.object(data, 'clean_msg') as _cast, \
+            patch.object(cfs, 'get_all') as _get_all:
+        res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+        assert(not _cast.called and not _get_all.called)
+    assert(res.status_code == 200)
+    assert(json.loads(res.data) == [{'count': len(docs), 'n': len(docs)}])
+
+    body = {
+        'where': where,
+        'groupBy': [{'fieldPath': 'item_name'}],
+        'aggregations': [
+            {'count': {}},
+            {'sum': {'fieldPath': 'quantity'}},
+            {'max': {'fieldPath': 'expiry_date'}},
+        ]
+    }
+    res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+    assert(res.status_code == 200)
+    rows = json.loads(res.data)
+    assert(sum(r['count'] for r in rows) == len(docs))
+    for row in rows:
+        group = [d for d in docs if d.get('item_name') == row['item_name']]
+        assert(row['count'] == len(group))
+        assert(row['sum_quantity'] == pytest.approx(
+            sum(d['quantity'] for d in group if d.get('quantity') is not None)))
+        assert(row['max_expiry_date'] == max(
+            d['expiry_date'] for d in group if d.get('expiry_date') is not None))
+
+
+@pytest.mark.integration
+def test__data_aggregate_invalid(rtdb, cfs):  # noqa
+    path = f'data/{TEST_OBJECT_TYPE}/aggregate'.split('/')
+    for body in [None, [], {'aggregations': []}, {'aggregations': [{'sum': {}}]}]:
+        res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+        assert(res.status_code == 400), body
+    res = data.resolve(
+        TEST_USER, path, cfs, rtdb, {'aggregations': [{'count': {}}]},
+        {'Accept': 'application/avro'})
+    assert(res.status_code == 406)
+
+
+@pytest.mark.parametrize('where', [
+    None,
+    _program_filter('EQUAL', 'Routine Immunization'),
+    _program_filter('GREATER_THAN', 'Poutine Immunization'),
+])
+@pytest.mark.integration
+def test__data_query_plans(rtdb, cfs, where):  # noqa
+    key = operator.itemgetter('uuid')
+    _q = StructuredQuery(where=where) if where else None
+    expected = sorted(
+        json.loads(''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _q))), key=key)
+    ordered = StructuredQuery(where=where, orderBy=[
+        {'field': {'fieldPath': 'batch_number'}, 'direction': 'ASCENDING'}])
+    skipped = StructuredQuery(where=where, offset=3, limit=5)
+    options = [
+        (planner.IN_CHUNKS, False),
+        (planner.MULTI_GET, bool(where)),
+        (planner.INTERSECT, False),
+        (planner.INTERSECT, bool(where)),
+    ]
+    count_body = {'where': where, 'aggregations': [{'count': {}}]}
+    path = f'data/{TEST_OBJECT_TYPE}/aggregate'.split('/')
+    for option in options:
+        for cached in [True, False]:
+            if not cached:
+                data._invalidate_eligible_docs(TEST_USER, TEST_OBJECT_TYPE)
+            # a small peek, so that the slot listing is still running when planning
+            with patch.object(planner, 'candidates', return_value=[option]), \
+                    patch.object(data, 'PLAN_PEEK_IDS', 10):
+                docs = json.loads(''.join(data._query(
+                    rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, _q)))
+                assert(sorted(docs, key=key) == expected), option
+                docs = json.loads(''.join(data._query(
+                    rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, ordered)))
+                assert(docs == ordered.order(expected)), option
+                docs = json.loads(''.join(data._query(
+                    rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, skipped)))
+                if option[0] != planner.INTERSECT:
+                    # by id, whichever chunk query comes back first
+                    assert(docs == expected[3:8]), option
+                assert(docs == json.loads(''.join(data._query(
+                    rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE, skipped)))), option
+                res = data.resolve(TEST_USER, path, cfs, rtdb, count_body)
+                assert(json.loads(res.data) == [{'count': len(expected)}]), option
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('where', [None, _program_filter('EQUAL', 'Routine Immunization')])
+def test__data_query_timing(rtdb, cfs, where):  # noqa
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    body = {'where': where} if where else None
+    data._invalidate_eligible_docs(TEST_USER, TEST_OBJECT_TYPE)
+    with timing.request() as timings:
+        res = data.resolve(TEST_USER, path, cfs, rtdb, body)
+    assert(res.status_code == 200 and res.is_streamed)
+    # the body is streamed after the handler returns
+    docs = json.loads(''.join(timing.trailing(res.response, timings, 'test')))
+    record = timings.record()
+    for phase in ['eligible', 'fetch', 'cast', 'encode']:
+        assert(record['spans'][phase]['calls'] > 0), phase
+    assert(record['spans']['cast']['calls'] == len(docs))
+    # slots listed and docs read, at least
+    assert(record['counts']['cfs_reads'] >= len(docs) + 137)
+    if where:
+        assert(record['spans']['validate']['calls'] > 0)
+
+
+@pytest.mark.integration
+def test__data_query_metrics(rtdb, cfs):  # noqa
+    def _calls(backend, op):
+        return (hist := metrics.CALLS.get((backend, op))) and hist.snapshot()[2] or 0
+
+    def _stats(name):
+        return metrics.CACHES[name].stats()
+
+    data._invalidate_eligible_docs(TEST_USER, TEST_OBJECT_TYPE)
+    before = {k: _stats(k) for k in ['eligibility', 'schema_caster']}
+    listed = _calls('firestore', 'list')
+    docs = json.loads(''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE)))
+    json.loads(''.join(data._query(rtdb, cfs, TEST_USER, TEST_OBJECT_TYPE)))
+    # the slots are listed once, then cached
+    assert(_calls('firestore', 'list') == listed + 1)
+    eligibility = _stats('eligibility')
+    assert(eligibility['hits'] > before['eligibility']['hits'])
+    assert(eligibility['misses'] > before['eligibility']['misses'])
+    assert(eligibility['memory'] > 0)
+    # a caster lookup per doc read
+    assert(_stats('schema_caster')['hits'] >= before['schema_caster']['hits'] + len(docs))
+    text = metrics.render()
+    assert('logiak_cache_hits_total{cache="verify_session"}' in text)
+    assert('logiak_backend_call_seconds_count{backend="firestore",op="list"}' in text)
+
+
+@pytest.mark.integration
+def test__data_explain(rtdb, cfs):  # noqa
+    where = _program_filter('EQUAL', 'Routine Immunization')
+    path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+    _ids = data._eligible_docs(cfs, TEST_USER, TEST_OBJECT_TYPE)
+    with patch.object(data, 'unordered_query') as _run:
+        res = data.resolve(TEST_USER, path, cfs, rtdb, {'where': where, 'explain': True})
+        assert(not _run.called)
+    assert(res.status_code == 200 and res.mimetype == 'application/json')
+    plan = json.loads(res.data)
+    assert(plan['eligible'] == len(_ids) and plan['eligible_exact'])
+    assert(plan['collection'] == data._collection_count(cfs, TEST_OBJECT_TYPE))
+    assert(plan['selectivity'] == pytest.approx(0.1))
+    assert(plan['strategy'] == plan['candidates'][0]['strategy'])
+    assert({c['strategy'] for c in plan['candidates']} == {
+        planner.IN_CHUNKS, planner.MULTI_GET, planner.INTERSECT})
+
+    # unordered pages are never intersected
+    res = data.resolve(
+        TEST_USER, path, cfs, rtdb, {'where': where, 'pageSize': 10, 'explain': True})
+    plan = json.loads(res.data)
+    assert(planner.INTERSECT not in {c['strategy'] for c in plan['candidates']})
+
+    path = f'data/{TEST_OBJECT_TYPE}/aggregate'.split('/')
+    body = {'where': where, 'aggregations': [{'count': {}}], 'explain': True}
+    plan = json.loads(data.resolve(TEST_USER, path, cfs, rtdb, body).data)
+    assert(planner.COUNT in {c['strategy'] for c in plan['candidates']})
+
+    # without an index, only the plans that filter here are left
+    data.QUERY_SHAPE_CACHE.clear()
+    missing = FailedPrecondition('The query requires an index')
+    with patch.object(data, '_probe_query', side_effect=missing):
+        body = {'where': where, 'explain': True}
+        path = f'data/{TEST_OBJECT_TYPE}/query'.split('/')
+        plan = json.loads(data.resolve(TEST_USER, path, cfs, rtdb, body).data)
+        assert(all(c['filtered_locally'] for c in plan['candidates']))
+    data.QUERY_SHAPE_CACHE.clear()
+
+
 @pytest.mark.integration
 def test__data_validate_for_write(cfs, rtdb):  # noqa
     all_gen = data._query(
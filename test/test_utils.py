@@ -18,10 +18,33 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import gzip
+import json
+import random
+import sys
+from threading import Lock
+from time import sleep
+from unittest.mock import patch
+
+from cachetools import cached
+from flask import Response
+from google.api_core.exceptions import AlreadyExists, NotFound
 import pytest
 from pydantic.error_wrappers import ValidationError
+import spavro.schema
 
-from test.app.cloud import utils, query, schema
+from test.app.cloud import (
+    aggregation,
+    compression,
+    fb_memory,
+    formats,
+    metrics,
+    planner,
+    timing,
+    utils,
+    query,
+    schema
+)
 
 
 @pytest.mark.unit
@@ -40,6 +63,33 @@ def test__clean_list():
         assert(len(res) > 0)
 
 
+@pytest.mark.unit
+def test__fan_out():
+    lock = Lock()
+    running = 0
+    peak = 0
+
+    def _fn(x):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        sleep(0.01)
+        with lock:
+            running -= 1
+        return x * 2
+
+    res = list(utils.fan_out(_fn, range(20), 4))
+    assert(sorted(res) == [x * 2 for x in range(20)])
+    assert(1 < peak <= 4)
+
+    def _raises(x):
+        raise ValueError(x)
+
+    with pytest.raises(ValueError):
+        list(utils.fan_out(_raises, range(3), 2))
+
+
 @pytest.mark.parametrize('body,valid', (
     ('''{
       "where" : {
@@ -122,13 +172,26 @@ def test__clean_list():
             {"booleanValue": "true"}
         ]}
     }''', False),
-    # not allowed.
     ('''{
       "limit": 1
+    }''', True),
+    ('''{
+      "offset": 1
+    }''', True),
+    # not allowed.
+    ('''{
+      "limit": -1
     }''', False),
     # not allowed.
     ('''{
-      "offset": 1
+      "offset": -1
+    }''', False),
+    ('''{
+      "select": {"fields": [{"fieldPath": "name"}]}
+    }''', True),
+    # nothing selected
+    ('''{
+      "select": {"fields": []}
     }''', False),
 ))
 @pytest.mark.unit
@@ -188,3 +251,827 @@ def test__field_remove_optional():
     assert(isinstance(res_c['type'], list))
     assert('null' not in res_c['type'])
     assert(isinstance(schema.field_remove_optional(d)['type'], dict))
+
+
+@pytest.mark.unit
+def test__query_order():
+    _q = query.StructuredQuery(**{
+        'orderBy': [
+            {'field': {'fieldPath': 'a'}, 'direction': 'ASCENDING'},
+            {'field': {'fieldPath': 'b'}, 'direction': 'DESCENDING'}
+        ]
+    })
+    streams = [
+        [{'a': 10.0, 'b': 'x'}, {'a': 9.0, 'b': 'y'}],
+        [{'a': 10.0, 'b': 'z'}, {'b': 'missing a'}],
+        []
+    ]
+    res = _q.order([i for s in streams for i in s])
+    # typed (not string) order, missing first, ties broken by the second term
+    assert([(i.get('a'), i['b']) for i in res] == [
+        (None, 'missing a'),
+        (9.0, 'y'),
+        (10.0, 'z'),
+        (10.0, 'x')
+    ])
+
+
+@pytest.mark.parametrize('cursors,expected', [
+    ({'startAt': {'values': [{'integerValue': '2'}]}}, [2, 3, 4]),
+    ({'startAt': {'values': [{'integerValue': '2'}], 'before': True}}, [3, 4]),
+    # between existing values
+    ({'startAt': {'values': [{'doubleValue': 1.5}]}}, [2, 3, 4]),
+    ({'endAt': {'values': [{'integerValue': '3'}]}}, [1, 2, 3]),
+    ({'endAt': {'values': [{'integerValue': '3'}], 'before': True}}, [1, 2]),
+    ({
+        'startAt': {'values': [{'integerValue': '2'}]},
+        'endAt': {'values': [{'integerValue': '3'}]}
+    }, [2, 3]),
+])
+@pytest.mark.unit
+def test__query_order_cursors(cursors, expected):
+    _q = query.StructuredQuery(**{
+        'orderBy': [{'field': {'fieldPath': 'a'}, 'direction': 'ASCENDING'}],
+        **cursors
+    })
+    streams = [[{'a': 4}, {'a': 1}], [{'a': 3}], [{'a': 2}]]
+    assert([i['a'] for i in _q.order([i for s in streams for i in s])] == expected)
+
+
+@pytest.mark.parametrize('paging,expected', [
+    ({}, [1, 2, 3, 4, 5]),
+    ({'limit': 2}, [1, 2]),
+    ({'limit': 2, 'offset': 2}, [3, 4]),
+    ({'offset': 3}, [4, 5]),
+    ({'limit': 0}, []),
+    ({'limit': 10, 'offset': 4}, [5]),
+])
+@pytest.mark.unit
+def test__query_limit_offset(paging, expected):
+    _q = query.StructuredQuery(**paging)
+    chunks = [[1, 2], [], [3], [4, 5]]
+    assert([i for c in _q.window(iter(chunks)) for i in c] == expected)
+
+    _q = query.StructuredQuery(**{
+        'orderBy': [{'field': {'fieldPath': 'a'}, 'direction': 'DESCENDING'}],
+        **paging
+    })
+    streams = [[{'a': 6 - i} for i in c] for c in chunks]
+    res = _q.order([i for s in streams for i in s])
+    assert([6 - i['a'] for i in res] == expected)
+    if 'limit' in paging:
+        res = _q.top(iter(streams))
+        assert([6 - i['a'] for i in res] == expected)
+
+
+@pytest.mark.unit
+def test__query_window_stops_early():
+    pulled = []
+
+    def _chunks():
+        for x in range(100):
+            pulled.append(x)
+            yield [x]
+
+    _q = query.StructuredQuery(limit=3)
+    assert(len(list(_q.window(_chunks()))) == 3)
+    assert(len(pulled) == 3)
+
+
+@pytest.mark.unit
+def test__tokens():
+    secret = b'secret'
+    payload = {'k': ['a', 1, 2.5, None], 'p': 10}
+    token = utils.sign_token(payload, secret)
+    assert(utils.read_token(token, secret) == payload)
+    body, signature = token.split('.')
+    for bad in [
+        f'{body}x.{signature}',
+        f'{body}.{signature[:-1]}',
+        body,
+        '',
+        None
+    ]:
+        with pytest.raises(ValueError):
+            utils.read_token(bad, secret)
+    with pytest.raises(ValueError):
+        utils.read_token(token, b'other')
+
+
+@pytest.mark.unit
+def test__prefetch():
+    assert(list(utils.prefetch(iter(range(50)), 3)) == list(range(50)))
+
+    def _fails():
+        yield 1
+        raise ValueError('producer error')
+
+    with pytest.raises(ValueError):
+        list(utils.prefetch(_fails(), 3))
+
+    produced = []
+
+    def _slow():
+        for x in range(1000):
+            produced.append(x)
+            yield x
+
+    gen = utils.prefetch(_slow(), 2)
+    assert(next(gen) == 0)
+    gen.close()
+    sleep(0.3)
+    # the producer stops at most a few items past what the buffer holds
+    assert(len(produced) < 10)
+
+
+@pytest.mark.unit
+def test__timing():
+    @timing.timed('work')
+    def _work(x):
+        timing.count('items')
+        return x
+
+    # nothing is bound outside of a request
+    assert(timing.current() is None)
+    with timing.span('work'):
+        assert(_work(1) == 1)
+    assert(timing.current() is None)
+
+    with timing.request() as timings:
+        assert(timing.current() is timings)
+        with timing.request() as inner:
+            # already timed by an outer handler
+            assert(inner is None)
+        with timing.span('phase'):
+            sleep(0.01)
+        # the calls on the pool threads count towards the request
+        assert(sorted(utils.fan_out(_work, range(20), 4)) == list(range(20)))
+        assert(list(utils.prefetch(map(_work, range(5)), 2)) == list(range(5)))
+        assert(list(timing.timed_iter('pull', iter(range(3)))) == [0, 1, 2])
+    assert(timing.current() is None)
+    record = timings.record()
+    assert(record['spans']['work']['calls'] == 25)
+    assert(record['spans']['pull']['calls'] == 4)
+    assert(record['spans']['phase']['ms'] >= 10)
+    assert(record['counts'] == {'items': 25})
+    header = timings.header().split(', ')
+    assert(header[0].startswith('phase;dur='))
+    assert('items;desc=25' in header)
+    assert(header[-1].startswith('total;dur='))
+
+    with patch.object(timing, 'REQUEST_TIMING', False):
+        with timing.request() as timings:
+            assert(timings is None and timing.current() is None)
+
+
+@pytest.mark.unit
+def test__timing_trailing():
+    timings = timing.Timings()
+
+    def _body():
+        for x in range(3):
+            timing.count('chunks')
+            yield str(x)
+
+    with patch.object(timing.LOG, 'info') as _log:
+        body = timing.trailing(_body(), timings, 'GET /test')
+        assert(next(body) == '0')
+        # bound only while the body is iterated
+        assert(timing.current() is None)
+        assert(list(body) == ['1', '2'])
+        _log.assert_called_once()
+    assert(timings.counts == {'chunks': 3})
+    assert(_log.call_args[0][0].startswith('GET /test {'))
+
+    with patch.object(timing.LOG, 'info') as _log:
+        body = timing.trailing(_body(), timings, 'GET /test')
+        next(body)
+        # logged even if the client goes away early
+        body.close()
+        _log.assert_called_once()
+
+
+@pytest.mark.unit
+def test__metrics_caches():
+    lru = metrics.LRUCache('test_lru', maxsize=2)
+    assert(metrics.CACHES['test_lru'] is lru)
+    lru['a'] = 1
+    lru['b'] = 2
+    assert(lru['a'] == 1)
+    with pytest.raises(KeyError):
+        lru['c']
+    assert(lru.get('c') is None)
+    lru['c'] = 3  # b is evicted
+    assert(lru.get('b', 'missing') == 'missing')
+    lru.clear()
+    stats = lru.stats()
+    assert((stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1))
+    assert(stats['entries'] == 0 and stats['maxsize'] == 2)
+
+    now = [0]
+    ttl = metrics.TTLCache('test_ttl', maxsize=10, ttl=5, timer=lambda: now[0])
+    ttl['a'] = 1
+    ttl['b'] = 2
+    assert(ttl['a'] == 1)
+    now[0] = 10
+    with pytest.raises(KeyError):
+        ttl['a']
+    ttl['c'] = 3  # setting expires the others
+    stats = ttl.stats()
+    assert((stats['hits'], stats['misses'], stats['expirations']) == (1, 1, 2))
+    assert(stats['entries'] == 1)
+
+    # a decorated function counts as the decorator looks the cache up
+    @cached(metrics.LRUCache('test_fn', maxsize=4))
+    def _double(x):
+        return x * 2
+
+    assert([_double(i) for i in [1, 2, 1, 1]] == [2, 4, 2, 2])
+    stats = metrics.CACHES['test_fn'].stats()
+    assert((stats['hits'], stats['misses']) == (2, 2))
+
+    # sized cache, size is in its own units
+    sized = metrics.TTLCache('test_sized', maxsize=100, ttl=5, getsizeof=len)
+    sized['a'] = tuple(str(i) for i in range(50))
+    stats = sized.stats()
+    assert(stats['entries'] == 1 and stats['size'] == 50)
+    assert(stats['memory'] > 50 * 50)
+
+
+@pytest.mark.unit
+def test__metrics_deep_size():
+    small = {'a': 'x' * 100}
+    assert(metrics.deep_size(small) > 100)
+    shared = 'y' * 1000
+    # the same object is only counted once
+    assert(metrics.deep_size([shared, shared]) < 2000)
+    big = tuple(f'{i:010d}' for i in range(10000))
+    estimate = metrics.deep_size(big)
+    exact = sys.getsizeof(big) + sum(sys.getsizeof(i) for i in big)
+    assert(abs(estimate - exact) / exact < 0.01)
+
+    def _closure():
+        held = ['z' * 1000]
+        return lambda: held
+    assert(metrics.deep_size(_closure()) > 1000)
+
+
+@pytest.mark.unit
+def test__metrics_render():
+    hist = metrics.Histogram([0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        hist.observe(value)
+    buckets, _sum, count = hist.snapshot()
+    assert(buckets == [('0.1', 2), ('1.0', 3), ('+Inf', 4)])
+    assert(count == 4 and _sum == pytest.approx(2.65))
+
+    with metrics.backend_call('test', 'op "quoted"'):
+        pass
+    lru = metrics.LRUCache('test_render', maxsize=2)
+    lru['a'] = 1
+    lru['a']
+    lines = metrics.render().splitlines()
+    assert('logiak_cache_hits_total{cache="test_render"} 1' in lines)
+    assert('logiak_cache_maxsize{cache="test_render"} 2' in lines)
+    assert('# TYPE logiak_backend_call_seconds histogram' in lines)
+    assert(
+        'logiak_backend_call_seconds_count{backend="test",op="op \\"quoted\\""} 1' in lines
+    )
+    for line in lines:
+        # comments, or a name with labels and a number
+        assert(line.startswith('# ') or float(line.rsplit(' ', 1)[1]) >= 0), line
+
+
+@pytest.mark.parametrize('directions', [
+    ['ASCENDING', 'ASCENDING'],
+    ['DESCENDING', 'ASCENDING'],
+    ['ASCENDING', 'DESCENDING'],
+    ['DESCENDING', 'DESCENDING'],
+])
+@pytest.mark.unit
+def test__query_sort(directions):
+    rnd = random.Random(1)
+    pool = [None, True, False, 0, 1, 2.5, -3, 'a', 'B', 'b', '', {'x': 1}, [1, 2]]
+    items = []
+    for x in range(200):
+        doc = {'uuid': f'{x:04}'}
+        for field in ['a', 'b']:
+            # some docs don't have the field at all
+            if rnd.random() > 0.1:
+                doc[field] = rnd.choice(pool)
+        items.append(doc)
+    _q = query.StructuredQuery(**{
+        'orderBy': [
+            {'field': {'fieldPath': f}, 'direction': d}
+            for f, d in zip(['a', 'b'], directions)
+        ]
+    })
+    expected = sorted(items, key=_q.sort_key())
+    assert(_q.sort(items) == expected)
+    assert(_q.order(list(items)) == expected)
+
+
+@pytest.mark.parametrize('position', ['startAt', 'endAt'])
+@pytest.mark.parametrize('before', [True, False])
+@pytest.mark.parametrize('direction', ['ASCENDING', 'DESCENDING'])
+@pytest.mark.unit
+def test__cursor_bound(position, before, direction):
+    items = [{'a': x // 3, 'b': x % 3, 'uuid': str(x)} for x in range(30)]
+    _q = query.StructuredQuery(**{
+        'orderBy': [
+            {'field': {'fieldPath': 'a'}, 'direction': direction},
+            {'field': {'fieldPath': 'b'}, 'direction': 'ASCENDING'}
+        ],
+        position: {
+            'before': before,
+            # 4.5 falls between docs, 4 matches three of them
+            'values': [{'doubleValue': 4.5}]
+        }
+    })
+    _key = _q.sort_key()
+    items = _q.sort(items)
+    cursor = getattr(_q, position)
+    cursor_key = cursor.key(_q.orderBy)
+    expected = [i for i in items if cursor.admits(_key(i), cursor_key)]
+    assert(cursor.prune(_q.orderBy, items) == expected)
+    assert(_q.order(items) == expected)
+    assert(_q.order(items[10:] + items[:10]) == expected)
+
+    cursor.values = [query.ObjectValue(integerValue='4')]
+    cursor_key = cursor.key(_q.orderBy)
+    expected = [i for i in items if cursor.admits(_key(i), cursor_key)]
+    assert(cursor.prune(_q.orderBy, items) == expected)
+    # prefix matches include / exclude all docs with a == 4
+    matched = [i for i in expected if i['a'] == 4]
+    assert(len(matched) == (0 if before else 3))
+
+
+@pytest.mark.unit
+def test__cursor_bound_is_logarithmic():
+    items = [{'a': x} for x in range(1024)]
+    _q = query.StructuredQuery(**{
+        'orderBy': [{'field': {'fieldPath': 'a'}, 'direction': 'ASCENDING'}],
+        'startAt': {'values': [{'integerValue': '700'}]}
+    })
+    compare = query.SortKey.compare
+    with patch.object(query.SortKey, 'compare', autospec=True, side_effect=compare) as _mock:
+        assert(_q.startAt.bound(_q.orderBy, items) == 700)
+    assert(_mock.call_count <= 11)
+
+
+@pytest.mark.parametrize('accept,fmt', [
+    (None, formats.JSONFormat),
+    ('', formats.JSONFormat),
+    ('*/*', formats.JSONFormat),
+    ('application/json', formats.JSONFormat),
+    ('application/x-ndjson', formats.NDJSONFormat),
+    ('application/msgpack, application/json;q=0.5', formats.MessagePackFormat),
+    ('application/json;q=0.5, avro/binary', formats.AvroFormat),
+    ('text/html, application/*;q=0.1', formats.JSONFormat),
+    ('text/html', None),
+    ('application/json;q=0', None),
+])
+@pytest.mark.unit
+def test__negotiate(accept, fmt):
+    assert(formats.negotiate(accept) is fmt)
+
+
+@pytest.mark.unit
+def test__json_format_stream():
+    fmt = formats.JSONFormat()
+    assert(''.join(fmt.stream(iter([]))) == '[]')
+    chunks = iter([[], [{'a': 1}], [], [{'a': 2}, {'a': 3}]])
+    assert(''.join(fmt.stream(chunks)) == '[{"a": 1},{"a": 2},{"a": 3}]')
+    assert(fmt.many([]) == '[]')
+    assert(fmt.one({'a': 1}) == '{"a": 1}')
+    assert(formats.NDJSONFormat().many([{'a': 1}, {'a': 2}]) == '{"a": 1}\n{"a": 2}\n')
+
+
+@pytest.mark.unit
+def test__avro_format_mismatch():
+    schema = spavro.schema.parse(json.dumps({
+        'name': 'doc', 'type': 'record',
+        'fields': [{'name': 'uuid', 'type': 'string'}, {'name': 'a', 'type': 'long'}]
+    }))
+    fmt = formats.AvroFormat(schema)
+    assert(fmt.one({'uuid': '1', 'a': 1}))
+    with pytest.raises(formats.SchemaMismatch):
+        fmt.many([{'uuid': '1', 'a': 1}, {'uuid': '2', 'a': 'old'}])
+    # what was already streamed stays, but the stream doesn't finish
+    stream = fmt.stream(iter([[{'uuid': '1', 'a': 1}], [{'uuid': '2', 'a': 'old'}]]))
+    assert(next(stream))
+    with pytest.raises(formats.SchemaMismatch):
+        list(stream)
+
+
+@pytest.mark.parametrize('accept,encoding', [
+    (None, 'identity'),
+    ('gzip', 'gzip'),
+    ('deflate, gzip;q=0.5', 'gzip'),
+    ('gzip;q=0', 'identity'),
+    ('compress', 'identity'),
+    ('*', compression.ENCODINGS[0]),
+    ('br;q=0.5, gzip', 'gzip'),
+])
+@pytest.mark.unit
+def test__negotiate_encoding(accept, encoding):
+    assert(compression.negotiate_encoding(accept) == encoding)
+
+
+def _decompress(body, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    import brotli
+    return brotli.decompress(body)
+
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+@pytest.mark.unit
+def test__compress_stream(encoding):
+    parts = [json.dumps({'n': i, 'pad': 'x' * i}).encode() for i in range(200)]
+    raw = b''.join(parts)
+    compressed = list(compression.compress_stream(iter(parts), encoding))
+    # one flushed block per part, plus the trailer
+    assert(len(compressed) == len(parts) + 1)
+    assert(_decompress(b''.join(compressed), encoding) == raw)
+    # every prefix is decodable as it arrives
+    if encoding == 'gzip':
+        d = compression.zlib.decompressobj(31)
+        assert(d.decompress(compressed[0]) == parts[0])
+    assert(_decompress(compression.compress(raw, encoding, True), encoding) == raw)
+
+
+@pytest.mark.unit
+def test__compress_response():
+    body = json.dumps([{'a': 'b' * 10} for _ in range(200)])
+
+    def _gen():
+        yield '['
+        yield body
+        yield ']'
+
+    res = compression.compress_response(Response(_gen(), 200), 'gzip')
+    assert(res.headers['Content-Encoding'] == 'gzip')
+    assert('Accept-Encoding' in res.headers['Vary'])
+    assert(gzip.decompress(b''.join(res.response)) == f'[{body}]'.encode())
+
+    res = compression.compress_response(Response(body, 200), 'gzip')
+    assert(gzip.decompress(res.get_data()) == body.encode())
+    # already encoded -> untouched
+    assert(compression.compress_response(res, 'gzip').get_data() == res.get_data())
+
+    for res, accept in [
+        (Response('small', 200), 'gzip'),
+        (Response(body, 404), 'gzip'),
+        (Response(body, 200), None),
+    ]:
+        res = compression.compress_response(res, accept)
+        assert('Content-Encoding' not in res.headers)
+
+
+@pytest.mark.unit
+def test__not_modified():
+    assert(compression.not_modified('"abc"', 'abc'))
+    assert(compression.not_modified('W/"abc"', 'abc'))
+    assert(compression.not_modified('"x", "abc-gzip"', 'abc'))
+    assert(compression.not_modified('*', 'abc'))
+    assert(not compression.not_modified('"abcd"', 'abc'))
+    assert(not compression.not_modified(None, 'abc'))
+    assert(not compression.not_modified('"abc"', None))
+
+    res = Response(json.dumps(['x' * 2000]), 200)
+    res.set_etag('abc')
+    res = compression.compress_response(res, 'gzip')
+    assert(res.get_etag() == ('abc-gzip', False))
+
+
+@pytest.mark.parametrize('body,valid', [
+    ({'aggregations': [{'count': {}}]}, True),
+    ({'aggregations': [{'sum': {'fieldPath': 'a'}}, {'max': {'fieldPath': 'a'}}]}, True),
+    ({'aggregations': []}, False),
+    ({'aggregations': [{}]}, False),
+    ({'aggregations': [{'count': {}, 'sum': {'fieldPath': 'a'}}]}, False),
+    ({'aggregations': [{'count': {}}, {'count': {}}]}, False),
+    ({'aggregations': [{'count': {}, 'alias': 'g'}], 'groupBy': [{'fieldPath': 'g'}]}, False),
+    ({'aggregations': [{'median': {'fieldPath': 'a'}}]}, False),
+])
+@pytest.mark.unit
+def test__aggregation_query_parse(body, valid):
+    if valid:
+        aggregation.AggregationQuery(**body)
+    else:
+        with pytest.raises(ValidationError):
+            aggregation.AggregationQuery(**body)
+
+
+@pytest.mark.unit
+def test__aggregation_reducer():
+    docs = [
+        {'g': 'a', 'n': 1, 'f': 1.5},
+        {'g': 'a', 'n': 2, 'f': None},
+        {'g': 'b', 'n': 'x', 'f': 2.5},
+        {'g': True, 'n': 4},
+        {'g': 1, 'n': 8},
+        {'n': 16},
+    ]
+    body = {
+        'groupBy': [{'fieldPath': 'g'}],
+        'aggregations': [
+            {'count': {}},
+            {'sum': {'fieldPath': 'n'}},
+            {'avg': {'fieldPath': 'n'}},
+            {'min': {'fieldPath': 'f'}, 'alias': 'low'},
+            {'max': {'fieldPath': 'f'}},
+        ]
+    }
+    reducer = aggregation.Reducer(aggregation.AggregationQuery(**body))
+    reducer.add(docs[:3])
+    reducer.add(docs[3:])
+    rows = reducer.result()
+    # null, bool, number, string
+    assert([r['g'] for r in rows] == [None, True, 1, 'a', 'b'])
+    by_group = {(type(r['g']), r['g']): r for r in rows}
+    assert(by_group[(str, 'a')] == {
+        'g': 'a', 'count': 2, 'sum_n': 3, 'avg_n': 1.5, 'low': 1.5, 'max_f': 1.5})
+    assert(by_group[(str, 'b')] == {
+        'g': 'b', 'count': 1, 'sum_n': 0, 'avg_n': None, 'low': 2.5, 'max_f': 2.5})
+    assert(by_group[(bool, True)]['sum_n'] == 4)
+    assert(by_group[(int, 1)]['sum_n'] == 8)
+    assert(isinstance(by_group[(str, 'a')]['sum_n'], int))
+
+    # no groups -> always a single row
+    body = {'aggregations': [{'count': {}}, {'min': {'fieldPath': 'n'}}]}
+    reducer = aggregation.Reducer(aggregation.AggregationQuery(**body))
+    assert(reducer.result() == [{'count': 0, 'min_n': None}])
+    reducer.add(docs)
+    assert(reducer.result() == [{'count': 6, 'min_n': 1}])
+
+    # min / max aren't only for numbers, they follow the order of orderBy
+    body = {'aggregations': [
+        {'min': {'fieldPath': 'n'}}, {'max': {'fieldPath': 'n'}},
+        {'min': {'fieldPath': 'd'}}, {'max': {'fieldPath': 'd'}},
+    ]}
+    reducer = aggregation.Reducer(aggregation.AggregationQuery(**body))
+    reducer.add([{'d': '2021-03-01', **d} for d in docs] + [{'d': '2020-12-31'}, {'d': None}])
+    assert(reducer.result() == [
+        {'min_n': 1, 'max_n': 'x', 'min_d': '2020-12-31', 'max_d': '2021-03-01'}])
+
+
+@pytest.mark.unit
+def test__query_select():
+    _q = query.StructuredQuery(**{
+        'select': {'fields': [{'fieldPath': 'a'}, {'fieldPath': 'c'}]},
+        'orderBy': [{'field': {'fieldPath': 'b'}, 'direction': 'ASCENDING'}]
+    })
+    assert(_q.selected_fields() == ['a', 'c'])
+    assert(_q.needed_fields() == ['a', 'c', 'b', 'uuid'])
+    assert(_q.project({'a': 1, 'b': 2, 'uuid': 'x'}) == {'a': 1})
+
+    _q = query.StructuredQuery()
+    assert(_q.selected_fields() is None and _q.needed_fields() is None)
+    doc = {'a': 1}
+    assert(_q.project(doc) is doc)
+
+
+@pytest.mark.unit
+def test__query_filter_shape():
+    def _filter(field, op, value):
+        return {'fieldFilter': {
+            'field': {'fieldPath': field}, 'op': op, 'value': {'stringValue': value}}}
+
+    def _shape(*filters):
+        return query.StructuredQuery(**{
+            'where': {'filter': {'compositeFilter': {'filters': [
+                {'filter': f} for f in filters
+            ]}}}
+        }).filter_shape()
+
+    a = _shape(_filter('a', 'EQUAL', 'x'), _filter('b', 'GREATER_THAN', 'y'))
+    assert(a == (('a', '=='), ('b', '>')))
+    # values and order don't matter
+    assert(a == _shape(_filter('b', 'GREATER_THAN', 'z'), _filter('a', 'EQUAL', 'w')))
+    assert(a != _shape(_filter('a', 'EQUAL', 'x'), _filter('b', 'LESS_THAN', 'y')))
+    assert(query.StructuredQuery().filter_shape() == ())
+
+
+@pytest.mark.unit
+def test__parse_query_cache():
+    query.PARSE_CACHE.clear()
+    body = {
+        'where': {'filter': {'fieldFilter': {
+            'field': {'fieldPath': 'a'}, 'op': 'EQUAL', 'value': {'integerValue': '1'}}}},
+        'orderBy': [{'field': {'fieldPath': 'b'}, 'direction': 'DESCENDING'}],
+        'limit': 5
+    }
+    _q = query.parse_query(body)
+    # the same body, in any key order, is only validated once
+    with patch.object(query.StructuredQuery, '__init__') as _init:
+        assert(query.parse_query(dict(reversed(list(body.items())))) is _q)
+        assert(not _init.called)
+    assert(_q == query.StructuredQuery(**body))
+    assert(_q.filter_shape() == (('a', '=='), ))
+    assert(_q.sort_terms() == (['b', 'uuid'], [True, False]))
+    assert(_q.key_values({'b': 2, 'uuid': 'x', 'c': 3}) == [2, 'x'])
+    # paging copies share the compiled parts
+    assert(_q.copy(update={'limit': 10}).sort_terms() == _q.sort_terms())
+
+    class _Base(object):
+        def __init__(self, terms=()):
+            self.terms = terms
+
+        def where(self, *term):
+            return _Base(self.terms + (term,))
+
+    assert(_q.filter(_Base()).terms == (('a', '==', '1'),))
+
+    with pytest.raises(ValidationError):
+        query.parse_query({'limit': -1})
+    assert(len(query.PARSE_CACHE) == 1)
+
+    with patch.object(query, 'get_type_hints') as _hints:
+        assert(query.ObjectValue(stringValue='x').get_value() == 'x')
+        assert(not _hints.called)
+
+
+@pytest.mark.parametrize('term,doc,expected', [
+    (('a', '==', '1'), {'a': '1'}, True),
+    (('a', '==', '1'), {'a': 1}, False),
+    (('a', '==', 1), {'a': '1'}, False),
+    (('a', '>', '10'), {'a': '9'}, True),  # strings compare as strings
+    (('a', '>', '10'), {'a': 9}, False),
+    (('a', '>=', '1.5'), {'a': 2.0}, False),
+    (('a', '<', 'x'), {'a': 'abc'}, True),
+    (('a', '<=', 'abc'), {'a': 'abc'}, True),
+    (('a', '==', 'true'), {'a': True}, False),
+    (('a', '==', 'x'), {'b': 'x'}, False),
+    (('a', '==', None), {'a': None}, True),
+    (('a', 'in', ['1', '2']), {'a': '2'}, True),
+    (('a', 'in', ['1', '2']), {'a': 2}, False),
+    (('a', 'in', ['1', '2']), {'a': '3'}, False),
+    (('a', 'array-contains', 'x'), {'a': ['x', 'y']}, True),
+    (('a', 'array-contains', 'x'), {'a': 'x'}, False),
+    (('a', 'array-contains-any', ['z', 'y']), {'a': ['x', 'y']}, True),
+    (('a', '<', ['x']), {'a': ['w']}, False),  # arrays only support equality
+    (('a', '==', {'b': '1'}), {'a': {'b': '1'}}, True),
+])
+@pytest.mark.unit
+def test__compile_filter(term, doc, expected):
+    assert(query.compile_filter([term])(doc) is expected)
+
+
+@pytest.mark.unit
+def test__query_filtered_locally():
+    _q = query.StructuredQuery(**{
+        'where': {'filter': {'compositeFilter': {'filters': [
+            {'filter': {'fieldFilter': {
+                'field': {'fieldPath': 'a'}, 'op': 'EQUAL', 'value': {'stringValue': '1'}}}},
+            {'filter': {'fieldFilter': {
+                'field': {'fieldPath': 'b'}, 'op': 'LESS_THAN', 'value': {'stringValue': 'm'}}}},
+        ]}}}
+    })
+    assert(_q.filter_fields() == ['a', 'b'])
+    assert(_q.matches({'a': '1', 'b': 'k'}))
+    assert(not _q.matches({'a': 1, 'b': 'k'}))
+    assert(not _q.matches({'a': '1', 'b': 'z'}))
+    assert(not _q.is_filtered_locally())
+
+    _local = _q.filtered_locally()
+    assert(_local.is_filtered_locally() and not _q.is_filtered_locally())
+    # still the same query, but nothing is sent to CFS
+    assert(_local == _q and _local.matches({'a': '1', 'b': 'k'}))
+    base = object()  # no `where` to call
+    assert(_local.filter(base) is base)
+    assert(not query.StructuredQuery().filtered_locally().is_filtered_locally())
+
+
+def _filtered(*terms):
+    return query.StructuredQuery(**{
+        'where': {'filter': {'compositeFilter': {'filters': [
+            {'filter': {'fieldFilter': {
+                'field': {'fieldPath': field}, 'op': op, 'value': value}}}
+            for field, op, value in terms
+        ]}}}
+    })
+
+
+@pytest.mark.unit
+def test__planner_selectivity():
+    _eq = ('a', 'EQUAL', {'stringValue': 'x'})
+    _gt = ('b', 'GREATER_THAN', {'stringValue': 'x'})
+    assert(planner.selectivity(None) == 1.0)
+    assert(planner.selectivity(query.StructuredQuery()) == 1.0)
+    assert(planner.selectivity(_filtered(_eq)) == pytest.approx(0.1))
+    assert(planner.selectivity(_filtered(_eq, _gt)) == pytest.approx(0.1 / 3))
+
+
+@pytest.mark.unit
+def test__planner_candidates():
+    _q = _filtered(('a', 'EQUAL', {'stringValue': 'x'}))
+    assert(planner.candidates(None, collection=10) == [
+        (planner.MULTI_GET, False), (planner.INTERSECT, False)])
+    assert(planner.candidates(_q, collection=10) == [
+        (planner.IN_CHUNKS, False), (planner.MULTI_GET, True),
+        (planner.INTERSECT, False), (planner.INTERSECT, True)])
+    # nothing runs the filter in CFS without an index
+    assert(planner.candidates(_q, has_index=False, collection=10) == [
+        (planner.MULTI_GET, True), (planner.INTERSECT, True)])
+    assert(planner.candidates(_q, count=True, intersect=False, collection=10) == [
+        (planner.COUNT, False), (planner.MULTI_GET, True)])
+    # the collection size is needed to estimate a scan
+    assert(planner.candidates(None, count=True) == [
+        (planner.COUNT, False), (planner.MULTI_GET, False)])
+
+
+@pytest.mark.parametrize('eligible,collection,terms,strategy,local', [
+    # a small slot list, a few chunks in one wave
+    (30, 100_000, 1, planner.IN_CHUNKS, False),
+    # a big slot list and a selective filter, one query instead of thousands
+    (50_000, 200_000, 2, planner.INTERSECT, False),
+    # a big slot list and a filter that isn't, the multi-gets read the same docs
+    (50_000, 1_000_000, 0, planner.MULTI_GET, False),
+    # most of the collection is eligible, a scan reads less
+    (99_000, 100_000, 0, planner.INTERSECT, False),
+])
+@pytest.mark.unit
+def test__planner_plan(eligible, collection, terms, strategy, local):
+    _q = _filtered(*[(f, 'EQUAL', {'stringValue': 'x'}) for f in 'ab'[:terms]]) \
+        if terms else None
+    options = planner.candidates(_q, collection=collection)
+    plan = planner.plan(_q, eligible, True, collection, options, 10, 300, 8)
+    assert((plan.strategy, plan.filtered_locally) == (strategy, local))
+    assert(len(plan.candidates) == len(options))
+    assert(plan.candidates[0].cost <= min(c.cost for c in plan.candidates))
+    assert(plan.reads == plan.candidates[0].reads)
+    assert(plan.dict()['strategy'] == strategy)
+
+
+@pytest.mark.unit
+def test__planner_estimate():
+    _in = planner.estimate(planner.IN_CHUNKS, False, 1000, None, 0.01, 10, 300, 8)
+    # empty results are still billed
+    assert((_in.reads, _in.round_trips) == (100, 100))
+    _get = planner.estimate(planner.MULTI_GET, True, 1000, None, 0.01, 10, 300, 8)
+    assert((_get.reads, _get.round_trips) == (1000, 4))
+    _scan = planner.estimate(planner.INTERSECT, False, 1000, 10_000, 0.01, 10, 300, 8)
+    assert((_scan.reads, _scan.round_trips) == (100, 1))
+    _count = planner.estimate(planner.COUNT, False, 1000, None, 0.01, 10, 300, 8)
+    assert((_count.reads, _count.round_trips) == (100, 100))
+    with pytest.raises(ValueError):
+        planner.estimate('other', False, 1, 1, 1, 10, 300, 8)
+
+
+@pytest.mark.unit
+def test__memory_backend():
+    cfs, rtdb = fb_memory.MemoryFirestore(), fb_memory.MemoryRTDB()
+    app_id = fb_memory.load_mock_project(cfs, rtdb)
+    assert(rtdb.reference(f'{app_id}/settings/uuid').get() == app_id)
+    assert(set(rtdb.reference(f'objects/{app_id}').get(shallow=True).values()) == {True})
+
+    uri = f'{app_id}/data/batch'
+    _ids = cfs.list(path=uri)
+    assert(_ids and _ids == sorted(_ids))
+    assert([i for page in cfs.list_pages(path=uri, page_size=10) for i in page] == _ids)
+    doc = cfs.ref(path=uri, _id=_ids[0]).get().to_dict()
+    assert(doc['uuid'] == _ids[0])
+
+    query_ = cfs.ref(path=uri).where('uuid', 'in', _ids[:3])
+    assert(sorted(d.id for d in query_.stream()) == _ids[:3])
+    assert(query_.count().get()[0][0].value == 3)
+    assert(len(query_.limit(2).get()) == 2)
+    selected = [d.to_dict() for d in query_.select(['uuid', '`version_modified`']).stream()]
+    assert(all(set(d) == {'uuid', 'version_modified'} for d in selected))
+    # filters compare raw values, missing fields never match
+    assert(not list(cfs.ref(path=uri).where('uuid', '==', 1).stream()))
+    assert(not list(cfs.ref(path=uri).where('missing', '>=', '').stream()))
+    # values are stored as strings, a number never matches them (and doesn't raise)
+    assert(not list(cfs.ref(path=uri).where('quantity', '>', 5.0).stream()))
+    assert(list(cfs.ref(path=uri).where('quantity', '>', '').stream()))
+    with pytest.raises(ValueError):
+        cfs.ref(path=uri).where('uuid', 'like', 'x')
+
+    snapshots = list(cfs.get_all([f'{uri}/{_ids[0]}', f'{uri}/missing'], field_paths=[]))
+    assert([s.exists for s in snapshots] == [True, False])
+    assert(snapshots[0].to_dict() == {})
+
+    ref = cfs.ref(path=uri, _id='new-doc')
+    ref.create({'uuid': 'new-doc', 'a': '1'})
+    with pytest.raises(AlreadyExists):
+        ref.create({'uuid': 'new-doc'})
+    ref.update({'a': '2'})
+    assert(ref.get().to_dict() == {'uuid': 'new-doc', 'a': '2'})
+    assert('new-doc' in cfs.list(path=uri))
+    ref.delete()
+    assert(not ref.get().exists and 'new-doc' not in cfs.list(path=uri))
+    with pytest.raises(NotFound):
+        ref.update({'a': '3'})
+
+    session = rtdb.reference('webapp/sessions/user/key')
+    session.set({'start_time': 1})
+    rtdb.reference('webapp/sessions/user').update({'other': {'start_time': 2}})
+    assert(rtdb.reference('webapp/sessions/user').get(shallow=True) == {
+        'key': True, 'other': True})
+    session.delete()
+    assert(rtdb.reference('webapp/sessions/user').get() == {'other': {'start_time': 2}})
+    # values are copies, changing them doesn't change the store
+    rtdb.reference('webapp/sessions/user').get()['other']['start_time'] = 3
+    assert(rtdb.reference('webapp/sessions/user/other/start_time').get() == 2)